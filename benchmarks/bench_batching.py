@@ -0,0 +1,90 @@
+"""
+Batches built up front (as trainIters did before utils/batching.py) against lazily built batches with background
+prefetching: time until the first training step, memory held by the batches and iterations per second of a
+training loop on synthetic sentence pairs.
+
+Usage: python -m benchmarks.bench_batching --iterations 2000 --batch_size 64
+"""
+import argparse
+import random
+import time
+
+import torch
+from torch import optim
+
+from experiment.train_eval import train
+from model.model import EncoderLSTM, DecoderLSTM
+from utils.batching import sample_batches, prefetch_batches
+from utils.tokenize import Voc, batch2TrainData
+
+
+def synthetic_pairs(n_pairs, vocab_size, max_len, seed=1):
+    rng = random.Random(seed)
+    sentence = lambda: " ".join("w%d" % rng.randrange(vocab_size) for _ in range(rng.randint(3, max_len)))
+    return [[sentence(), sentence()] for _ in range(n_pairs)]
+
+
+def batch_bytes(batch):
+    return sum(t.element_size() * t.nelement() for t in batch if isinstance(t, torch.Tensor))
+
+
+def run(batches, encoder, decoder, iterations, batch_size):
+    encoder_optimizer = optim.Adam(encoder.parameters())
+    decoder_optimizer = optim.Adam(decoder.parameters())
+    start = time.perf_counter()
+    for _ in range(iterations):
+        inp, lengths, target, mask, max_target_len, trg_lengths = next(batches)
+        train(inp, lengths, target, mask, max_target_len, trg_lengths, encoder, decoder, encoder_optimizer,
+              decoder_optimizer, batch_size, None, K=0)
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Up front vs. lazy batch production')
+    parser.add_argument('--iterations', type=int, default=2000, help='number of batches')
+    parser.add_argument('--timed_iterations', type=int, default=200, help='training steps timed per configuration')
+    parser.add_argument('--batch_size', type=int, default=64, help='batch size')
+    parser.add_argument('--pairs', type=int, default=50000, help='number of synthetic sentence pairs')
+    parser.add_argument('--vocab', type=int, default=5000, help='vocabulary size')
+    parser.add_argument('--max_len', type=int, default=10, help='max sentence length')
+    parser.add_argument('--emb', type=int, default=64, help='embedding size')
+    parser.add_argument('--hid', type=int, default=64, help='hidden size')
+    args = parser.parse_args()
+
+    pairs = synthetic_pairs(args.pairs, args.vocab, args.max_len)
+    src_voc, tar_voc = Voc("src"), Voc("trg")
+    for src, trg in pairs:
+        src_voc.addSentence(src)
+        tar_voc.addSentence(trg)
+
+    ### Up front: all batches are built before the first step
+    start = time.perf_counter()
+    random.seed(1)
+    all_batches = [batch2TrainData(src_voc, tar_voc, [random.choice(pairs) for _ in range(args.batch_size)])
+                   for _ in range(args.iterations)]
+    upfront_first = time.perf_counter() - start
+    upfront_bytes = sum(batch_bytes(batch) for batch in all_batches)
+
+    configurations = [("up front", None, None), ("lazy, no workers", 0, False), ("1 thread", 1, False),
+                      ("2 threads", 2, False), ("2 processes", 2, True)]
+    print("{:<18} {:>15} {:>15} {:>10}".format("batches", "first batch ms", "batch memory MB", "it/s"))
+    for name, num_workers, use_processes in configurations:
+        torch.manual_seed(1)
+        encoder = EncoderLSTM(src_voc.num_words, args.emb, args.hid)
+        decoder = DecoderLSTM(tar_voc.num_words, args.emb, args.hid)
+        if num_workers is None:
+            batches, first, memory = iter(all_batches), upfront_first, upfront_bytes
+        else:
+            start = time.perf_counter()
+            batches = prefetch_batches(src_voc, tar_voc,
+                                       sample_batches(pairs, args.batch_size, args.iterations, seed=1),
+                                       num_workers=num_workers, prefetch=4, use_processes=use_processes)
+            first_batch = next(batches)
+            first = time.perf_counter() - start
+            # At most prefetch + 1 batches are alive at the same time
+            memory = batch_bytes(first_batch) * (4 + 1 if num_workers else 1)
+        duration = run(batches, encoder, decoder, args.timed_iterations, args.batch_size)
+        print("{:<18} {:>15.1f} {:>15.2f} {:>10.1f}".format(name, first * 1000, memory / 2 ** 20,
+                                                           args.timed_iterations / duration))
+        if num_workers is not None:
+            batches.close()
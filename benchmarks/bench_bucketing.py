@@ -0,0 +1,91 @@
+"""
+Random batches (random.choice, as trainIters samples them by default) against length-bucketed batches with a fixed
+batch size and with a token budget: padding ratio, sentences per batch and effective (non-padding) tokens per second
+of the training step.
+
+Usage: python -m benchmarks.bench_bucketing --batch_size 64 --max_tokens 800
+       python -m benchmarks.bench_bucketing --data data/prepro/eng-deu_cleaned_full.pkl
+"""
+import argparse
+import random
+import time
+
+import torch
+from torch import optim
+
+from experiment.train_eval import train
+from model.model import EncoderLSTM, DecoderLSTM
+from utils.batching import sample_batches, sample_bucket_batches, padding_statistics
+from utils.prepro import load_cleaned_data
+from utils.tokenize import Voc, batch2TrainData
+
+
+def synthetic_pairs(n_pairs, vocab_size, max_len, seed=1):
+    # Lengths of source and target are correlated, as for real translations
+    rng = random.Random(seed)
+    sentence = lambda length: " ".join("w%d" % rng.randrange(vocab_size) for _ in range(length))
+    pairs = []
+    for _ in range(n_pairs):
+        length = rng.randint(2, max_len)
+        pairs.append([sentence(length), sentence(min(max(length + rng.randint(-2, 2), 1), max_len))])
+    return pairs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Random vs. length-bucketed batches')
+    parser.add_argument('--data', type=str, default="", help='preprocessed pairs (.pkl). Default: synthetic pairs')
+    parser.add_argument('--pairs', type=int, default=50000, help='number of synthetic sentence pairs')
+    parser.add_argument('--max_len', type=int, default=25, help='max length of the synthetic sentences')
+    parser.add_argument('--vocab', type=int, default=5000, help='vocabulary size of the synthetic sentences')
+    parser.add_argument('--batch_size', type=int, default=64, help='batch size')
+    parser.add_argument('--max_tokens', type=int, default=0, help='token budget. Default: batch_size x average longest sentence of the random batches')
+    parser.add_argument('--iterations', type=int, default=100, help='timed training steps per sampler')
+    parser.add_argument('--emb', type=int, default=128, help='embedding size')
+    parser.add_argument('--hid', type=int, default=128, help='hidden size')
+    args = parser.parse_args()
+
+    if args.data:
+        pairs = load_cleaned_data("", args.data)
+    else:
+        pairs = synthetic_pairs(args.pairs, args.vocab, args.max_len)
+    src_voc, tar_voc = Voc("src"), Voc("trg")
+    for src, trg in pairs:
+        src_voc.addSentence(src)
+        tar_voc.addSentence(trg)
+
+    random_batches = [batch2TrainData(src_voc, tar_voc, batch)
+                      for batch in sample_batches(pairs, args.batch_size, args.iterations, seed=1)]
+    max_tokens = args.max_tokens
+    if not max_tokens:
+        # Same number of tokens (including padding) per batch as the random batches
+        max_tokens = sum(max(batch[0].size(0), batch[2].size(0)) * batch[0].size(1) for batch in random_batches)
+        max_tokens //= len(random_batches)
+
+    samplers = [("random", random_batches),
+                ("bucket, batch size", [batch2TrainData(src_voc, tar_voc, batch) for batch in
+                                        sample_bucket_batches(pairs, args.iterations, args.batch_size, seed=1)]),
+                ("bucket, %d tokens" % max_tokens, [batch2TrainData(src_voc, tar_voc, batch) for batch in
+                                                    sample_bucket_batches(pairs, args.iterations, max_tokens=max_tokens,
+                                                                          seed=1)])]
+
+    print("{:<22} {:>9} {:>14} {:>12} {:>10}".format("batches", "padding", "sentences/bat", "ms/step", "tokens/s"))
+    for name, batches in samplers:
+        torch.manual_seed(1)
+        encoder = EncoderLSTM(src_voc.num_words, args.emb, args.hid)
+        decoder = DecoderLSTM(tar_voc.num_words, args.emb, args.hid)
+        encoder_optimizer = optim.Adam(encoder.parameters())
+        decoder_optimizer = optim.Adam(decoder.parameters())
+
+        real, padded = 0, 0
+        start = time.perf_counter()
+        for batch in batches:
+            inp, lengths, target, mask, max_target_len, trg_lengths = batch
+            train(inp, lengths, target, mask, max_target_len, trg_lengths, encoder, decoder, encoder_optimizer,
+                  decoder_optimizer, inp.size(1), None, K=0)
+            batch_real, batch_padded = padding_statistics(batch)
+            real += batch_real
+            padded += batch_padded
+        duration = time.perf_counter() - start
+        sentences = sum(batch[0].size(1) for batch in batches) / len(batches)
+        print("{:<22} {:>8.1f}% {:>14.1f} {:>12.1f} {:>10.0f}".format(name, 100. * (1 - real / padded), sentences,
+                                                                    duration * 1000 / len(batches), real / duration))
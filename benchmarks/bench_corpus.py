@@ -0,0 +1,64 @@
+"""
+Start-up cost of the training data: pickled sentence pairs (load, split, build vocabularies, encode) against the
+memory-mapped encoded corpus (utils/corpus.py), and batch building from both.
+
+Usage: python -m benchmarks.bench_corpus --pairs 200000
+"""
+import argparse
+import os
+import pickle
+import random
+import tempfile
+import time
+
+from utils.corpus import save_encoded_corpus, load_encoded_corpus
+from utils.tokenize import build_vocab, encode_pairs, encodedBatch2TrainData
+from utils.utils import split_data
+
+
+def synthetic_pairs(n_pairs, vocab_size, max_len, seed=1):
+    rng = random.Random(seed)
+    sentence = lambda: " ".join("w%d" % rng.randrange(vocab_size) for _ in range(rng.randint(2, max_len)))
+    return [[sentence(), sentence()] for _ in range(n_pairs)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pickled pairs vs. memory-mapped encoded corpus')
+    parser.add_argument('--pairs', type=int, default=200000, help='number of synthetic sentence pairs')
+    parser.add_argument('--max_len', type=int, default=10, help='max sentence length')
+    parser.add_argument('--vocab', type=int, default=30000, help='vocabulary size')
+    parser.add_argument('--batches', type=int, default=1000, help='batches of 64 built from each format')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        pkl_file = os.path.join(directory, "pairs.pkl")
+        with open(pkl_file, "wb") as f:
+            pickle.dump(synthetic_pairs(args.pairs, args.vocab, args.max_len), f)
+
+        start = time.perf_counter()
+        with open(pkl_file, "rb") as f:
+            pairs = pickle.load(f)
+        train_set, val_set, test_set = split_data(pairs, seed=1)
+        src_voc = build_vocab([pair[0] for pair in train_set], "eng")
+        tar_voc = build_vocab([pair[1] for pair in train_set], "deu")
+        encoded_train = encode_pairs(src_voc, tar_voc, train_set)
+        pickled_time = time.perf_counter() - start
+
+        corpus_dir = os.path.join(directory, "corpus")
+        save_encoded_corpus(corpus_dir, src_voc, tar_voc, {"train": train_set, "val": val_set, "test": test_set})
+        corpus_size = sum(os.path.getsize(os.path.join(corpus_dir, f)) for f in os.listdir(corpus_dir))
+
+        start = time.perf_counter()
+        _, _, splits, _ = load_encoded_corpus(corpus_dir)
+        corpus_time = time.perf_counter() - start
+
+        print("Start-up: pickled pairs %.3f s (%.1f MB), encoded corpus %.3f s (%.1f MB)"
+              % (pickled_time, os.path.getsize(pkl_file) / 2 ** 20, corpus_time, corpus_size / 2 ** 20))
+
+        rng = random.Random(1)
+        indexes = [[rng.randrange(len(encoded_train)) for _ in range(64)] for _ in range(args.batches)]
+        for name, data in (("encoded pairs (list)", encoded_train), ("encoded corpus (mmap)", splits["train"])):
+            start = time.perf_counter()
+            for batch in indexes:
+                encodedBatch2TrainData([data[i] for i in batch])
+            print("Batches from %s: %.3f ms per batch" % (name, (time.perf_counter() - start) * 1000 / args.batches))
@@ -0,0 +1,103 @@
+"""
+Counts the allocations done by the greedy inference loop itself (encoder and decoder calls excluded)
+for growing output lengths. EOS is suppressed, so that every sentence is decoded for max_length steps.
+
+Usage: python -m benchmarks.bench_decode_allocations --lengths 10 20 40 80
+"""
+import argparse
+
+import torch
+from torch import nn
+from torch.autograd import profiler
+
+from experiment.train_eval import GreedySearchDecoder
+from global_settings import device
+from model.model import EncoderLSTM, DecoderLSTM
+from utils.tokenize import SOS_token, EOS_token, PAD_token
+
+
+class CatGreedySearchDecoder(GreedySearchDecoder):
+    """
+    Reference implementation growing the outputs with torch.cat on every step (previous behaviour)
+    """
+    @torch.no_grad()
+    def forward(self, input_seq, input_length, max_length):
+        device = input_seq.device
+        batch_size = input_seq.size(1)
+        encoder_outputs, decoder_hidden = self.encoder(input_seq, input_length)
+        decoder_input = torch.ones(1, batch_size, device=device, dtype=torch.long) * SOS_token
+        finished = torch.zeros(batch_size, device=device, dtype=torch.bool)
+        all_tokens = torch.zeros([0, batch_size], device=device, dtype=torch.long)
+        all_scores = torch.zeros([0, batch_size], device=device)
+        for _ in range(max_length):
+            decoder_output, decoder_hidden = self.decoder(decoder_input, decoder_hidden, logits=True)
+            decoder_output = decoder_output.float()
+            decoder_scores, decoder_input = torch.max(decoder_output, dim=1)
+            decoder_scores = (decoder_scores - torch.logsumexp(decoder_output, dim=1)).exp()
+            decoder_input = decoder_input.masked_fill(finished, PAD_token)
+            decoder_scores = decoder_scores.masked_fill(finished, 0.)
+            all_tokens = torch.cat((all_tokens, decoder_input.unsqueeze(0)), dim=0)
+            all_scores = torch.cat((all_scores, decoder_scores.unsqueeze(0)), dim=0)
+            finished = finished | (decoder_input == EOS_token)
+            if finished.all():
+                break
+            decoder_input = torch.unsqueeze(decoder_input, 0)
+        return all_tokens.t(), all_scores.t()
+
+
+class Recorded(nn.Module):
+    """
+    Wraps a model component, so that its allocations can be told apart in the profile
+    """
+    def __init__(self, module, name):
+        super(Recorded, self).__init__()
+        self.module = module
+        self.name = name
+
+    def forward(self, *args, **kwargs):
+        with profiler.record_function(self.name):
+            return self.module(*args, **kwargs)
+
+
+def loop_allocations(searcher, input_seq, lengths, max_length):
+    """
+    Profiles a single searcher call
+    :return: number of allocations and allocated bytes of the searcher, without encoder and decoder
+    """
+    with profiler.profile(profile_memory=True) as prof:
+        searcher(input_seq, lengths, max_length)
+    count, allocated = 0, 0
+    for event in prof.function_events:
+        if event.cpu_parent is None and event.name not in ("encoder", "decoder") and event.cpu_memory_usage > 0:
+            count += 1
+            allocated += event.cpu_memory_usage
+    return count, allocated
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Allocations of the greedy decoding loop')
+    parser.add_argument('--lengths', type=int, nargs='+', default=[10, 20, 40, 80], help='decoding lengths')
+    parser.add_argument('--batch_size', type=int, default=64, help='number of sentences per batch')
+    parser.add_argument('--vocab', type=int, default=10000, help='target vocabulary size')
+    parser.add_argument('--hid', type=int, default=256, help='hidden size')
+    args = parser.parse_args()
+
+    torch.manual_seed(1)
+    encoder = EncoderLSTM(args.vocab, args.hid, args.hid).to(device).eval()
+    decoder = DecoderLSTM(args.vocab, args.hid, args.hid).to(device).eval()
+    with torch.no_grad():
+        decoder.out.bias[EOS_token] = -1e4
+    encoder, decoder = Recorded(encoder, "encoder"), Recorded(decoder, "decoder")
+
+    input_seq = torch.randint(4, args.vocab, (10, args.batch_size), device=device)
+    lengths = torch.full((args.batch_size,), 10, dtype=torch.long)
+
+    print("{:>10} {:>8} {:>12} {:>20} {:>20}".format("searcher", "length", "allocations", "allocations/sentence",
+                                                   "bytes/sentence"))
+    for name, searcher in [("cat", CatGreedySearchDecoder(encoder, decoder)),
+                           ("prealloc", GreedySearchDecoder(encoder, decoder))]:
+        for max_length in args.lengths:
+            with torch.no_grad():
+                count, allocated = loop_allocations(searcher, input_seq, lengths, max_length)
+            print("{:>10} {:>8} {:>12} {:>20.2f} {:>20.1f}".format(name, max_length, count, count / args.batch_size,
+                                                                 allocated / args.batch_size))
@@ -0,0 +1,109 @@
+"""
+Free-running decoder loops of train() (without teacher forcing) and eval(): the current on-device loops, which read
+the loss once per batch, against the former ones, which rebuilt the next decoder input with a Python loop over the
+batch and read the loss at every step. Throughput in target tokens per second, and the largest loss difference.
+
+Usage: python -m benchmarks.bench_decode_loop --batch_sizes 16 64 256
+"""
+import argparse
+import copy
+import time
+
+import numpy as np
+import torch
+from torch import optim
+
+from experiment.train_eval import train, eval, detach_states
+from global_settings import device
+from model.model import EncoderLSTM, DecoderLSTM
+from utils.tokenize import SOS_token, EOS_token, encodedBatch2TrainData
+from utils.utils import maskCrossEntropyLoss
+
+
+def former_train(input_variable, lengths, target_variable, mask, max_target_len, encoder, decoder,
+                 encoder_optimizer, decoder_optimizer, batch_size):
+    # Free-running branch of train() before the change (tbptt=True, no clipping)
+    encoder_optimizer.zero_grad()
+    decoder_optimizer.zero_grad()
+    loss, print_losses, n_totals = 0, [], 0
+    _, decoder_states = encoder(input_variable.to(device), lengths.to(device))
+    decoder_input = torch.LongTensor([[SOS_token for _ in range(batch_size)]]).to(device)
+    for t in range(max_target_len):
+        decoder_output, decoder_states = decoder(decoder_input, decoder_states, logits=True)
+        decoder_states = detach_states(decoder_states)
+        _, topi = decoder_output.topk(1)
+        decoder_input = torch.LongTensor([[topi[i][0] for i in range(batch_size)]]).to(device)
+        mask_loss, nTotal = maskCrossEntropyLoss(decoder_output, target_variable[t], mask[t])
+        loss += mask_loss
+        print_losses.append(mask_loss.item() * nTotal.item())
+        n_totals += nTotal.item()
+    loss.backward()
+    encoder_optimizer.step()
+    decoder_optimizer.step()
+    return sum(print_losses) / n_totals
+
+
+def former_eval(input_variable, lengths, target_variable, mask, max_target_len, encoder, decoder, batch_size):
+    print_losses, n_totals = [], 0
+    with torch.no_grad():
+        _, decoder_states = encoder(input_variable.to(device), lengths.to(device))
+        decoder_input = torch.LongTensor([[SOS_token for _ in range(batch_size)]]).to(device)
+        for t in range(max_target_len):
+            decoder_output, decoder_states = decoder(decoder_input, decoder_states, logits=True)
+            _, topi = decoder_output.topk(1)
+            decoder_input = torch.LongTensor([[topi[i][0] for i in range(batch_size)]]).to(device)
+            mask_loss, nTotal = maskCrossEntropyLoss(decoder_output, target_variable[t], mask[t])
+            print_losses.append(mask_loss.item() * nTotal.item())
+            n_totals += nTotal.item()
+    return sum(print_losses) / n_totals
+
+
+def random_batches(n_batches, batch_size, max_len, vocab_size, seed=1):
+    rng = np.random.default_rng(seed)
+    sentence = lambda: np.append(rng.integers(4, vocab_size, rng.integers(1, max_len + 1)), EOS_token).astype(np.int32)
+    return [encodedBatch2TrainData([(sentence(), sentence()) for _ in range(batch_size)]) for _ in range(n_batches)]
+
+
+def throughput(step, batches):
+    losses = [step(batches[0])]  # warm-up
+    start = time.perf_counter()
+    losses = [step(batch) for batch in batches[1:]]
+    n_tokens = sum(int(batch[3].sum()) for batch in batches[1:])
+    return n_tokens / (time.perf_counter() - start), losses
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Free-running decoder loops: on-device vs. former')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[16, 64, 256], help='batch sizes')
+    parser.add_argument('--max_len', type=int, default=10, help='max sentence length')
+    parser.add_argument('--vocab', type=int, default=5000, help='vocabulary size')
+    parser.add_argument('--emb', type=int, default=256, help='embedding size')
+    parser.add_argument('--hid', type=int, default=256, help='hidden size')
+    parser.add_argument('--batches', type=int, default=20, help='timed batches')
+    args = parser.parse_args()
+
+    torch.manual_seed(1)
+    encoder = EncoderLSTM(args.vocab, args.emb, args.hid).to(device)
+    decoder = DecoderLSTM(args.vocab, args.emb, args.hid).to(device)
+    print("{:>6} {:<6} {:>14} {:>14} {:>9} {:>14}".format("batch", "loop", "former tok/s", "current tok/s",
+                                                          "speedup", "max loss diff"))
+    for batch_size in args.batch_sizes:
+        batches = random_batches(args.batches + 1, batch_size, args.max_len, args.vocab)
+        results = {}
+        for name, former in (("former", True), ("current", False)):
+            enc, dec = copy.deepcopy(encoder), copy.deepcopy(decoder)
+            enc_opt, dec_opt = optim.Adam(enc.parameters()), optim.Adam(dec.parameters())
+            if former:
+                train_step = lambda b: former_train(b[0], b[1], b[2], b[3], b[4], enc, dec, enc_opt, dec_opt,
+                                                    b[0].size(1))
+                eval_step = lambda b: former_eval(b[0], b[1], b[2], b[3], b[4], enc, dec, b[0].size(1))
+            else:
+                train_step = lambda b: train(*b, enc, dec, enc_opt, dec_opt, b[0].size(1), None,
+                                             teacher_forcing_ratio=0)
+                eval_step = lambda b: eval(*b, enc, dec, b[0].size(1))
+            results[name] = throughput(train_step, batches), throughput(eval_step, batches)
+        for i, loop in enumerate(("train", "eval")):
+            (former_speed, former_losses), (current_speed, current_losses) = results["former"][i], results["current"][i]
+            print("{:>6} {:<6} {:>14.0f} {:>14.0f} {:>8.2f}x {:>14.2e}".format(
+                batch_size, loop, former_speed, current_speed, current_speed / former_speed,
+                max(abs(a - b) for a, b in zip(former_losses, current_losses))))
@@ -0,0 +1,117 @@
+"""
+Scaling of the data-parallel training (utils/distributed.py, gloo backend) on one machine: training throughput in
+target tokens per second against the number of processes. Every process trains on its own batches of --batch_size
+pairs (the global batch grows with the number of processes) with --threads threads. Also reported: time of the
+gradient all-reduce per step and the largest parameter difference between the replicas after training (0 if the
+replicas stayed in sync).
+
+Usage: python -m benchmarks.bench_distributed --procs 1 2 4 8 --threads 1
+"""
+import argparse
+import os
+import socket
+import time
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch import optim
+
+import experiment.train_eval as train_eval
+from model.model import EncoderLSTM, DecoderLSTM
+from utils.distributed import init_distributed, broadcast_parameters, all_reduce_values
+from utils.tokenize import EOS_token, encodedBatch2TrainData
+
+
+def random_batches(n_batches, batch_size, max_len, vocab_size, seed):
+    rng = np.random.default_rng(seed)
+    sentence = lambda: np.append(rng.integers(4, vocab_size, rng.integers(1, max_len + 1)), EOS_token).astype(np.int32)
+    return [encodedBatch2TrainData([(sentence(), sentence()) for _ in range(batch_size)]) for _ in range(n_batches)]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def worker(rank, world_size, port, args, results):
+    os.environ.update(MASTER_ADDR="127.0.0.1", MASTER_PORT=str(port), RANK=str(rank), WORLD_SIZE=str(world_size),
+                      LOCAL_RANK=str(rank))
+    init_distributed()
+    torch.set_num_threads(args.threads)
+    torch.manual_seed(rank)
+    encoder = EncoderLSTM(args.vocab, args.emb, args.hid)
+    decoder = DecoderLSTM(args.vocab, args.emb, args.hid)
+    broadcast_parameters([encoder, decoder])
+    encoder_optimizer = optim.Adam(encoder.parameters())
+    decoder_optimizer = optim.Adam(decoder.parameters())
+    batches = random_batches(args.steps + 1, args.batch_size, args.max_len, args.vocab, seed=rank)
+
+    # Time of the gradient all-reduce
+    reduce_times = []
+    all_reduce_gradients = train_eval.all_reduce_gradients
+
+    def timed_all_reduce(modules):
+        start = time.perf_counter()
+        all_reduce_gradients(modules)
+        reduce_times.append(time.perf_counter() - start)
+    train_eval.all_reduce_gradients = timed_all_reduce
+
+    start = time.perf_counter()
+    for i, batch in enumerate(batches):
+        if i == 1:
+            # The first step is not timed (allocation of the optimizer states)
+            start = time.perf_counter()
+        train_eval.train(*batch, encoder, decoder, encoder_optimizer, decoder_optimizer, args.batch_size, 50.,
+                         teacher_forcing_ratio=args.teacher)
+    elapsed = time.perf_counter() - start
+    n_tokens = sum(int(batch[3].sum()) for batch in batches[1:])
+
+    params = torch.cat([param.detach().flatten() for param in list(encoder.parameters()) + list(decoder.parameters())])
+    params_max, params_min = params.clone(), params.clone()
+    if world_size > 1:
+        dist.all_reduce(params_max, op=dist.ReduceOp.MAX)
+        dist.all_reduce(params_min, op=dist.ReduceOp.MIN)
+    # Throughput of all processes together, measured on the slowest one
+    total_tokens, = all_reduce_values([n_tokens], average=False)
+    max_elapsed = torch.tensor([elapsed], dtype=torch.double)
+    if world_size > 1:
+        dist.all_reduce(max_elapsed, op=dist.ReduceOp.MAX)
+    reduce_ms, = all_reduce_values([sum(reduce_times[1:]) * 1000 / args.steps])
+    if rank == 0:
+        results.put((total_tokens / max_elapsed.item(), max_elapsed.item() * 1000 / args.steps, reduce_ms,
+                     (params_max - params_min).abs().max().item()))
+    if world_size > 1:
+        dist.destroy_process_group()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Data-parallel training: throughput vs. number of processes')
+    parser.add_argument('--procs', type=int, nargs='+', default=[1, 2, 4], help='numbers of processes')
+    parser.add_argument('--threads', type=int, default=1, help='threads per process')
+    parser.add_argument('--max_len', type=int, default=10, help='max sentence length')
+    parser.add_argument('--vocab', type=int, default=5000, help='vocabulary size')
+    parser.add_argument('--emb', type=int, default=256, help='embedding size')
+    parser.add_argument('--hid', type=int, default=256, help='hidden size')
+    parser.add_argument('--batch_size', type=int, default=64, help='batch size per process')
+    parser.add_argument('--teacher', type=float, default=1., help='teacher forcing ratio')
+    parser.add_argument('--steps', type=int, default=20, help='timed training steps')
+    args = parser.parse_args()
+
+    print("CPU cores: %d, threads per process: %d" % (os.cpu_count(), args.threads))
+    print("{:>6} {:>10} {:>9} {:>11} {:>10} {:>14} {:>16}".format("procs", "tokens/s", "speedup", "efficiency",
+                                                                  "ms/step", "all-reduce ms", "max param diff"))
+    context = mp.get_context("spawn")
+    baseline = None
+    for n_procs in args.procs:
+        results = context.SimpleQueue()
+        mp.spawn(worker, args=(n_procs, free_port(), args, results), nprocs=n_procs)
+        throughput, step_time, reduce_time, param_diff = results.get()
+        if baseline is None:
+            # Throughput of a single process, taken from the first configuration
+            baseline = throughput / n_procs
+        speedup = throughput / baseline
+        print("{:>6} {:>10.0f} {:>8.2f}x {:>10.0f}% {:>10.1f} {:>14.2f} {:>16.2e}".format(
+            n_procs, throughput, speedup, 100 * speedup / n_procs, step_time, reduce_time, param_diff))
@@ -0,0 +1,66 @@
+"""
+Compares the decoder output path used so far (softmax + maskNLLLoss) with the fused one
+(logits + maskCrossEntropyLoss) for forward and backward of a single decoder step.
+
+Usage: python -m benchmarks.bench_loss --vocab 5000 15000 35000
+"""
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+
+from global_settings import device
+from utils.tokenize import PAD_token
+from utils.utils import maskNLLLoss, maskCrossEntropyLoss
+
+
+def time_step(loss_fn, hidden, weight, target, mask, softmax, repeats):
+    """
+    Average time of projection, loss and backward pass
+    """
+    timings = []
+    for _ in range(repeats + 1):
+        weight.grad = None
+        start = time.perf_counter()
+        logits = hidden.matmul(weight.t())
+        output = F.softmax(logits, dim=1) if softmax else logits
+        loss, _ = loss_fn(output, target, mask)
+        loss.backward()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        timings.append(time.perf_counter() - start)
+    # First run is a warm up
+    return sum(timings[1:]) / repeats, loss.item()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Softmax + maskNLLLoss vs. fused masked cross entropy')
+    parser.add_argument('--vocab', type=int, nargs='+', default=[5000, 15000, 35000], help='target vocabulary sizes')
+    parser.add_argument('--batch_size', type=int, default=64, help='batch size')
+    parser.add_argument('--hid', type=int, default=256, help='hidden size')
+    parser.add_argument('--repeats', type=int, default=50, help='timed repetitions')
+    args = parser.parse_args()
+
+    torch.manual_seed(1)
+    print("{:>8} {:>14} {:>14} {:>9} {:>14} {:>14}".format("vocab", "softmax+nll ms", "fused ms", "speedup",
+                                                           "softmax+nll", "fused"))
+    for vocab_size in args.vocab:
+        hidden = torch.randn(args.batch_size, args.hid, device=device)
+        weight = torch.randn(vocab_size, args.hid, device=device).mul_(0.05).requires_grad_()
+        target = torch.randint(4, vocab_size, (args.batch_size,), device=device)
+        target[args.batch_size // 2:] = PAD_token
+        mask = target != PAD_token
+
+        nll_time, nll_loss = time_step(maskNLLLoss, hidden, weight, target, mask, True, args.repeats)
+        fused_time, fused_loss = time_step(maskCrossEntropyLoss, hidden, weight, target, mask, False, args.repeats)
+        print("{:>8} {:>14.3f} {:>14.3f} {:>8.2f}x {:>14.4f} {:>14.4f}".format(
+            vocab_size, nll_time * 1000, fused_time * 1000, nll_time / fused_time, nll_loss, fused_loss))
+
+    # Numerical robustness: confident wrong predictions underflow the softmax probability to 0
+    logits = torch.tensor([[100., -100.]], device=device)
+    target = torch.tensor([1], device=device)
+    mask = torch.tensor([True], device=device)
+    print("Loss for a confident wrong prediction: softmax+nll {:.4f}, fused {:.4f}".format(
+        maskNLLLoss(F.softmax(logits, dim=1), target, mask)[0].item(),
+        maskCrossEntropyLoss(logits, target, mask)[0].item()))
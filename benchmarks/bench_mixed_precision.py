@@ -0,0 +1,141 @@
+"""
+bfloat16 autocast (run_experiment.py --mixed_precision, translate.py --mixed_precision) against fp32:
+training step time, greedy search latency with the share of identical output tokens, and the final validation loss
+of the two trained models. Both runs start from the same weights and see the same batches, the validation loss is
+computed in fp32 for both. The check fails (exit code 1) if the bfloat16 validation loss is more than --tolerance
+(relative) above the fp32 one.
+Default data: synthetic copy task (the target is the source sentence), or a tab separated corpus with --data.
+
+Usage: python -m benchmarks.bench_mixed_precision --steps 1000 --tolerance 0.02
+       python -m benchmarks.bench_mixed_precision --data data/deu.txt
+"""
+import argparse
+import copy
+import random
+import sys
+import time
+
+import numpy as np
+import torch
+from torch import optim
+
+from experiment.train_eval import train, eval_batch, GreedySearchDecoder
+from model.model import EncoderLSTM, DecoderLSTM
+from utils.prepro import iter_lines, iter_preprocessed
+from utils.tokenize import EOS_token, build_vocab, encode_pairs, encodedBatch2TrainData
+
+
+def copy_task_pairs(n_pairs, vocab_size, max_len, seed=1):
+    rng = np.random.default_rng(seed)
+    pairs = []
+    for _ in range(n_pairs):
+        sentence = np.append(rng.integers(4, vocab_size, rng.integers(1, max_len)), EOS_token).astype(np.int32)
+        pairs.append((sentence, sentence.copy()))
+    return pairs, vocab_size, vocab_size
+
+
+def corpus_pairs(path, max_len):
+    pairs = list(iter_preprocessed(iter_lines("", path), True, max_len=max_len))
+    src_voc = build_vocab([src for src, _ in pairs], "src")
+    trg_voc = build_vocab([trg for _, trg in pairs], "trg")
+    return encode_pairs(src_voc, trg_voc, pairs), src_voc.num_words, trg_voc.num_words
+
+
+def make_batches(pairs, n_batches, batch_size, seed):
+    rng = random.Random(seed)
+    return [encodedBatch2TrainData(rng.sample(pairs, batch_size)) for _ in range(n_batches)]
+
+
+def train_steps(encoder, decoder, batches, teacher, mixed_precision):
+    encoder_optimizer = optim.Adam(encoder.parameters(), lr=0.003)
+    decoder_optimizer = optim.Adam(decoder.parameters(), lr=0.003)
+    random.seed(1)
+    start = time.perf_counter()
+    for i, batch in enumerate(batches):
+        if i == 1:
+            # The first step is not timed (allocation of the optimizer states)
+            start = time.perf_counter()
+        encoder.train()
+        decoder.train()
+        train(*batch, encoder, decoder, encoder_optimizer, decoder_optimizer, batch[0].size(1), 50.,
+              teacher_forcing_ratio=teacher, mixed_precision=mixed_precision)
+    return (time.perf_counter() - start) * 1000 / (len(batches) - 1)
+
+
+def greedy_search(encoder, decoder, batches, max_length, mixed_precision):
+    encoder.eval()
+    decoder.eval()
+    searcher = GreedySearchDecoder(encoder, decoder, mixed_precision=mixed_precision)
+    outputs = []
+    with torch.no_grad():
+        searcher(batches[0][0], batches[0][1], max_length)  # warm-up
+        start = time.perf_counter()
+        for inp, lengths, *_ in batches:
+            outputs.append(searcher(inp, lengths, max_length)[0])
+    return (time.perf_counter() - start) * 1000 / len(batches), outputs
+
+
+def token_agreement(outputs, reference):
+    same, total = 0, 0
+    for tokens, ref_tokens in zip(outputs, reference):
+        steps = min(tokens.size(1), ref_tokens.size(1))
+        same += int((tokens[:, :steps] == ref_tokens[:, :steps]).sum())
+        total += ref_tokens.numel()
+    return same / total
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='bfloat16 autocast vs. fp32: speed and validation loss')
+    parser.add_argument('--data', type=str, default="", help='tab separated parallel corpus. Default: copy task')
+    parser.add_argument('--pairs', type=int, default=20000, help='number of synthetic sentence pairs')
+    parser.add_argument('--vocab', type=int, default=5000, help='vocabulary size of the synthetic pairs')
+    parser.add_argument('--max_len', type=int, default=10, help='max sentence length')
+    parser.add_argument('--emb', type=int, default=256, help='embedding size')
+    parser.add_argument('--hid', type=int, default=256, help='hidden size')
+    parser.add_argument('--batch_size', type=int, default=64, help='batch size')
+    parser.add_argument('--steps', type=int, default=1000, help='training steps')
+    parser.add_argument('--teacher', type=float, default=1., help='teacher forcing ratio')
+    parser.add_argument('--val_batches', type=int, default=20, help='validation and search batches')
+    parser.add_argument('--tolerance', type=float, default=0.02,
+                        help='allowed relative increase of the bfloat16 validation loss over fp32')
+    args = parser.parse_args()
+
+    if args.data:
+        pairs, src_size, trg_size = corpus_pairs(args.data, args.max_len)
+    else:
+        pairs, src_size, trg_size = copy_task_pairs(args.pairs, args.vocab, args.max_len)
+    random.Random(1).shuffle(pairs)
+    n_val = len(pairs) // 10
+    train_batches = make_batches(pairs[n_val:], args.steps, args.batch_size, seed=1)
+    val_batches = make_batches(pairs[:n_val], args.val_batches, min(args.batch_size, n_val), seed=2)
+
+    torch.manual_seed(1)
+    encoder = EncoderLSTM(src_size, args.emb, args.hid)
+    decoder = DecoderLSTM(trg_size, args.emb, args.hid)
+    print("CPU capability: %s, threads: %d, pairs: %d" % (torch.backends.cpu.get_cpu_capability(),
+                                                          torch.get_num_threads(), len(pairs)))
+    results = {}
+    for name, mixed_precision in (("fp32", False), ("bf16", True)):
+        enc, dec = copy.deepcopy(encoder), copy.deepcopy(decoder)
+        step_time = train_steps(enc, dec, train_batches, args.teacher, mixed_precision)
+        enc.eval()
+        dec.eval()
+        results[name] = step_time, eval_batch(val_batches, enc, dec), (enc, dec)
+
+    fp32_step, fp32_loss, fp32_model = results["fp32"]
+    bf16_step, bf16_loss, _ = results["bf16"]
+    # Both searches use the fp32-trained weights
+    fp32_search, fp32_outputs = greedy_search(*fp32_model, val_batches, args.max_len + 1, False)
+    bf16_search, bf16_outputs = greedy_search(*fp32_model, val_batches, args.max_len + 1, True)
+
+    print("{:<6} {:>14} {:>14} {:>10}".format("", "train ms/step", "greedy ms", "val loss"))
+    print("{:<6} {:>14.1f} {:>14.2f} {:>10.4f}".format("fp32", fp32_step, fp32_search, fp32_loss))
+    print("{:<6} {:>14.1f} {:>14.2f} {:>10.4f}".format("bf16", bf16_step, bf16_search, bf16_loss))
+    print("Speedup: training %.2fx, greedy search %.2fx" % (fp32_step / bf16_step, fp32_search / bf16_search))
+    print("Greedy tokens identical to fp32: %.1f%%" % (100 * token_agreement(bf16_outputs, fp32_outputs)))
+    relative = (bf16_loss - fp32_loss) / fp32_loss
+    passed = relative <= args.tolerance
+    print("Validation loss bf16 vs. fp32: %+.2f%% (tolerance %.2f%%): %s"
+          % (100 * relative, 100 * args.tolerance, "OK" if passed else "FAILED"))
+    if not passed:
+        sys.exit(1)
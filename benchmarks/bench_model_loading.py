@@ -0,0 +1,129 @@
+"""
+Cold start of the translator: loading the full training checkpoint (as translate.py did before, including optimizer
+states and embedding copies) against the slim, memory-mapped inference artifact.
+A checkpoint of the given size is created in a temporary directory, every load runs in a fresh process.
+
+Usage: python -m benchmarks.bench_model_loading --src_vocab 15000 --trg_vocab 30000 --emb 512 --hid 512 --nlayers 2
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+import torch
+from torch import optim
+
+from model.checkpoint import export_inference_model
+from model.model import EncoderLSTM, DecoderLSTM
+from utils.tokenize import Voc, voc_to_state
+
+# Imports are done before timing, they are the same for every loader
+SETUP = """
+import time
+import torch
+from torch import nn, optim
+from model.checkpoint import load_checkpoint, load_inference_model
+from model.model import EncoderLSTM, DecoderLSTM
+"""
+
+LOADERS = {
+    # Previous translate.py behaviour
+    "full checkpoint + optimizers": """
+checkpoint = torch.load(FILE)
+src_emb = checkpoint['src_embedding']
+trg_emb = checkpoint['trg_embedding']
+emb_dim = src_emb['weight'].shape[1]
+nn.Embedding(src_emb['weight'].shape[0], emb_dim, _weight=src_emb['weight'])
+nn.Embedding(trg_emb['weight'].shape[0], emb_dim, _weight=trg_emb['weight'])
+encoder = EncoderLSTM(src_emb['weight'].shape[0], emb_dim, checkpoint['hidden_size'], checkpoint['n_layers'])
+decoder = DecoderLSTM(trg_emb['weight'].shape[0], emb_dim, checkpoint['hidden_size'], checkpoint['n_layers'])
+encoder.load_state_dict(checkpoint['en'])
+decoder.load_state_dict(checkpoint['de'])
+encoder_optimizer = optim.Adam(encoder.parameters())
+decoder_optimizer = optim.Adam(decoder.parameters())
+encoder_optimizer.load_state_dict(checkpoint['en_opt'])
+decoder_optimizer.load_state_dict(checkpoint['de_opt'])
+""",
+    "full checkpoint": """
+load_checkpoint(FILE)
+""",
+    "inference artifact (mmap)": """
+load_inference_model(FILE)
+""",
+}
+
+TIMER = SETUP + """
+start = time.perf_counter()
+{}
+print(time.perf_counter() - start)
+"""
+
+
+def make_checkpoint(path, src_vocab, trg_vocab, emb, hid, n_layers):
+    encoder = EncoderLSTM(src_vocab, emb, hid, n_layers)
+    decoder = DecoderLSTM(trg_vocab, emb, hid, n_layers)
+    encoder_optimizer = optim.Adam(encoder.parameters())
+    decoder_optimizer = optim.Adam(decoder.parameters())
+    # One optimizer step, so that the Adam states are populated as in a real checkpoint
+    for model in (encoder, decoder):
+        for p in model.parameters():
+            p.grad = torch.zeros_like(p)
+    encoder_optimizer.step()
+    decoder_optimizer.step()
+
+    src_voc, trg_voc = Voc("eng"), Voc("deu")
+    for voc, size in ((src_voc, src_vocab), (trg_voc, trg_vocab)):
+        for i in range(size - voc.num_words):
+            voc.addWord("word%d" % i)
+    torch.save({
+        'iteration': 1,
+        'en': encoder.state_dict(),
+        'de': decoder.state_dict(),
+        'en_opt': encoder_optimizer.state_dict(),
+        'de_opt': decoder_optimizer.state_dict(),
+        'loss': 0,
+        'src_dict': voc_to_state(src_voc),
+        'tar_dict': voc_to_state(trg_voc),
+        'src_embedding': encoder.embedding.state_dict(),
+        'trg_embedding': decoder.embedding.state_dict(),
+        'n_layers': n_layers,
+        'hidden_size': hid
+    }, path)
+
+
+def cold_load(code, path, root):
+    """
+    Runs a loader in a new process
+    :return: loading time and total process time (including interpreter start and imports)
+    """
+    import time
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-c", TIMER.format(code.replace("FILE", repr(path)))], cwd=root,
+                            check=True, stdout=subprocess.PIPE, universal_newlines=True)
+    return float(result.stdout.strip().splitlines()[-1]), time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Checkpoint vs. inference artifact loading')
+    parser.add_argument('--src_vocab', type=int, default=15000, help='source vocabulary size')
+    parser.add_argument('--trg_vocab', type=int, default=30000, help='target vocabulary size')
+    parser.add_argument('--emb', type=int, default=512, help='embedding size')
+    parser.add_argument('--hid', type=int, default=512, help='hidden size')
+    parser.add_argument('--nlayers', type=int, default=2, help='number of layers')
+    parser.add_argument('--repeats', type=int, default=3, help='runs per loader')
+    args = parser.parse_args()
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with tempfile.TemporaryDirectory() as tmp:
+        checkpoint_file = os.path.join(tmp, "checkpoint.tar")
+        artifact_file = os.path.join(tmp, "inference.pt")
+        make_checkpoint(checkpoint_file, args.src_vocab, args.trg_vocab, args.emb, args.hid, args.nlayers)
+        export_inference_model(checkpoint_file, artifact_file)
+        print("checkpoint.tar: {:.1f} MB, inference.pt: {:.1f} MB".format(os.path.getsize(checkpoint_file) / 2 ** 20,
+                                                                        os.path.getsize(artifact_file) / 2 ** 20))
+        print("{:<30} {:>10} {:>16}".format("loader", "load s", "process s"))
+        for name, code in LOADERS.items():
+            path = artifact_file if "artifact" in name else checkpoint_file
+            runs = [cold_load(code, path, root) for _ in range(args.repeats)]
+            print("{:<30} {:>10.3f} {:>16.3f}".format(name, min(r[0] for r in runs), min(r[1] for r in runs)))
@@ -0,0 +1,78 @@
+"""
+Regression benchmark of the contraction/umlaut expansion: the former regex alternation, compiled for every sentence,
+against the trie normalizer (utils/normalizer.py). Outputs are compared on the corpus and on random sentences built
+from the keys of the mappings (mixed case, keys next to each other and inside words).
+
+Usage: python -m benchmarks.bench_normalizer --data data/deu.txt
+"""
+import argparse
+import os
+import random
+import re
+import time
+
+from global_settings import DATA_DIR
+from utils.mappings import ENG_CONTRACTIONS_MAP, UMLAUT_MAP
+from utils.normalizer import MapNormalizer
+from utils.prepro import read_lines
+
+
+def regex_expand_contraction(sentence, mapping):
+    # Former implementation of utils.prepro.expand_contraction
+    contractions_patterns = re.compile('({})'.format('|'.join(mapping.keys())), flags=re.IGNORECASE | re.DOTALL)
+
+    def replace_text(t):
+        txt = t.group(0)
+        if txt.lower() in mapping.keys():
+            return mapping[txt.lower()]
+
+    return contractions_patterns.sub(replace_text, sentence)
+
+
+def random_sentences(mapping, n, seed=1):
+    rng = random.Random(seed)
+    keys = list(mapping)
+    filler = ["the", "a", "we", "i", "can", "t", "ve", "'", "x", "ab", "über", "strasse", "", " "]
+    sentences = []
+    for _ in range(n):
+        tokens = [rng.choice(keys) if rng.random() < 0.4 else rng.choice(filler) for _ in range(rng.randint(1, 12))]
+        sentence = rng.choice([" ", "", "-"]).join(tokens)
+        if rng.random() < 0.3:
+            sentence = "".join(c.upper() if rng.random() < 0.5 else c for c in sentence)
+        sentences.append(sentence)
+    return sentences
+
+
+def per_sentence(function, sentences, mapping, repeats=3):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for sentence in sentences:
+            function(sentence, mapping)
+        best = min(best, time.perf_counter() - start)
+    return best / len(sentences)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Regex vs. trie contraction expansion')
+    parser.add_argument('--data', type=str, default=os.path.join(DATA_DIR, "simple_dataset_praesi.txt"),
+                        help='tab separated parallel corpus')
+    parser.add_argument('--random', type=int, default=20000, help='number of random sentences per mapping')
+    args = parser.parse_args()
+
+    pairs = read_lines(*os.path.split(args.data))
+    normalizers = {}
+    trie_expand = lambda sentence, mapping: normalizers[id(mapping)](sentence)
+
+    print("{:<30} {:>10} {:>12} {:>10} {:>9} {:>10}".format("mapping / sentences", "sentences", "regex us", "trie us",
+                                                           "speedup", "identical"))
+    for name, mapping, side in (("ENG_CONTRACTIONS_MAP", ENG_CONTRACTIONS_MAP, 0), ("UMLAUT_MAP", UMLAUT_MAP, 1)):
+        normalizers[id(mapping)] = MapNormalizer(mapping)
+        for kind, sentences in (("corpus", [pair[side] for pair in pairs]),
+                                ("random", random_sentences(mapping, args.random))):
+            identical = all(regex_expand_contraction(s, mapping) == trie_expand(s, mapping) for s in sentences)
+            regex_time = per_sentence(regex_expand_contraction, sentences, mapping)
+            trie_time = per_sentence(trie_expand, sentences, mapping)
+            print("{:<30} {:>10} {:>12.2f} {:>10.2f} {:>8.2f}x {:>10}".format(
+                "%s / %s" % (name, kind), len(sentences), regex_time * 1e6, trie_time * 1e6, regex_time / trie_time,
+                str(identical)))
@@ -0,0 +1,44 @@
+"""
+Scaling of the preprocessing (utils/prepro.py clean_pairs) with the number of worker processes, against the serial
+loop calling preprocess_sentence with the mappings for every sentence. All outputs are compared with the serial output.
+
+Usage: python -m benchmarks.bench_prepro --workers 1 2 4 8
+       python -m benchmarks.bench_prepro --data data/deu.txt
+"""
+import argparse
+import os
+import time
+
+from global_settings import DATA_DIR
+from utils.mappings import ENG_CONTRACTIONS_MAP, UMLAUT_MAP
+from utils.prepro import read_lines, preprocess_sentence, clean_pairs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serial vs. multi-process preprocessing')
+    parser.add_argument('--data', type=str, default=os.path.join(DATA_DIR, "simple_dataset_praesi.txt"),
+                        help='tab separated parallel corpus')
+    parser.add_argument('--pairs', type=int, default=100000, help='number of pairs (the corpus is repeated if needed)')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8], help='numbers of worker processes')
+    parser.add_argument('--chunk_size', type=int, default=5000, help='pairs per chunk')
+    args = parser.parse_args()
+
+    lines = [line[:2] for line in read_lines(*os.path.split(args.data))]
+    pairs = (lines * (args.pairs // len(lines) + 1))[:args.pairs]
+    print("Pairs: %d, CPU cores: %d" % (len(pairs), os.cpu_count()))
+
+    start = time.perf_counter()
+    reference = [[preprocess_sentence(src, ENG_CONTRACTIONS_MAP), preprocess_sentence(trg, UMLAUT_MAP)]
+                 for src, trg in pairs]
+    reference_time = time.perf_counter() - start
+    print("{:<28} {:>9} {:>9} {:>10}".format("", "seconds", "speedup", "identical"))
+    print("{:<28} {:>9.2f} {:>8.2f}x {:>10}".format("serial, mapping per call", reference_time, 1., "True"))
+
+    for num_workers in args.workers:
+        start = time.perf_counter()
+        cleaned = clean_pairs(pairs, ENG_CONTRACTIONS_MAP, UMLAUT_MAP, num_workers=num_workers,
+                              chunk_size=args.chunk_size)
+        duration = time.perf_counter() - start
+        name = "%d worker%s" % (num_workers, "s" if num_workers > 1 else " (serial)")
+        print("{:<28} {:>9.2f} {:>8.2f}x {:>10}".format(name, duration, reference_time / duration,
+                                                      str(cleaned == reference)))
@@ -0,0 +1,93 @@
+"""
+fp32 against dynamic int8 inference (model/quantize.py) on the test split of an experiment:
+serialized model size, greedy decoding latency and agreement of the int8 translations with the fp32 ones.
+The test split is rebuilt like in run_experiment.py, so --max_len, --limit and --seed must match the experiment.
+
+Usage: python -m benchmarks.bench_quantize --path path_to_experiment --max_len 10 --seed 1111
+"""
+import argparse
+import io
+import os
+import time
+
+import torch
+
+from experiment.train_eval import GreedySearchDecoder, evaluate_batch
+from global_settings import DATA_DIR, FILENAME
+from model.checkpoint import load_checkpoint
+from model.quantize import quantize_models
+from translate import find_checkpoint
+from utils.prepro import load_cleaned_data, load_or_preprocess
+from utils.utils import split_data
+
+
+def serialized_size(*models):
+    buffer = io.BytesIO()
+    torch.save([model.state_dict() for model in models], buffer)
+    return buffer.tell()
+
+
+def translate_all(searcher, src_voc, trg_voc, sentences, batch_size):
+    start = time.perf_counter()
+    translations = []
+    for i in range(0, len(sentences), batch_size):
+        translations.extend(evaluate_batch(searcher, src_voc, trg_voc, sentences[i:i + batch_size]))
+    return translations, time.perf_counter() - start
+
+
+def agreement(reference, candidate):
+    """
+    :return: ratio of identical translations, ratio of identical tokens (position by position)
+    """
+    identical = sum(ref == cand for ref, cand in zip(reference, candidate))
+    same_tokens = sum(sum(r == c for r, c in zip(ref, cand)) for ref, cand in zip(reference, candidate))
+    all_tokens = sum(max(len(ref), len(cand)) for ref, cand in zip(reference, candidate))
+    return identical / len(reference), same_tokens / max(all_tokens, 1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='fp32 vs. dynamic int8 inference')
+    parser.add_argument('--path', type=str, default="", help='experiment path. Default: last experiment')
+    parser.add_argument('--max_len', type=int, default=0, help='max_len of the experiment (selects the cached preprocessing)')
+    parser.add_argument('--data', type=str, default="", help='preprocessed pairs (.pkl). Overrides --max_len')
+    parser.add_argument('--limit', type=int, help='limit of the experiment')
+    parser.add_argument('--seed', type=int, default=1111, help='seed of the experiment')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 64], help='sentences per searcher call')
+    parser.add_argument('--max_sentences', type=int, default=1000, help='number of test sentences for batch size 1')
+    args = parser.parse_args()
+
+    if args.data:
+        pairs = load_cleaned_data(*os.path.split(args.data))
+    else:
+        pairs, _ = load_or_preprocess(os.path.join(DATA_DIR, FILENAME), True, max_len=args.max_len)
+    if args.limit:
+        pairs = pairs[:args.limit]
+    _, _, test_set = split_data(pairs, seed=args.seed)
+    sentences = [pair[0] for pair in test_set]
+    print("Test sentences:", len(sentences))
+
+    experiment_dir, checkpoint_file = find_checkpoint(".", args.path if args.path != "" else None)
+    encoder, decoder, src_voc, trg_voc = load_checkpoint(checkpoint_file)
+    encoder.eval()
+    decoder.eval()
+    q_encoder, q_decoder = quantize_models(encoder, decoder)
+    fp32 = GreedySearchDecoder(encoder, decoder)
+    int8 = GreedySearchDecoder(q_encoder, q_decoder)
+
+    fp32_size, int8_size = serialized_size(encoder, decoder), serialized_size(q_encoder, q_decoder)
+    print("Model size: fp32 %.2f MB, int8 %.2f MB (%.2fx smaller)"
+          % (fp32_size / 2 ** 20, int8_size / 2 ** 20, fp32_size / int8_size))
+
+    print("{:>6} {:>10} {:>12} {:>12} {:>9} {:>11} {:>12}".format(
+        "batch", "sentences", "fp32 ms/sent", "int8 ms/sent", "speedup", "identical", "same tokens"))
+    for batch_size in args.batch_sizes:
+        subset = sentences[:args.max_sentences] if batch_size == 1 else sentences
+        # Warm up
+        translate_all(fp32, src_voc, trg_voc, subset[:batch_size], batch_size)
+        translate_all(int8, src_voc, trg_voc, subset[:batch_size], batch_size)
+        reference, fp32_time = translate_all(fp32, src_voc, trg_voc, subset, batch_size)
+        candidate, int8_time = translate_all(int8, src_voc, trg_voc, subset, batch_size)
+        identical, same_tokens = agreement(reference, candidate)
+        print("{:>6} {:>10} {:>12.3f} {:>12.3f} {:>8.2f}x {:>10.1f}% {:>11.1f}%".format(
+            batch_size, len(subset), fp32_time * 1000 / len(subset), int8_time * 1000 / len(subset),
+            fp32_time / int8_time, identical * 100, same_tokens * 100))
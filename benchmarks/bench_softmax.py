@@ -0,0 +1,90 @@
+"""
+Training step (experiment/train_eval.py train) with the full softmax against the sampled softmax
+(model/sampled_softmax.py) for several target vocabulary sizes: time per step and peak memory.
+Target words follow a Zipf distribution. Every measurement runs in a fresh process (peak RSS).
+
+Usage: python -m benchmarks.bench_softmax --vocab 10000 50000 --samples 0 1024 4096
+"""
+import argparse
+import resource
+import subprocess
+import sys
+import time
+
+import torch
+from torch import optim
+
+from experiment.train_eval import train
+from model.model import EncoderLSTM, DecoderLSTM
+from model.sampled_softmax import SampledSoftmax
+from utils.tokenize import EOS_token, padEncoded
+
+
+def zipf_batch(vocab_size, batch_size, length, generator):
+    weights = 1. / torch.arange(1, vocab_size - 3, dtype=torch.double)
+    sequences = [torch.multinomial(weights, length, replacement=True, generator=generator).numpy() + 4
+                 for _ in range(batch_size)]
+    for seq in sequences:
+        seq[-1] = EOS_token
+    return padEncoded(sequences)[0]
+
+
+def run(vocab_size, n_samples, args):
+    torch.manual_seed(1)
+    torch.set_num_threads(1)
+    generator = torch.Generator().manual_seed(1)
+    encoder = EncoderLSTM(vocab_size, args.emb, args.hid)
+    decoder = DecoderLSTM(vocab_size, args.emb, args.hid)
+    encoder_optimizer = optim.Adam(encoder.parameters())
+    decoder_optimizer = optim.Adam(decoder.parameters())
+    counts = (1. / torch.arange(1, vocab_size + 1, dtype=torch.double) * 1e6).long().tolist()
+    sampler = SampledSoftmax(counts, n_samples) if n_samples else None
+    batches = []
+    for _ in range(args.steps + 2):
+        inp = zipf_batch(vocab_size, args.batch_size, args.length, generator)
+        trg = zipf_batch(vocab_size, args.batch_size, args.length, generator)
+        batches.append((inp, torch.full((args.batch_size,), args.length), trg, trg != 0, args.length))
+    # Time of the optimizer steps, which update the full embeddings and output layer in both modes
+    step_times = []
+    for optimizer in (encoder_optimizer, decoder_optimizer):
+        def timed_step(step=optimizer.step):
+            start = time.perf_counter()
+            step()
+            step_times.append(time.perf_counter() - start)
+        optimizer.step = timed_step
+    times = []
+    for inp, lengths, trg, mask, max_len in batches:
+        start = time.perf_counter()
+        train(inp, lengths, trg, mask, max_len, None, encoder, decoder, encoder_optimizer, decoder_optimizer,
+              args.batch_size, None, teacher_forcing_ratio=1, sampled_softmax=sampler)
+        times.append(time.perf_counter() - start)
+    # The first steps allocate the optimizer states
+    return (sum(times[2:]) * 1000 / args.steps, sum(step_times[4:]) * 1000 / args.steps,
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Full vs. sampled softmax training step')
+    parser.add_argument('--vocab', type=int, nargs='+', default=[10000, 50000], help='target vocabulary sizes')
+    parser.add_argument('--samples', type=int, nargs='+', default=[0, 1024, 4096],
+                        help='sampled words per batch, 0 for the full softmax')
+    parser.add_argument('--emb', type=int, default=256, help='embedding size')
+    parser.add_argument('--hid', type=int, default=256, help='hidden size')
+    parser.add_argument('--batch_size', type=int, default=64, help='batch size')
+    parser.add_argument('--length', type=int, default=10, help='sentence length (EOS included)')
+    parser.add_argument('--steps', type=int, default=10, help='timed training steps')
+    parser.add_argument('--run', type=int, nargs=2, help=argparse.SUPPRESS)  # vocabulary size, samples
+    args = parser.parse_args()
+
+    if args.run:
+        print(*run(*args.run, args))
+        sys.exit()
+
+    print("{:>8} {:<18} {:>10} {:>14} {:>10}".format("vocab", "output layer", "ms/step", "optimizer ms", "peak MB"))
+    for vocab_size in args.vocab:
+        for n_samples in args.samples:
+            output = subprocess.run([sys.executable, "-m", "benchmarks.bench_softmax", "--run", str(vocab_size),
+                                     str(n_samples)] + sys.argv[1:], check=True, capture_output=True, text=True)
+            step_time, optimizer_time, peak = [float(value) for value in output.stdout.split("\n")[-2].split()]
+            name = "sampled (%d)" % n_samples if n_samples else "full softmax"
+            print("{:>8} {:<18} {:>10.1f} {:>14.1f} {:>10.1f}".format(vocab_size, name, step_time, optimizer_time, peak))
@@ -0,0 +1,75 @@
+"""
+Peak memory of the ingestion of a parallel corpus into the encoded corpus format, for growing corpus sizes:
+in-memory path of run_experiment.py (read_lines, preprocess_pipeline, split_data, build_vocab, save_encoded_corpus)
+against the single streaming pass (iter_lines, iter_preprocessed, stream_encoded_corpus).
+The corpus is the given file repeated with numbered words, so that the vocabulary grows as well.
+Every measurement runs in a fresh process (peak RSS).
+
+Usage: python -m benchmarks.bench_stream --lines 100000 400000 1600000
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from global_settings import DATA_DIR
+from utils.corpus import save_encoded_corpus, stream_encoded_corpus
+from utils.prepro import read_lines, preprocess_pipeline, iter_lines, iter_preprocessed
+from utils.tokenize import build_vocab
+from utils.utils import split_data
+
+
+def write_corpus(source, target, n_lines, vocab):
+    lines = [line.rstrip("\n") for line in open(source, encoding="utf-8") if "\t" in line]
+    with open(target, "w", encoding="utf-8") as f:
+        for i in range(n_lines):
+            src, trg = lines[i % len(lines)].split("\t")[:2]
+            f.write("%s w%d\t%s w%d\n" % (src, i % vocab, trg, i % vocab))
+
+
+def ingest(mode, corpus_file, output_dir):
+    root, filename = os.path.split(corpus_file)
+    if mode == "stream":
+        stream_encoded_corpus(output_dir, iter_preprocessed(iter_lines(root, filename), True, max_len=0),
+                              "eng", "deu", seed=1)
+    else:
+        pairs, _ = preprocess_pipeline(read_lines(root, filename), None, True, max_len=0)
+        train_set, val_set, test_set = split_data(pairs, seed=1)
+        src_voc = build_vocab([pair[0] for pair in train_set], "eng")
+        tar_voc = build_vocab([pair[1] for pair in train_set], "deu")
+        save_encoded_corpus(output_dir, src_voc, tar_voc, {"train": train_set, "val": val_set, "test": test_set})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='In-memory vs. streaming ingestion')
+    parser.add_argument('--data', type=str, default=os.path.join(DATA_DIR, "simple_dataset_praesi.txt"),
+                        help='tab separated parallel corpus, repeated to the requested size')
+    parser.add_argument('--lines', type=int, nargs='+', default=[100000, 400000, 1600000], help='corpus sizes')
+    parser.add_argument('--vocab', type=int, default=50000, help='number of distinct numbered words')
+    parser.add_argument('--run', type=str, nargs=3, help=argparse.SUPPRESS)  # mode, corpus file, output dir
+    args = parser.parse_args()
+
+    if args.run:
+        start = time.perf_counter()
+        ingest(*args.run)
+        # ru_maxrss is in kilobytes on Linux
+        print(time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+        sys.exit()
+
+    print("{:>10} {:>10} {:>14} {:>14} {:>12} {:>12}".format("lines", "file MB", "in-memory MB", "streaming MB",
+                                                             "in-memory s", "streaming s"))
+    with tempfile.TemporaryDirectory() as directory:
+        for n_lines in args.lines:
+            corpus_file = os.path.join(directory, "corpus.txt")
+            write_corpus(args.data, corpus_file, n_lines, args.vocab)
+            results = {}
+            for mode in ("memory", "stream"):
+                output = subprocess.run([sys.executable, "-m", "benchmarks.bench_stream", "--run", mode, corpus_file,
+                                         os.path.join(directory, mode)], check=True, capture_output=True, text=True)
+                results[mode] = [float(value) for value in output.stdout.split("\n")[-2].split()]
+            print("{:>10} {:>10.1f} {:>14.1f} {:>14.1f} {:>12.2f} {:>12.2f}".format(
+                n_lines, os.path.getsize(corpus_file) / 2 ** 20, results["memory"][1], results["stream"][1],
+                results["memory"][0], results["stream"][0]))
@@ -0,0 +1,83 @@
+"""
+Truncated backpropagation through time of the decoder (experiment/train_eval.py train, run_experiment.py --tbptt_k):
+time per training step and peak memory for several truncation lengths K on long target sequences.
+K = 0 is the full backpropagation through the whole target sequence. Every measurement runs in a fresh process
+(peak RSS), the memory used by training is the peak minus the memory reached before the first step.
+
+Usage: python -m benchmarks.bench_tbptt --length 200 --ks 0 100 50 20 10 --teacher 1
+"""
+import argparse
+import random
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+import torch
+from torch import optim
+
+from experiment.train_eval import train
+from model.model import EncoderLSTM, DecoderLSTM
+from utils.tokenize import EOS_token, padEncoded
+
+
+def random_batch(batch_size, length, vocab_size, rng):
+    sequences = [np.append(rng.integers(4, vocab_size, length - 1), EOS_token) for _ in range(batch_size)]
+    return padEncoded(sequences)[0]
+
+
+def run(K, args):
+    torch.manual_seed(1)
+    torch.set_num_threads(1)
+    random.seed(1)
+    rng = np.random.default_rng(1)
+    encoder = EncoderLSTM(args.vocab, args.emb, args.hid)
+    decoder = DecoderLSTM(args.vocab, args.emb, args.hid)
+    encoder_optimizer = optim.Adam(encoder.parameters())
+    decoder_optimizer = optim.Adam(decoder.parameters())
+    batches = []
+    for _ in range(args.steps + 1):
+        inp = random_batch(args.batch_size, args.length, args.vocab, rng)
+        trg = random_batch(args.batch_size, args.length, args.vocab, rng)
+        batches.append((inp, torch.full((args.batch_size,), args.length), trg, trg != 0, args.length, None))
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    losses = []
+    start = time.perf_counter()
+    for i, batch in enumerate(batches):
+        if i == 1:
+            # The first step is not timed (allocation of the optimizer states)
+            start = time.perf_counter()
+        losses.append(train(*batch, encoder, decoder, encoder_optimizer, decoder_optimizer, args.batch_size, None,
+                            teacher_forcing_ratio=args.teacher, K=K, tbptt=K > 0))
+    step_time = (time.perf_counter() - start) * 1000 / args.steps
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return step_time, peak, peak - before, losses[-1]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Truncated backpropagation through time: memory and speed vs. K')
+    parser.add_argument('--ks', type=int, nargs='+', default=[0, 100, 50, 20, 10],
+                        help='truncation lengths in decoder steps, 0 for the full backpropagation')
+    parser.add_argument('--length', type=int, default=200, help='sentence length (EOS included)')
+    parser.add_argument('--teacher', type=float, default=1., help='teacher forcing ratio')
+    parser.add_argument('--vocab', type=int, default=5000, help='vocabulary size')
+    parser.add_argument('--emb', type=int, default=256, help='embedding size')
+    parser.add_argument('--hid', type=int, default=256, help='hidden size')
+    parser.add_argument('--batch_size', type=int, default=64, help='batch size')
+    parser.add_argument('--steps', type=int, default=5, help='timed training steps')
+    parser.add_argument('--run', type=int, help=argparse.SUPPRESS)  # truncation length
+    args = parser.parse_args()
+
+    if args.run is not None:
+        print(*run(args.run, args))
+        sys.exit()
+
+    print("Target length: %d, teacher forcing ratio: %.2f" % (args.length, args.teacher))
+    print("{:<10} {:>10} {:>10} {:>12} {:>12}".format("K", "ms/step", "peak MB", "training MB", "last loss"))
+    for K in args.ks:
+        output = subprocess.run([sys.executable, "-m", "benchmarks.bench_tbptt", "--run", str(K)] + sys.argv[1:],
+                                check=True, capture_output=True, text=True)
+        step_time, peak, training, loss = [float(value) for value in output.stdout.split("\n")[-2].split()]
+        print("{:<10} {:>10.1f} {:>10.1f} {:>12.1f} {:>12.4f}".format(K if K > 0 else "full", step_time, peak,
+                                                                       training, loss))
@@ -0,0 +1,69 @@
+"""
+Training step time (experiment/train_eval.py train) with the whole-sequence teacher-forced decoder pass
+(DecoderLSTM.forward_sequence) against the step by step teacher-forced loop, at a given teacher forcing ratio.
+Both variants see the same batches and the same teacher forcing decisions; the losses are compared.
+
+Usage: python -m benchmarks.bench_teacher --teacher 0.9 --lengths 10 30
+"""
+import argparse
+import copy
+import random
+import time
+
+import numpy as np
+import torch
+from torch import optim
+
+from experiment.train_eval import train
+from model.model import EncoderLSTM, DecoderLSTM
+from utils.tokenize import EOS_token, encodedBatch2TrainData
+
+
+def random_batches(n_batches, batch_size, max_len, vocab_size, seed=1):
+    rng = np.random.default_rng(seed)
+    sentence = lambda: np.append(rng.integers(4, vocab_size, rng.integers(1, max_len + 1)), EOS_token).astype(np.int32)
+    return [encodedBatch2TrainData([(sentence(), sentence()) for _ in range(batch_size)]) for _ in range(n_batches)]
+
+
+def time_steps(encoder, decoder, batches, teacher, sequence_teacher_forcing):
+    encoder_optimizer = optim.Adam(encoder.parameters())
+    decoder_optimizer = optim.Adam(decoder.parameters())
+    random.seed(1)
+    losses = []
+    start = time.perf_counter()
+    for i, (inp, lengths, trg, mask, max_len, trg_lengths) in enumerate(batches):
+        if i == 1:
+            # The first batch is not timed (warm-up, allocation of the optimizer states)
+            start = time.perf_counter()
+        losses.append(train(inp, lengths, trg, mask, max_len, trg_lengths, encoder, decoder, encoder_optimizer,
+                            decoder_optimizer, inp.size(1), None, teacher_forcing_ratio=teacher,
+                            sequence_teacher_forcing=sequence_teacher_forcing))
+    return (time.perf_counter() - start) * 1000 / (len(batches) - 1), losses
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Whole-sequence vs. step by step teacher forcing')
+    parser.add_argument('--teacher', type=float, default=0.9, help='teacher forcing ratio')
+    parser.add_argument('--lengths', type=int, nargs='+', default=[10, 30], help='max sentence lengths')
+    parser.add_argument('--vocab', type=int, default=10000, help='vocabulary size')
+    parser.add_argument('--emb', type=int, default=256, help='embedding size')
+    parser.add_argument('--hid', type=int, default=256, help='hidden size')
+    parser.add_argument('--batch_size', type=int, default=64, help='batch size')
+    parser.add_argument('--steps', type=int, default=30, help='timed training steps')
+    args = parser.parse_args()
+
+    torch.manual_seed(1)
+    encoder = EncoderLSTM(args.vocab, args.emb, args.hid)
+    decoder = DecoderLSTM(args.vocab, args.emb, args.hid)
+    print("Teacher forcing ratio: %.2f" % args.teacher)
+    print("{:>8} {:>14} {:>14} {:>9} {:>16}".format("max_len", "stepwise ms", "sequence ms", "speedup",
+                                                    "max loss diff"))
+    for max_len in args.lengths:
+        batches = random_batches(args.steps, args.batch_size, max_len, args.vocab)
+        stepwise_time, stepwise_losses = time_steps(copy.deepcopy(encoder), copy.deepcopy(decoder), batches,
+                                                    args.teacher, False)
+        sequence_time, sequence_losses = time_steps(copy.deepcopy(encoder), copy.deepcopy(decoder), batches,
+                                                    args.teacher, True)
+        print("{:>8} {:>14.1f} {:>14.1f} {:>8.2f}x {:>16.2e}".format(
+            max_len, stepwise_time, sequence_time, stepwise_time / sequence_time,
+            max(abs(a - b) for a, b in zip(stepwise_losses, sequence_losses))))
@@ -0,0 +1,65 @@
+"""
+Microbenchmark of batch tensorization: batch2TrainData (word lookups and Python padding loops) against
+encodedBatch2TrainData on pairs encoded once with encode_pairs (NumPy padding, mask as tensor != PAD).
+The outputs of both are compared tensor by tensor.
+
+Usage: python -m benchmarks.bench_tensorize --batch_sizes 16 64 256
+"""
+import argparse
+import random
+import time
+
+import torch
+
+from utils.tokenize import Voc, batch2TrainData, encode_pairs, encodedBatch2TrainData
+
+
+def synthetic_pairs(n_pairs, vocab_size, max_len, seed=1):
+    rng = random.Random(seed)
+    sentence = lambda: " ".join("w%d" % rng.randrange(vocab_size) for _ in range(rng.randint(2, max_len)))
+    return [[sentence(), sentence()] for _ in range(n_pairs)]
+
+
+def identical(a, b):
+    return all(x.dtype == y.dtype and torch.equal(x, y) for x, y in zip(a, b))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='batch2TrainData vs. vectorized tensorization')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[16, 64, 256], help='pairs per batch')
+    parser.add_argument('--batches', type=int, default=500, help='timed batches per batch size')
+    parser.add_argument('--pairs', type=int, default=20000, help='number of synthetic sentence pairs')
+    parser.add_argument('--max_len', type=int, default=25, help='max sentence length')
+    parser.add_argument('--vocab', type=int, default=5000, help='vocabulary size')
+    args = parser.parse_args()
+
+    pairs = synthetic_pairs(args.pairs, args.vocab, args.max_len)
+    src_voc, tar_voc = Voc("src"), Voc("trg")
+    for src, trg in pairs:
+        src_voc.addSentence(src)
+        tar_voc.addSentence(trg)
+
+    start = time.perf_counter()
+    encoded = encode_pairs(src_voc, tar_voc, pairs)
+    print("encode_pairs: %.1f ms for %d pairs (once per run)" % ((time.perf_counter() - start) * 1000, len(pairs)))
+
+    print("{:>6} {:>16} {:>16} {:>9} {:>10}".format("batch", "batch2TrainData", "vectorized", "speedup", "identical"))
+    rng = random.Random(1)
+    for batch_size in args.batch_sizes:
+        indexes = [[rng.randrange(len(pairs)) for _ in range(batch_size)] for _ in range(args.batches)]
+        same = all(identical(batch2TrainData(src_voc, tar_voc, [pairs[i] for i in batch]),
+                             encodedBatch2TrainData([encoded[i] for i in batch])) for batch in indexes[:50])
+
+        start = time.perf_counter()
+        for batch in indexes:
+            batch2TrainData(src_voc, tar_voc, [pairs[i] for i in batch])
+        reference = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for batch in indexes:
+            encodedBatch2TrainData([encoded[i] for i in batch])
+        vectorized = time.perf_counter() - start
+
+        print("{:>6} {:>13.3f} ms {:>13.3f} ms {:>8.2f}x {:>10}".format(
+            batch_size, reference * 1000 / args.batches, vectorized * 1000 / args.batches, reference / vectorized,
+            str(same)))
@@ -0,0 +1,58 @@
+"""
+Latency of the eager GreedySearchDecoder against the TorchScript greedy searcher (model/script.py),
+together with a token-for-token comparison of their outputs.
+
+Usage: python -m benchmarks.bench_torchscript --batch_sizes 1 64
+"""
+import argparse
+import time
+
+import torch
+
+from experiment.train_eval import GreedySearchDecoder
+from global_settings import device, MAX_LENGTH
+from model.model import EncoderLSTM, DecoderLSTM
+from model.script import script_greedy_search
+
+
+def latency(searcher, input_seq, lengths, max_length, repeats):
+    with torch.no_grad():
+        # Warm up, the scripted module is optimized during the first calls
+        for _ in range(5):
+            searcher(input_seq, lengths, max_length)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            searcher(input_seq, lengths, max_length)
+    return (time.perf_counter() - start) / repeats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Eager vs. TorchScript greedy search')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 64], help='sentences per searcher call')
+    parser.add_argument('--src_len', type=int, default=6, help='source sentence length')
+    parser.add_argument('--src_vocab', type=int, default=15000, help='source vocabulary size')
+    parser.add_argument('--trg_vocab', type=int, default=30000, help='target vocabulary size')
+    parser.add_argument('--emb', type=int, default=256, help='embedding size')
+    parser.add_argument('--hid', type=int, default=256, help='hidden size')
+    parser.add_argument('--nlayers', type=int, default=1, help='number of layers')
+    parser.add_argument('--repeats', type=int, default=50, help='timed calls')
+    args = parser.parse_args()
+
+    torch.manual_seed(1)
+    encoder = EncoderLSTM(args.src_vocab, args.emb, args.hid, args.nlayers).to(device).eval()
+    decoder = DecoderLSTM(args.trg_vocab, args.emb, args.hid, args.nlayers).to(device).eval()
+    eager = GreedySearchDecoder(encoder, decoder)
+    scripted = script_greedy_search(encoder, decoder)
+
+    print("{:>6} {:>10} {:>12} {:>9} {:>10}".format("batch", "eager ms", "scripted ms", "speedup", "identical"))
+    for batch_size in args.batch_sizes:
+        input_seq = torch.randint(4, args.src_vocab, (args.src_len, batch_size), device=device)
+        lengths = torch.full((batch_size,), args.src_len, dtype=torch.long)
+        with torch.no_grad():
+            eager_tokens, _ = eager(input_seq, lengths, MAX_LENGTH)
+            scripted_tokens, _ = scripted(input_seq, lengths, MAX_LENGTH)
+        identical = torch.equal(eager_tokens, scripted_tokens)
+        eager_time = latency(eager, input_seq, lengths, MAX_LENGTH, args.repeats)
+        scripted_time = latency(scripted, input_seq, lengths, MAX_LENGTH, args.repeats)
+        print("{:>6} {:>10.3f} {:>12.3f} {:>8.2f}x {:>10}".format(batch_size, eager_time * 1000, scripted_time * 1000,
+                                                               eager_time / scripted_time, str(identical)))
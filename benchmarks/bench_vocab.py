@@ -0,0 +1,89 @@
+"""
+Effect of vocabulary trimming (Voc.trim, run_experiment.py --min_count / --max_vocab) on the model:
+vocabulary sizes, share of training tokens mapped to UNK, cost of the decoder output layer (out + log_softmax,
+forward and backward of one decoder step) and size of the serialized encoder, decoder and vocabularies.
+
+Usage: python -m benchmarks.bench_vocab --min_counts 1 2 5 10 --max_sizes 10000
+       python -m benchmarks.bench_vocab --data data/deu.txt
+"""
+import argparse
+import copy
+import io
+import itertools
+import random
+import time
+
+import torch
+import torch.nn.functional as F
+
+from model.model import EncoderLSTM, DecoderLSTM
+from utils.prepro import iter_lines, iter_preprocessed
+from utils.tokenize import Voc, UNK_token, voc_to_state
+
+
+def synthetic_pairs(n_pairs, vocab_size, max_len, seed=1):
+    # Zipf word frequencies (frequency ~ 1 / rank), as in natural language
+    rng = random.Random(seed)
+    words = ["w%d" % rank for rank in range(vocab_size)]
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(vocab_size)))
+    sentence = lambda: " ".join(rng.choices(words, cum_weights=cum_weights, k=rng.randint(2, max_len)))
+    return [[sentence(), sentence()] for _ in range(n_pairs)]
+
+
+def output_layer_time(decoder, batch_size, repeats):
+    hidden = torch.randn(batch_size, decoder.hidden_size)
+    target = torch.randint(0, decoder.output_size, (batch_size,))
+    start = time.perf_counter()
+    for _ in range(repeats):
+        loss = F.nll_loss(F.log_softmax(decoder.out(hidden), dim=1), target)
+        loss.backward()
+    return (time.perf_counter() - start) * 1000 / repeats
+
+
+def checkpoint_size(encoder, decoder, src_voc, trg_voc):
+    buffer = io.BytesIO()
+    torch.save({'en': encoder.state_dict(), 'de': decoder.state_dict(),
+                'src_dict': voc_to_state(src_voc), 'tar_dict': voc_to_state(trg_voc)}, buffer)
+    return buffer.tell()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Vocabulary trimming: softmax cost and checkpoint size')
+    parser.add_argument('--data', type=str, default="", help='tab separated parallel corpus. Default: synthetic corpus')
+    parser.add_argument('--pairs', type=int, default=200000, help='number of synthetic sentence pairs')
+    parser.add_argument('--vocab', type=int, default=50000, help='vocabulary size of the synthetic corpus')
+    parser.add_argument('--min_counts', type=int, nargs='+', default=[1, 2, 5, 10], help='min_count thresholds')
+    parser.add_argument('--max_sizes', type=int, nargs='+', default=[10000], help='max_size thresholds')
+    parser.add_argument('--emb', type=int, default=256, help='embedding size')
+    parser.add_argument('--hid', type=int, default=256, help='hidden size')
+    parser.add_argument('--batch_size', type=int, default=64, help='batch size of the decoder step')
+    parser.add_argument('--repeats', type=int, default=20, help='timed decoder steps')
+    args = parser.parse_args()
+    torch.set_num_threads(1)
+
+    if args.data:
+        pairs = list(iter_preprocessed(iter_lines("", args.data), True, max_len=0))
+    else:
+        pairs = synthetic_pairs(args.pairs, args.vocab, 10)
+    full_src, full_trg = Voc("eng"), Voc("deu")
+    for src, trg in pairs:
+        full_src.addSentence(src)
+        full_trg.addSentence(trg)
+    n_tokens = sum(full_trg.counts)
+
+    settings = [(min_count, None) for min_count in args.min_counts] + [(1, max_size) for max_size in args.max_sizes]
+    print("Pairs: %d, target tokens: %d" % (len(pairs), n_tokens))
+    print("{:<22} {:>9} {:>9} {:>9} {:>14} {:>15}".format("", "src voc", "trg voc", "trg UNK", "out+softmax ms",
+                                                           "checkpoint MB"))
+    for min_count, max_size in settings:
+        src_voc, trg_voc = copy.deepcopy(full_src), copy.deepcopy(full_trg)
+        if min_count > 1 or max_size:
+            src_voc.trim(min_count, max_size)
+            trg_voc.trim(min_count, max_size)
+        encoder = EncoderLSTM(src_voc.num_words, args.emb, args.hid)
+        decoder = DecoderLSTM(trg_voc.num_words, args.emb, args.hid)
+        name = "min_count %d" % min_count if max_size is None else "max_size %d" % max_size
+        print("{:<22} {:>9} {:>9} {:>8.2f}% {:>14.2f} {:>15.1f}".format(
+            name, src_voc.num_words, trg_voc.num_words, 100 * trg_voc.counts[UNK_token] / n_tokens,
+            output_layer_time(decoder, args.batch_size, args.repeats),
+            checkpoint_size(encoder, decoder, src_voc, trg_voc) / 2 ** 20))
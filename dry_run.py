@@ -6,9 +6,9 @@ import torch
 from torch import optim
 
 from experiment.train_eval import evaluateInput, GreedySearchDecoder, trainIters, eval_batch, plot_training_results
-from global_settings import device, FILENAME, SAVE_DIR, PREPRO_DIR, TRAIN_FILE, TEST_FILE, EXPERIMENT_DIR, LOG_FILE
+from global_settings import device, FILENAME, SAVE_DIR, TRAIN_FILE, TEST_FILE, EXPERIMENT_DIR, LOG_FILE
 from model.model import EncoderLSTM, DecoderLSTM
-from utils.prepro import read_lines, preprocess_pipeline, load_cleaned_data, save_clean_data
+from utils.prepro import load_or_preprocess
 from utils.tokenize import build_vocab, batch2TrainData
 
 from global_settings import DATA_DIR
@@ -104,6 +104,7 @@ if __name__ == '__main__':
     parser.add_argument('--log_interval', type=int, default=100, help='report interval')
 
     parser.add_argument('--max_len', type=int, default=10, help='max sentence length in the dataset. Sentences longer than max_len are trimmed. Provide 0 for no trimming!')
+    parser.add_argument('--prepro_workers', type=int, default=1, help='number of processes preprocessing the dataset (only if it has not been preprocessed yet)')
 
     parser.add_argument('--optim', type=str, default='adam', help="Training optimizer. Possible values: 'adamax', 'adam', 'adagrad', 'sgd'")
 
@@ -137,23 +138,11 @@ if __name__ == '__main__':
 
     voc_all = args.voc_all
 
-    ### Setup preprocessing file ####
+    ### Preprocessed pairs from the preprocessing cache, preprocess if not cached ####
 
     max_sent_len = args.max_len
-    if max_sent_len > 0:
-        cleaned_file =  "%s-%s_cleaned" % (src_lang, trg_lang) + "_{}".format(max_sent_len) +".pkl"
-    else:
-        cleaned_file = "%s-%s_cleaned" % (src_lang, trg_lang) + "_full" + ".pkl"
-
-    ### Check if data has already been preprocessed, if not, preprocess it ####
-
-    if os.path.isfile(os.path.join(PREPRO_DIR, cleaned_file)):
-        print("File already preprocessed! Loading file....")
-        pairs = load_cleaned_data(PREPRO_DIR, filename=cleaned_file)
-    else:
-        print("No preprocessed file found. Starting data preprocessing...")
-        pairs = read_lines(os.path.join(start_root, DATA_DIR), FILENAME)
-        pairs, path = preprocess_pipeline(pairs, cleaned_file, exp_contraction, max_len = max_sent_len) #data/prepro/eng-deu_cleaned_full.pkl
+    pairs, _ = load_or_preprocess(os.path.join(start_root, DATA_DIR, FILENAME), exp_contraction,
+                                  max_len=max_sent_len, num_workers=args.prepro_workers)
 
     ### Get sample ###
     print("Sample from data:")
@@ -256,7 +245,8 @@ if __name__ == '__main__':
     val_loss, directory, train_history, val_statistics, _, _ = \
         trainIters(model_name, input_lang, output_lang, train_data, None, encoder, decoder, encoder_optimizer,
                    decoder_optimizer, encoder_n_layers, decoder_n_layers, SAVE_DIR, n_iteration, batch_size,
-                   print_every, save_every, clip, FILENAME, val_iteration, tbptt=tbptt)
+                   print_every, save_every, clip, FILENAME, val_iteration, tbptt=tbptt,
+                   teacher_forcing_ratio=teacher_forcing_ratio)
 
     end_time = datetime.now()
     duration = end_time-start_time
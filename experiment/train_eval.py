@@ -1,14 +1,33 @@
 import os
 import random
+import time
 from torch import nn
+import torch.nn.functional as F
 from global_settings import device, MAX_LENGTH, VAL_TRAIN_DELTA, LR_CONSTRAINT, MAX_VAL_BATCH_SIZE
 import torch
 from utils.prepro import preprocess_sentence
-from utils.tokenize import SOS_token, batch2TrainData, indexesFromSentence, EOS, PAD, EOS_token
-from utils.utils import maskNLLLoss
+from utils.tokenize import SOS_token, batch2TrainData, indexesFromSentence, zeroPadding, EOS, PAD, EOS_token, PAD_token, \
+    encode_pairs, voc_to_state
+from utils.batching import sample_batches, sample_bucket_batches, prefetch_batches, padding_statistics, Shard
+from utils.distributed import all_reduce_gradients, all_reduce_values, barrier, get_rank, get_world_size, \
+    is_main_process
+from utils.utils import maskCrossEntropyLoss, sequenceMaskCrossEntropyLoss
+from model.sampled_softmax import SampledSoftmax
 from global_settings import NUM_BAD_VALID_LOSS, LR_DECAY, MIN_LR
 import numpy as np
 
+### Mixed precision
+def autocast(enabled, device_type=None):
+    """
+    bfloat16 autocast on the device of the model. Matrix products and LSTM layers run in bfloat16, the weights,
+    their gradients and the optimizer states stay in fp32 (master copy). bfloat16 has the exponent range of fp32,
+    no loss scaling is needed. The losses (utils/utils.py) are computed in fp32.
+    :param enabled: False for a context without effect
+    :param device_type: device type of the model, by default the one of the global device
+    :return: autocast context manager
+    """
+    return torch.autocast(device_type=device_type or device.type, dtype=torch.bfloat16, enabled=enabled)
+
 ## Truncated backpropagation
 def detach_states(states):
     #https://github.com/yunjey/pytorch-tutorial/blob/master/tutorials/02-intermediate/language_model/main.py#L59
@@ -36,7 +55,8 @@ def adapt_lr(enc_optim, dec_optim, decay_value):
     return new_enc_lr, new_dec_lr
 
 def train(input_variable, lengths, target_variable, mask, max_target_len, trg_lengths, encoder, decoder,
-          encoder_optimizer, decoder_optimizer, batch_size, clip, teacher_forcing_ratio=0.5, K=5, tbptt=True):
+          encoder_optimizer, decoder_optimizer, batch_size, clip, teacher_forcing_ratio=0.5, K=0, tbptt=True,
+          sampled_softmax=None, sequence_teacher_forcing=True, mixed_precision=False):
     """
     Performs a training step on a batch during training process
     :param input_variable: batched tensor input
@@ -52,6 +72,13 @@ def train(input_variable, lengths, target_variable, mask, max_target_len, trg_le
     :param batch_size: batch size
     :param clip: gradient clipping
     :param teacher_forcing_ratio: frequency to use teacher forcing
+    :param K: truncation length of the backpropagation through time in decoder steps (only with tbptt).
+        0 or None: the decoder states are detached at every step without teacher forcing
+    :param tbptt: truncated backpropagation through time
+    :param sampled_softmax: SampledSoftmax drawing the candidate words of the output layer, None for the full softmax
+    :param sequence_teacher_forcing: with teacher forcing, run the decoder over the whole target sequence in one call
+        instead of step by step
+    :param mixed_precision: run the forward passes with bfloat16 autocast (see autocast)
     :return: the train loss
     """
     # Zero gradients
@@ -65,66 +92,99 @@ def train(input_variable, lengths, target_variable, mask, max_target_len, trg_le
     mask = mask.to(device)
     #trg_lengths = trg_lengths.to(device) #RuntimeError: cuDNN error: CUDNN_STATUS_EXECUTION_FAILED
 
-    # Initialize variables
-    loss = 0
-    print_losses = []
+    # Initialize variables. Loss sums and token counts stay tensors, they are read once per batch
+    print_loss = 0
     n_totals = 0
 
-   # K = max_target_len//2
+    # Truncated backpropagation through time: with tbptt and K > 0, the decoder is run in chunks of K steps.
+    # Each chunk is backpropagated as soon as it is done and the decoder states are detached, so only the graph
+    # of the last K steps is kept in memory. The gradients of the chunks add up, the optimizers step once.
+    # The encoder only receives the gradients of the first chunk.
+    max_target_len = int(max_target_len)
+    k_step_tbptt = tbptt and K is not None and K > 0
+    chunk_len = K if k_step_tbptt else max_target_len
 
     # Forward pass through encoder
-    encoder_outputs, encoder_states = encoder(input_variable, lengths)
+    with autocast(mixed_precision):
+        encoder_outputs, encoder_states = encoder(input_variable, lengths)
 
     # Create initial decoder input (start with SOS tokens for each sentence)
-    decoder_input = torch.LongTensor([[SOS_token for _ in range(batch_size)]])
-    decoder_input = decoder_input.to(device)
+    decoder_input = torch.full((1, batch_size), SOS_token, dtype=torch.long, device=device)
 
     # Set initial decoder hidden state to the encoder's final hidden state
     #decoder_hidden = encoder_hidden[:decoder.n_layers]
     decoder_states = encoder_states
 
+    # Sampled softmax: the output layer is restricted to the candidate words of this batch,
+    # the loss targets are the positions of the target words among the candidates
+    output_words, output_layer, loss_targets, output_correction = None, None, target_variable, None
+    if sampled_softmax is not None:
+        output_words, loss_targets, output_correction = sampled_softmax.candidates(target_variable)
 
     # Determine if we are using teacher forcing this iteration
     rand = random.random()
     # print(rand)
     use_teacher_forcing = True if rand < teacher_forcing_ratio else False
 
-    # Forward batch of sequences through decoder one time step at a time
-    if use_teacher_forcing:
-        for t in range(max_target_len):
-            decoder_output, decoder_states = decoder(
-                decoder_input, decoder_states
-            )
-            # Teacher forcing: next input is current target
-            decoder_input = target_variable[t].view(1, -1)
-            # Calculate and accumulate loss
-            mask_loss, nTotal = maskNLLLoss(decoder_output, target_variable[t], mask[t])
-            loss += mask_loss
-            print_losses.append(mask_loss.item() * nTotal)
-            n_totals += nTotal
-    else:
-        for t in range(max_target_len):
-            decoder_output, decoder_states = decoder(
-                decoder_input, decoder_states
-            )
-            ### Truncate backpropagation through time ###
-            if tbptt:
-                #decoder_input = decoder_input.detach()
-                decoder_states = detach_states(decoder_states)
-            # No teacher forcing: next input is decoder's own current output
-            _, topi = decoder_output.topk(1)
-            decoder_input = torch.LongTensor([[topi[i][0] for i in range(batch_size)]])
-            decoder_input = decoder_input.to(device)
-
-            # Calculate and accumulate loss
-            mask_loss, nTotal = maskNLLLoss(decoder_output, target_variable[t], mask[t])
-            loss += mask_loss
-            print_losses.append(mask_loss.item() * nTotal)
-            n_totals += nTotal
+    if use_teacher_forcing and sequence_teacher_forcing:
+        # All decoder inputs are known: SOS followed by the targets shifted right by one step
+        decoder_inputs = torch.cat([decoder_input, target_variable[:max_target_len - 1]])
+
+    for start in range(0, max_target_len, chunk_len):
+        end = min(start + chunk_len, max_target_len)
+        # Forward passes under autocast, the backward passes outside of it
+        with autocast(mixed_precision):
+            if output_words is not None:
+                # Taken for every chunk: the backward pass of the previous chunk has freed its graph
+                output_layer = decoder.restricted_output(output_words, output_correction)
+
+            # Forward batch of sequences through decoder
+            if use_teacher_forcing and sequence_teacher_forcing:
+                # One decoder call for the whole chunk, same loss and gradients as the step by step loop below
+                decoder_outputs, decoder_states = decoder.forward_sequence(decoder_inputs[start:end], decoder_states,
+                                                                           output_layer=output_layer)
+                loss, sum_loss, nTotal = sequenceMaskCrossEntropyLoss(decoder_outputs, loss_targets[start:end],
+                                                                      mask[start:end])
+                print_loss += sum_loss.detach()
+                n_totals += nTotal
+            else:
+                loss = 0
+                for t in range(start, end):
+                    decoder_output, decoder_states = decoder(
+                        decoder_input, decoder_states, logits=True, output_layer=output_layer
+                    )
+                    if use_teacher_forcing:
+                        # Teacher forcing: next input is current target
+                        decoder_input = target_variable[t].view(1, -1)
+                    else:
+                        ### Without K, truncate backpropagation through time at every step ###
+                        if tbptt and not k_step_tbptt:
+                            #decoder_input = decoder_input.detach()
+                            decoder_states = detach_states(decoder_states)
+                        # No teacher forcing: next input is decoder's own current output
+                        # (with sampled softmax: the most likely candidate word)
+                        _, topi = decoder_output.topk(1)
+                        if output_words is not None:
+                            topi = output_words[topi]
+                        decoder_input = topi.view(1, -1)
+
+                    # Calculate and accumulate loss
+                    mask_loss, nTotal = maskCrossEntropyLoss(decoder_output, loss_targets[t], mask[t])
+                    loss += mask_loss
+                    print_loss += mask_loss.detach() * nTotal
+                    n_totals += nTotal
+
+        if end < max_target_len:
+            ### Truncate backpropagation through time after K steps ###
+            loss.backward()
+            decoder_states = detach_states(decoder_states)
 
     # Perform backpropatation
     loss.backward()
 
+    # Distributed training: the gradients are averaged over all processes before clipping
+    all_reduce_gradients([encoder, decoder])
+
     if clip:
         # Clip gradients: gradients are modified in place
         _ = torch.nn.utils.clip_grad_norm_(encoder.parameters(), max_norm=clip)
@@ -134,10 +194,10 @@ def train(input_variable, lengths, target_variable, mask, max_target_len, trg_le
     encoder_optimizer.step()
     decoder_optimizer.step()
 
-    return sum(print_losses) / n_totals
+    return (print_loss / n_totals).item()
 
 def eval(input_variable, lengths, target_variable, mask, max_target_len, trg_lengths, encoder, decoder,
-          batch_size):
+          batch_size, mixed_precision=False):
     """
     Performs evaluation on validation set during training iteration
     :param input_variable: batched tensor input
@@ -149,6 +209,7 @@ def eval(input_variable, lengths, target_variable, mask, max_target_len, trg_len
     :param encoder: encoder
     :param decoder: decoder
     :param batch_size: batch size
+    :param mixed_precision: run the forward passes with bfloat16 autocast (see autocast)
     :return: validation loss
     """
     # Set device options
@@ -157,19 +218,17 @@ def eval(input_variable, lengths, target_variable, mask, max_target_len, trg_len
     target_variable = target_variable.to(device)
     mask = mask.to(device)
 
-    # Initialize variables
-    loss = 0
-    print_losses = []
+    # Initialize variables. Loss sum and token count stay tensors, they are read once per batch
+    print_loss = 0
     n_totals = 0
 
-    with torch.no_grad():
+    with torch.no_grad(), autocast(mixed_precision):
 
         # Forward pass through encoder
         encoder_outputs, encoder_states = encoder(input_variable, lengths)
 
         # Create initial decoder input (start with SOS tokens for each sentence)
-        decoder_input = torch.LongTensor([[SOS_token for _ in range(batch_size)]])
-        decoder_input = decoder_input.to(device)
+        decoder_input = torch.full((1, batch_size), SOS_token, dtype=torch.long, device=device)
 
         # Set initial decoder hidden state to the encoder's final hidden state
         #decoder_hidden = encoder_hidden[:decoder.n_layers]
@@ -178,30 +237,27 @@ def eval(input_variable, lengths, target_variable, mask, max_target_len, trg_len
         # Forward batch of sequences through decoder one time step at a time
         for t in range(max_target_len):
             decoder_output, decoder_states = decoder(
-                decoder_input, decoder_states
+                decoder_input, decoder_states, logits=True
             )
             # No teacher forcing: next input is decoder's own current output
             _, topi = decoder_output.topk(1)
-            #decoder_input = decoder_input.detach()
-            try:
-                decoder_input = torch.LongTensor([[topi[i][0] for i in range(batch_size)]]) #RuntimeError: CUDA error: device-side assert triggered
-                decoder_input = decoder_input.to(device)
-                # Calculate and accumulate loss
-                mask_loss, nTotal = maskNLLLoss(decoder_output, target_variable[t], mask[t])
-                loss += mask_loss
-                print_losses.append(mask_loss.item() * nTotal)
-                n_totals += nTotal
-            except RuntimeError:
-                pass
-
+            decoder_input = topi.view(1, -1)
+            # Calculate and accumulate loss
+            mask_loss, nTotal = maskCrossEntropyLoss(decoder_output, target_variable[t], mask[t])
+            print_loss += mask_loss * nTotal
+            n_totals += nTotal
 
-        return sum(print_losses) / n_totals
+        return (print_loss / n_totals).item()
 
 def trainIters(model_name, src_voc, tar_voc, train_pairs, val_pairs, encoder, decoder, encoder_optimizer,
                decoder_optimizer, encoder_n_layers, decoder_n_layers, save_dir, n_iteration, batch_size, print_every,
-               save_every, clip, corpus_name, val_iterations, tbptt=True):
+               save_every, clip, corpus_name, val_iterations, tbptt=True, seed=1, num_workers=1, prefetch=4,
+               use_processes=False, bucketing=False, max_tokens=None, sampled_softmax=0, teacher_forcing_ratio=0.5,
+               tbptt_k=0, mixed_precision=False):
     """
-    This method defines the main training procedure
+    This method defines the main training procedure.
+    In distributed training (utils/distributed.py) every process trains on its own shard of the pairs with the same
+    batch size, the gradients are averaged in train(). Only the main process writes checkpoints.
     :param device:
     :param model_name: model name
     :param src_voc: source vocabulary
@@ -221,6 +277,18 @@ def trainIters(model_name, src_voc, tar_voc, train_pairs, val_pairs, encoder, de
     :param save_every: storage frequency
     :param clip: gradient clipping value
     :param corpus_name: file name
+    :param seed: seed of the batch sampling and of the teacher forcing decisions
+    :param num_workers: number of background workers building the batches (0: built in the training loop)
+    :param prefetch: number of batches built ahead of the training loop
+    :param use_processes: build the batches in worker processes instead of threads
+    :param bucketing: build batches of pairs with similar lengths instead of sampling random pairs
+    :param max_tokens: token budget per batch (only with bucketing), replaces the fixed batch size
+    :param sampled_softmax: number of sampled words of the sampled softmax training, 0 for the full softmax.
+        The reported training loss is then the loss over the candidate words, the validation loss stays exact
+    :param teacher_forcing_ratio: frequency to use teacher forcing
+    :param tbptt_k: with tbptt, backpropagate every tbptt_k decoder steps (see train), 0 for the per-step truncation
+        without teacher forcing
+    :param mixed_precision: bfloat16 autocast for the training and validation steps, fp32 weights and losses
     :return: average validation loss, directory, train_history, val_history
     """
     # Load batches for each iteration
@@ -234,13 +302,35 @@ def trainIters(model_name, src_voc, tar_voc, train_pairs, val_pairs, encoder, de
     #print("Start validation loss", best_validation_loss)
     n_bad_loss=0
 
-    random.seed(1)
-    training_batches = [batch2TrainData(src_voc, tar_voc, [random.choice(train_pairs) for _ in range(batch_size)])
-                        for _ in range(n_iteration)]
+    random.seed(seed)
+    # Words are looked up once, batches are built from the index arrays (already done for an EncodedCorpus)
+    if isinstance(train_pairs[0][0], str):
+        train_pairs = encode_pairs(src_voc, tar_voc, train_pairs)
+    if val_pairs and isinstance(val_pairs[0][0], str):
+        val_pairs = encode_pairs(src_voc, tar_voc, val_pairs)
+
+    # Distributed training: every process draws its batches from its own shard of the pairs
+    world_size = get_world_size()
+    if world_size > 1:
+        train_pairs = Shard(train_pairs, get_rank(), world_size)
+        if val_pairs:
+            val_pairs = Shard(val_pairs, get_rank(), world_size)
+
+    if bucketing:
+        sampler = lambda pairs, sampler_seed: sample_bucket_batches(pairs, n_iteration, batch_size, max_tokens,
+                                                                    sampler_seed)
+    else:
+        sampler = lambda pairs, sampler_seed: sample_batches(pairs, batch_size, n_iteration, sampler_seed)
+
+    # Batches are built lazily, while the previous iterations are running
+    training_batches = prefetch_batches(src_voc, tar_voc, sampler(train_pairs, seed),
+                                        num_workers=num_workers, prefetch=prefetch, use_processes=use_processes)
+
+    softmax_sampler = SampledSoftmax(tar_voc.counts, sampled_softmax, seed=seed) if sampled_softmax else None
 
     if val_pairs:
-        val_batches = [batch2TrainData(src_voc, tar_voc, [random.choice(val_pairs) for _ in range(batch_size)]) for
-                       _ in range(n_iteration)]
+        val_batches = prefetch_batches(src_voc, tar_voc, sampler(val_pairs, seed + 1),
+                                       num_workers=num_workers, prefetch=prefetch, use_processes=use_processes)
 
 
     #### Directory setup
@@ -248,14 +338,17 @@ def trainIters(model_name, src_voc, tar_voc, train_pairs, val_pairs, encoder, de
     directory = os.path.join(save_dir, model_name, corpus_name,
                              '{}-{}_{}-{}_{}'.format(encoder_n_layers, decoder_n_layers, encoder.emb_size,
                                                      encoder.hidden_size, batch_size))
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-    else:
-        print("An experiment with these settings has been already excuted. Deleting content...")
-        files_to_remove = [os.path.join(directory, f) for f in os.listdir(directory)]
-        for f in files_to_remove:
-            if os.path.isfile(f):
-                os.remove(f)
+    # Only the main process writes to the directory
+    if is_main_process():
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        else:
+            print("An experiment with these settings has been already excuted. Deleting content...")
+            files_to_remove = [os.path.join(directory, f) for f in os.listdir(directory)]
+            for f in files_to_remove:
+                if os.path.isfile(f):
+                    os.remove(f)
+    barrier()
 
     # Initializations
     print('Initializing ...')
@@ -273,16 +366,26 @@ def trainIters(model_name, src_voc, tar_voc, train_pairs, val_pairs, encoder, de
     encoder_layers, decoder_layers = [], []
     min_lr_reached = False
 
+    ### Padding and throughput statistics of the training batches
+    real_tokens, padded_tokens = 0, 0
+    print_start_time = time.perf_counter()
+
     for iteration in range(start_iteration, n_iteration):
 
         ### Training batch
-        training_batch = training_batches[iteration - 1]
+        training_batch = next(training_batches)
         train_inp_var, train_src_len, train_trg_var, train_mask, train_max_len, train_trg_len = training_batch
+        batch_real, batch_padded = padding_statistics(training_batch)
+        real_tokens += batch_real
+        padded_tokens += batch_padded
 
         encoder.train()
         decoder.train()
+        # With bucketing, the batch size changes from batch to batch
         train_loss = train(train_inp_var, train_src_len, train_trg_var, train_mask, train_max_len, train_trg_len,
-                           encoder, decoder, encoder_optimizer, decoder_optimizer, batch_size, clip, K=0, tbptt=tbptt)
+                           encoder, decoder, encoder_optimizer, decoder_optimizer, train_inp_var.size(1), clip, K=tbptt_k,
+                           teacher_forcing_ratio=teacher_forcing_ratio, tbptt=tbptt, sampled_softmax=softmax_sampler,
+                           mixed_precision=mixed_precision)
 
         train_print_loss += train_loss
         #### store results
@@ -290,14 +393,14 @@ def trainIters(model_name, src_voc, tar_voc, train_pairs, val_pairs, encoder, de
 
         if val_pairs:
             ### Validation
-            val_batch = val_batches[iteration-1]
+            val_batch = next(val_batches)
             val_inp_var, val_src_len, val_trg_var, val_mask, val_max_len, val_trg_len = val_batch
 
             encoder.eval()
             decoder.eval()
 
             val_loss = eval(val_inp_var, val_src_len, val_trg_var, val_mask, val_max_len, val_trg_len, encoder, decoder,
-                            batch_size)
+                            val_inp_var.size(1), mixed_precision=mixed_precision)
 
             val_print_loss += val_loss
 
@@ -311,15 +414,23 @@ def trainIters(model_name, src_voc, tar_voc, train_pairs, val_pairs, encoder, de
 
         # Logging and validation check
         if iteration % print_every == 0 or iteration == n_iteration-1:
-            print_loss_avg = train_print_loss / print_every
+            # Distributed training: losses are averaged and tokens summed over all processes, so that all processes
+            # take the same learning rate decisions
+            print_loss_avg, val_loss_avg = all_reduce_values([train_print_loss / print_every,
+                                                              val_print_loss / print_every])
+            real_tokens, padded_tokens = all_reduce_values([real_tokens, padded_tokens], average=False)
             if val_pairs:
-                print_val_loss_avg = val_print_loss / print_every
+                print_val_loss_avg = val_loss_avg
                 print("Iteration: {}; Percent complete: {:.1f}%; Average train loss: {:.4f}; Average val loss: {:.4f}"
                       .format(iteration, iteration / n_iteration * 100, print_loss_avg, print_val_loss_avg))
                 print("Absolute difference validation vs. training loss:", np.abs(print_val_loss_avg - print_loss_avg))
             else:
                 print("Iteration: {}; Percent complete: {:.1f}%; Average train loss: {:.4f}"
                       .format(iteration, iteration / n_iteration * 100, print_loss_avg))
+            print("Padding ratio: {:.1f}%; Tokens/s: {:.0f}".format(
+                100. * (1 - real_tokens / padded_tokens), real_tokens / (time.perf_counter() - print_start_time)))
+            real_tokens, padded_tokens = 0, 0
+            print_start_time = time.perf_counter()
 
             ### reset counters
             train_print_loss = 0
@@ -334,21 +445,22 @@ def trainIters(model_name, src_voc, tar_voc, train_pairs, val_pairs, encoder, de
 
                     if n_bad_loss != 0: n_bad_loss = 0
 
-                    torch.save({
-                        'iteration': iteration,
-                        'en': encoder.state_dict(),
-                        'de': decoder.state_dict(),
-                        'en_opt': encoder_optimizer.state_dict(),
-                        'de_opt': decoder_optimizer.state_dict(),
-                        'loss': val_loss,
-                        'src_dict': src_voc.__dict__,
-                        'tar_dict': tar_voc.__dict__,
-                        'src_embedding': encoder.embedding.state_dict(),
-                        'trg_embedding': decoder.embedding.state_dict(),
-                        'n_layers': layers,  # Layer numbers the same for both components
-                        'hidden_size': hidden_size
-
-                    }, os.path.join(directory, '{}.tar'.format('checkpoint')))
+                    if is_main_process():
+                        torch.save({
+                            'iteration': iteration,
+                            'en': encoder.state_dict(),
+                            'de': decoder.state_dict(),
+                            'en_opt': encoder_optimizer.state_dict(),
+                            'de_opt': decoder_optimizer.state_dict(),
+                            'loss': val_loss,
+                            'src_dict': voc_to_state(src_voc),
+                            'tar_dict': voc_to_state(tar_voc),
+                            'src_embedding': encoder.embedding.state_dict(),
+                            'trg_embedding': decoder.embedding.state_dict(),
+                            'n_layers': layers,  # Layer numbers the same for both components
+                            'hidden_size': hidden_size
+
+                        }, os.path.join(directory, '{}.tar'.format('checkpoint')))
                 else:
                     ### increase the number of bad validation loss
                     n_bad_loss +=1
@@ -370,7 +482,7 @@ def trainIters(model_name, src_voc, tar_voc, train_pairs, val_pairs, encoder, de
 
                         min_lr_reached = True
 
-        if not val_pairs and iteration % save_every == 0:
+        if not val_pairs and iteration % save_every == 0 and is_main_process():
             torch.save({
                 'iteration': iteration,
                 'en': encoder.state_dict(),
@@ -378,8 +490,8 @@ def trainIters(model_name, src_voc, tar_voc, train_pairs, val_pairs, encoder, de
                 'en_opt': encoder_optimizer.state_dict(),
                 'de_opt': decoder_optimizer.state_dict(),
                 'loss': val_loss,
-                'src_dict': src_voc.__dict__,
-                'tar_dict': tar_voc.__dict__,
+                'src_dict': voc_to_state(src_voc),
+                'tar_dict': voc_to_state(tar_voc),
                 'src_embedding': encoder.embedding.state_dict(),
                 'trg_embedding': decoder.embedding.state_dict(),
                 'n_layers': layers,  # Layer numbers the same for both components
@@ -387,6 +499,10 @@ def trainIters(model_name, src_voc, tar_voc, train_pairs, val_pairs, encoder, de
 
             }, os.path.join(directory, '{}.tar'.format('checkpoint')))
 
+    # Stop the background workers
+    training_batches.close()
+    if val_pairs:
+        val_batches.close()
 
     return print_val_loss_avg, directory, train_history, val_history, [encoder_avg_grads, encoder_layers], [decoder_avg_grads, decoder_layers]
 
@@ -394,42 +510,229 @@ def trainIters(model_name, src_voc, tar_voc, train_pairs, val_pairs, encoder, de
 
 class GreedySearchDecoder(nn.Module):
     """
-    This is a greedy searcher decoder, to use during inference
+    This is a greedy searcher decoder, to use during inference.
+    It decodes a whole padded batch at once and stops as soon as every row has emitted EOS.
     """
-    def __init__(self, encoder, decoder):
+    def __init__(self, encoder, decoder, mixed_precision=False):
+        """
+        :param encoder: encoder
+        :param decoder: decoder
+        :param mixed_precision: run encoder and decoder with bfloat16 autocast, scores are computed in fp32
+        """
         super(GreedySearchDecoder, self).__init__()
         self.encoder = encoder
         self.decoder = decoder
+        self.mixed_precision = mixed_precision
 
+    # Inference only: the output buffers are written in place (out=...), which autograd does not support
+    @torch.no_grad()
     def forward(self, input_seq, input_length, max_length):
+        """
+        :param input_seq: padded input batch, shape = (max_len, batch_size)
+        :param input_length: lengths of the input sentences, sorted in decreasing order
+        :param max_length: maximum number of decoding steps
+        :return: tokens and scores per row, shape = (batch_size, decoded_steps)
+        """
+        # Buffers are allocated on the device of the input, e.g. the CPU for quantized models
+        device = input_seq.device
+        batch_size = input_seq.size(1)
         # Forward input through encoder model
-        encoder_outputs, encoder_hidden = self.encoder(input_seq, input_length)
+        with autocast(self.mixed_precision, device.type):
+            encoder_outputs, encoder_hidden = self.encoder(input_seq, input_length)
         # Prepare encoder's final hidden layer to be first hidden input to the decoder
         #decoder_hidden = encoder_hidden[:self.decoder.n_layers]
         decoder_hidden = encoder_hidden
-        # Initialize decoder input with SOS_token
-        decoder_input = torch.ones(1, 1, device=device, dtype=torch.long) * SOS_token
-        # Initialize tensors to append decoded words to
-        all_tokens = torch.zeros([0], device=device, dtype=torch.long)
-        all_scores = torch.zeros([0], device=device)
+        # Output buffers are allocated once and filled in place, one row per decoding step
+        all_tokens = torch.full((max_length, batch_size), PAD_token, device=device, dtype=torch.long)
+        all_scores = torch.zeros(max_length, batch_size, device=device)
+        # Initialize decoder input with SOS_token, one per row
+        decoder_input = torch.full((1, batch_size), SOS_token, device=device, dtype=torch.long)
+        # Rows which have already emitted EOS, plus scratch buffers for the per-step checks
+        finished = torch.zeros(batch_size, device=device, dtype=torch.bool)
+        is_eos = torch.zeros(batch_size, device=device, dtype=torch.bool)
+        all_finished = torch.zeros((), device=device, dtype=torch.bool)
+        log_norm = torch.zeros(batch_size, device=device)
+        steps = 0
         # Iteratively decode one word token at a time
-        for _ in range(max_length):
-            # Forward pass through decoder
-            decoder_output, decoder_hidden = self.decoder(decoder_input, decoder_hidden)
-            # Obtain most likely word token and its softmax score
-            decoder_scores, decoder_input = torch.max(decoder_output, dim=1)
-            # Record token and score
-            all_tokens = torch.cat((all_tokens, decoder_input), dim=0)
-            all_scores = torch.cat((all_scores, decoder_scores), dim=0)
-            # Prepare current token to be next decoder input (add a dimension)
-            decoder_input = torch.unsqueeze(decoder_input, 0)
-        # Return collections of word tokens and scores
-        return all_tokens, all_scores
+        for t in range(max_length):
+            # Forward pass through decoder, the logits are read in fp32
+            with autocast(self.mixed_precision, device.type):
+                decoder_output, decoder_hidden = self.decoder(decoder_input, decoder_hidden, logits=True)
+            decoder_output = decoder_output.float()
+            # Obtain most likely word token from the logits, written straight into the buffers
+            torch.max(decoder_output, dim=1, out=(all_scores[t], all_tokens[t]))
+            # Softmax score of the chosen token: exp(logit - logsumexp(logits))
+            torch.logsumexp(decoder_output, dim=1, out=log_norm)
+            all_scores[t].sub_(log_norm).exp_()
+            # Finished rows only produce padding
+            all_tokens[t].masked_fill_(finished, PAD_token)
+            all_scores[t].masked_fill_(finished, 0.)
+            torch.eq(all_tokens[t], EOS_token, out=is_eos)
+            finished |= is_eos
+            steps = t + 1
+            if torch.all(finished, out=all_finished):
+                break
+            # Current tokens are the next decoder input, as a (1, batch_size) view on the buffer
+            decoder_input = all_tokens[t:t + 1]
+        # Return collections of word tokens and scores, one row per sentence
+        return all_tokens[:steps].t(), all_scores[:steps].t()
+
+
+def _repeat_states(states, times):
+    # Repeats every batch entry of the recurrent states 'times' times: (n_layers, batch_size * times, hidden_size)
+    if isinstance(states, tuple):
+        return tuple(state.repeat_interleave(times, dim=1) for state in states)
+    return states.repeat_interleave(times, dim=1)
+
+
+def _select_states(states, index):
+    # Reorders the batch dimension of the recurrent states according to index
+    if isinstance(states, tuple):
+        return tuple(state.index_select(1, index) for state in states)
+    return states.index_select(1, index)
+
+
+class BeamSearchDecoder(nn.Module):
+    """
+    Beam search decoder, to use during inference instead of the GreedySearchDecoder.
+    All beams of all sentences are decoded as one flattened batch of size batch_size * beam_width,
+    top-k selection, backpointers and finished hypotheses are handled with tensor operations.
+    """
+    def __init__(self, encoder, decoder, beam_width=5):
+        super(BeamSearchDecoder, self).__init__()
+        self.encoder = encoder
+        self.decoder = decoder
+        self.beam_width = beam_width
+
+    def forward(self, input_seq, input_length, max_length):
+        """
+        :param input_seq: padded input batch, shape = (max_len, batch_size)
+        :param input_length: lengths of the input sentences, sorted in decreasing order
+        :param max_length: maximum number of decoding steps
+        :return: tokens and scores of the best hypothesis per row, shape = (batch_size, decoded_steps)
+        """
+        # Buffers are allocated on the device of the input, e.g. the CPU for quantized models
+        device = input_seq.device
+        batch_size = input_seq.size(1)
+        k = self.beam_width
+        # Forward input through encoder model and copy its final states for every beam
+        encoder_outputs, encoder_hidden = self.encoder(input_seq, input_length)
+        decoder_hidden = _repeat_states(encoder_hidden, k)
+        decoder_input = torch.full((1, batch_size * k), SOS_token, device=device, dtype=torch.long)
+
+        # Only the first beam is alive at the beginning, otherwise the first step would yield k identical beams
+        beam_scores = torch.full((batch_size, k), float('-inf'), device=device)
+        beam_scores[:, 0] = 0.
+        finished = torch.zeros(batch_size, k, device=device, dtype=torch.bool)
+        # Offset of every sentence in the flattened beam batch
+        offsets = torch.arange(batch_size, device=device).unsqueeze(1) * k
+
+        tokens = torch.zeros(max_length, batch_size, k, device=device, dtype=torch.long)
+        token_scores = torch.zeros(max_length, batch_size, k, device=device)
+        backpointers = torch.zeros(max_length, batch_size, k, device=device, dtype=torch.long)
+
+        steps = 0
+        for t in range(max_length):
+            decoder_output, decoder_hidden = self.decoder(decoder_input, decoder_hidden, logits=True)
+            log_probs = F.log_softmax(decoder_output, dim=1).view(batch_size, k, -1)
+            vocab_size = log_probs.size(2)
+            # Finished hypotheses can only be extended with padding, without changing their score
+            log_probs = log_probs.masked_fill(finished.unsqueeze(2), float('-inf'))
+            log_probs[:, :, PAD_token] = log_probs[:, :, PAD_token].masked_fill(finished, 0.)
+
+            # Top-k over all extensions of all beams of a sentence
+            candidates = (beam_scores.unsqueeze(2) + log_probs).view(batch_size, -1)
+            beam_scores, flat_index = candidates.topk(k, dim=1)
+            beam_index = flat_index // vocab_size
+            token_index = flat_index % vocab_size
+
+            tokens[t] = token_index
+            token_scores[t] = log_probs.view(batch_size, -1).gather(1, flat_index)
+            backpointers[t] = beam_index
+            finished = finished.gather(1, beam_index) | (token_index == EOS_token)
+            steps = t + 1
+            # Scores can only decrease: once the best beam is finished, no other hypothesis can overtake it
+            if finished[:, 0].all():
+                break
+
+            # Continue from the selected beams
+            decoder_hidden = _select_states(decoder_hidden, (beam_index + offsets).view(-1))
+            decoder_input = token_index.view(1, -1)
+
+        # Follow the backpointers of the best beam (always beam 0, as topk is sorted)
+        all_tokens = torch.zeros(steps, batch_size, device=device, dtype=torch.long)
+        all_scores = torch.zeros(steps, batch_size, device=device)
+        best = torch.zeros(batch_size, 1, device=device, dtype=torch.long)
+        for t in reversed(range(steps)):
+            all_tokens[t] = tokens[t].gather(1, best).squeeze(1)
+            all_scores[t] = token_scores[t].gather(1, best).squeeze(1)
+            best = backpointers[t].gather(1, best)
+        # Scores as probabilities, like the GreedySearchDecoder; padding after EOS has score 0
+        all_scores = all_scores.exp().masked_fill(all_tokens == PAD_token, 0.)
+        return all_tokens.t(), all_scores.t()
 
 
 ############# Evaluation ################
 
-def evaluate(searcher, src_voc, trg_voc, sentence, max_length=MAX_LENGTH):
+def _searcher_device(searcher):
+    # Device of the searcher's weights: quantized models stay on the CPU whatever the global device
+    for param in searcher.parameters():
+        return param.device
+    return device
+
+
+def _search_batch(searcher, src_voc, trg_voc, sentences, max_length):
+    ### Format input sentences as a batch
+    # words -> indexes
+    indexes_batch = [indexesFromSentence(src_voc, sentence) for sentence in sentences]
+    # 'lengths' has to be sorted in decreasing order -> pack padded
+    order = sorted(range(len(indexes_batch)), key=lambda i: len(indexes_batch[i]), reverse=True)
+    indexes_batch = [indexes_batch[i] for i in order]
+    # Create lengths tensor
+    lengths = torch.tensor([len(indexes) for indexes in indexes_batch])
+    # Pad and transpose dimensions of batch to match models' expectations
+    input_batch = torch.LongTensor(zeroPadding(indexes_batch))
+    # Use the device of the searcher
+    searcher_device = _searcher_device(searcher)
+    input_batch = input_batch.to(searcher_device)
+    lengths = lengths.to(searcher_device)
+    # Decode sentences with searcher, no gradients are needed for inference
+    with torch.no_grad():
+        tokens, scores = searcher(input_batch, lengths, max_length)
+    # indexes -> words, back in the original order
+    decoded_words = [None] * len(sentences)
+    for row, i in enumerate(order):
+        decoded_words[i] = [trg_voc.index2word[token] for token in tokens[row].tolist()]
+    return decoded_words
+
+
+def evaluate_batch(searcher, src_voc, trg_voc, sentences, max_length=MAX_LENGTH, cache=None):
+    """
+    Translates a list of sentences with a single searcher call
+    :param searcher: the searcher method. By Default it is a GreedySearcher
+    :param src_voc: the source vocabulary
+    :param trg_voc: the target vocabulary
+    :param sentences: list of (preprocessed) sentences to be translated
+    :param max_length: search max length
+    :param cache: optional TranslationCache, only the sentences missing in the cache are decoded
+    :return: Decoded words for each sentence, in the same order as sentences
+    """
+    if cache is None:
+        return _search_batch(searcher, src_voc, trg_voc, sentences, max_length)
+
+    decoded_words = [cache.get(sentence, max_length) for sentence in sentences]
+    # Every missing sentence is decoded once, even if it occurs several times in the batch
+    missing = list(dict.fromkeys(sentence for sentence, words in zip(sentences, decoded_words) if words is None))
+    if missing:
+        translations = dict(zip(missing, _search_batch(searcher, src_voc, trg_voc, missing, max_length)))
+        for sentence, words in translations.items():
+            cache.put(sentence, max_length, words)
+        decoded_words = [list(translations[sentence]) if words is None else words
+                         for sentence, words in zip(sentences, decoded_words)]
+    return decoded_words
+
+
+def evaluate(searcher, src_voc, trg_voc, sentence, max_length=MAX_LENGTH, cache=None):
     """
     Util method to do evaluation
     :param searcher: the searcher method. By Default it is a GreedySearcher
@@ -437,28 +740,57 @@ def evaluate(searcher, src_voc, trg_voc, sentence, max_length=MAX_LENGTH):
     :param trg_voc: the target vocabulary
     :param sentence: the sentence to be translated
     :param max_length: search max length
+    :param cache: optional TranslationCache
     :return: Decoded words
     """
-    ### Format input sentence as a batch
-    # words -> indexes
-    indexes_batch = [indexesFromSentence(src_voc, sentence)]
-    # Create lengths tensor
-    lengths = torch.tensor([len(indexes) for indexes in indexes_batch])
-    # Transpose dimensions of batch to match models' expectations
-    input_batch = torch.LongTensor(indexes_batch).transpose(0, 1)
-    # Use appropriate device
-    input_batch = input_batch.to(device)
-    lengths = lengths.to(device)
-    # Decode sentence with searcher
-    tokens, scores = searcher(input_batch, lengths, max_length)
-    # indexes -> words
-    decoded_words = [trg_voc.index2word[token.item()] for token in tokens]
-    return decoded_words
+    return evaluate_batch(searcher, src_voc, trg_voc, [sentence], max_length, cache=cache)[0]
 
 
 ######## Inference from input ##############
 
-def evaluateInput(encoder, decoder, searcher,  src_voc, trg_voc, from_file = None):
+def _translate_window(searcher, src_voc, trg_voc, sentences, batch_size, max_length, cache):
+    # Sentences of similar length are batched together, results are returned in the original order
+    order = sorted(range(len(sentences)), key=lambda i: len(sentences[i].split(' ')))
+    translations = [None] * len(sentences)
+    for start in range(0, len(order), batch_size):
+        batch_index = order[start:start + batch_size]
+        batch = [sentences[i] for i in batch_index]
+        decoded_batch = evaluate_batch(searcher, src_voc, trg_voc, batch, max_length, cache=cache)
+        for i, output_words in zip(batch_index, decoded_batch):
+            output_words = [x for x in output_words if not (x == EOS or x == PAD)]
+            translations[i] = ' '.join(output_words) if output_words else "No translation"
+    return [[sentence, translation] for sentence, translation in zip(sentences, translations)]
+
+
+def translate_stream(searcher, src_voc, trg_voc, lines, batch_size=64, window_batches=16, max_length=MAX_LENGTH,
+                     cache=None):
+    """
+    Translates an iterable of lines lazily, e.g. an open file.
+    Lines are read in windows of batch_size * window_batches lines. Inside a window the sentences are grouped
+    by length into batches, each batch is translated with a single searcher call.
+    Only one window is kept in memory at a time.
+    :param searcher: the searcher method, e.g. GreedySearchDecoder
+    :param src_voc: the source vocabulary
+    :param trg_voc: the target vocabulary
+    :param lines: iterable of raw sentences
+    :param batch_size: number of sentences translated together
+    :param window_batches: number of batches sorted by length together
+    :param max_length: search max length
+    :param cache: optional TranslationCache
+    :return: generator of [preprocessed sentence, translation], in the same order as lines
+    """
+    window_size = batch_size * window_batches
+    window = []
+    for line in lines:
+        window.append(preprocess_sentence(line))
+        if len(window) == window_size:
+            yield from _translate_window(searcher, src_voc, trg_voc, window, batch_size, max_length, cache)
+            window = []
+    if window:
+        yield from _translate_window(searcher, src_voc, trg_voc, window, batch_size, max_length, cache)
+
+
+def evaluateInput(encoder, decoder, searcher,  src_voc, trg_voc, from_file = None, batch_size=64, cache=None):
     """
     Adapted from: PyTorch Chatbot Tutorial
     Reads a sentence as keyboard input and returns its translation
@@ -468,21 +800,12 @@ def evaluateInput(encoder, decoder, searcher,  src_voc, trg_voc, from_file = Non
     :param src_voc:
     :param trg_voc:
     :param from_file: the file which sentences are read from
+    :param batch_size: number of sentences from file translated together
+    :param cache: optional TranslationCache shared by the file and the keyboard mode
     :return:
     """
-    results = []
-
     if from_file:
-        for line in from_file:
-            line = preprocess_sentence(line)
-            output_words = evaluate(searcher, src_voc, trg_voc, line)
-            output_words[:] = [x for x in output_words if not (x == EOS or x == PAD)]
-            if output_words:
-                translation = ' '.join(output_words)
-                results.append([line, str(translation)])
-            else:
-                results.append([line, "No translation"])
-        return results
+        return list(translate_stream(searcher, src_voc, trg_voc, from_file, batch_size=batch_size, cache=cache))
     else:
         input_sentence = ''
         while(1):
@@ -494,7 +817,7 @@ def evaluateInput(encoder, decoder, searcher,  src_voc, trg_voc, from_file = Non
                 # Normalize sentence
                 input_sentence = preprocess_sentence(input_sentence)
                 # Evaluate sentence
-                output_words = evaluate(searcher, src_voc, trg_voc, input_sentence)
+                output_words = evaluate(searcher, src_voc, trg_voc, input_sentence, cache=cache)
                 # Format and print response sentence
                 output_words[:] = [x for x in output_words if not (x == EOS or x == PAD)]
                 if output_words:
@@ -508,22 +831,27 @@ def evaluateInput(encoder, decoder, searcher,  src_voc, trg_voc, from_file = Non
 
 #### Evaluation on test set
 
-def eval_batch(batch_list, encoder, decoder, batch_size):
+def eval_batch(batch_list, encoder, decoder, batch_size=None):
     """
     Performs evaluation on test set
-    :param batch_list:
+    :param batch_list: outputs of batch2TrainData, e.g. built with utils.batching.bucket_batches
     :param encoder:
     :param decoder:
-    :return:
+    :param batch_size: not used anymore, the batch size is taken from every batch (batches may differ in size)
+    :return: average loss per target token
     """
     total_loss = 0
+    total_tokens = 0
     for batch in batch_list:
         test_inp_var, test_src_len, test_trg_var, test_mask, test_max_len, test_trg_len = batch
 
         test_loss = eval(test_inp_var, test_src_len, test_trg_var, test_mask, test_max_len, test_trg_len, encoder, decoder,
-                    batch_size)
-        total_loss+= test_loss
-    return total_loss/len(batch_list)
+                    test_inp_var.size(1))
+        # Batches of different sizes are weighted by their number of target tokens
+        n_tokens = int(test_mask.sum())
+        total_loss += test_loss * n_tokens
+        total_tokens += n_tokens
+    return total_loss/total_tokens
 
 #### Plot results
 
@@ -0,0 +1,54 @@
+"""
+Exports the last checkpoint of an experiment as slim inference artifact (inference.pt):
+weights, vocabularies and hyperparameters only. translate.py and serve.py load it instead of the checkpoint.
+With --script True the encoder and the greedy decoding loop are also compiled to TorchScript (greedy_scripted.pt),
+used by translate.py --script True.
+With --quantize True the dynamic int8 model is exported as well (inference_int8.pt, and greedy_scripted_int8.pt
+together with --script True), used by translate.py --quantize True.
+
+python export_model.py --path path_to_experiment
+"""
+import argparse
+import os
+
+from global_settings import INFERENCE_FILE, SCRIPT_FILE, QUANTIZED_FILE, QUANTIZED_SCRIPT_FILE
+from model.checkpoint import export_inference_model, load_checkpoint
+from model.quantize import export_quantized_model, quantize_models
+from model.script import script_greedy_search, save_scripted
+from run_experiment import str2bool
+from translate import find_checkpoint
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='PyTorch Vanilla LSTM Machine Translator - inference export')
+    parser.add_argument('--path', type=str, default="", help='experiment path')
+    parser.add_argument('--output', type=str, default="", help="artifact path. Default: inference.pt in the experiment directory")
+    parser.add_argument('--script', type=str2bool, default="False", help="Also export the TorchScript greedy searcher (greedy_scripted.pt)")
+    parser.add_argument('--quantize', type=str2bool, default="False", help="Also export the dynamic int8 model (inference_int8.pt)")
+
+    args = parser.parse_args()
+
+    experiment_dir, checkpoint_file = find_checkpoint(".", args.path if args.path != "" else None)
+    output_file = args.output if args.output != "" else os.path.join(".", experiment_dir, INFERENCE_FILE)
+    export_inference_model(checkpoint_file, output_file)
+    print("Exported %s (%.1f MB) to %s (%.1f MB)" % (checkpoint_file, os.path.getsize(checkpoint_file) / 2 ** 20,
+                                                  output_file, os.path.getsize(output_file) / 2 ** 20))
+
+    if args.script:
+        encoder, decoder, src_voc, trg_voc = load_checkpoint(checkpoint_file)
+        encoder.eval()
+        decoder.eval()
+        script_file = os.path.join(os.path.dirname(output_file), SCRIPT_FILE)
+        save_scripted(script_greedy_search(encoder, decoder), src_voc, trg_voc, script_file)
+        print("TorchScript greedy searcher stored in %s" % script_file)
+
+    if args.quantize:
+        quantized_file = os.path.join(os.path.dirname(output_file), QUANTIZED_FILE)
+        export_quantized_model(checkpoint_file, quantized_file)
+        print("Dynamic int8 model stored in %s (%.1f MB)" % (quantized_file, os.path.getsize(quantized_file) / 2 ** 20))
+        if args.script:
+            encoder, decoder, src_voc, trg_voc = load_checkpoint(checkpoint_file)
+            encoder, decoder = quantize_models(encoder, decoder)
+            script_file = os.path.join(os.path.dirname(output_file), QUANTIZED_SCRIPT_FILE)
+            save_scripted(script_greedy_search(encoder, decoder), src_voc, trg_voc, script_file)
+            print("TorchScript greedy searcher of the int8 model stored in %s" % script_file)
@@ -6,6 +6,7 @@ import torch
 FILENAME = "deu.txt"
 DATA_DIR = "data/"
 PREPRO_DIR = os.path.join(DATA_DIR, "prepro")
+PREPRO_CACHE_DIR = os.path.join(PREPRO_DIR, "cache") # content-addressed preprocessing results
 DOCU_DIR = "documentation"
 
 EXPERIMENT_DIR = "experiment/"
@@ -18,6 +19,10 @@ TEST_FILE = "test.pkl"
 LOG_FILE = "last_experiment.txt"
 SAMPLES_FILE = "translation_examples_for_testing.txt"
 TRANSLATIONS_FROM_SAMPLES = "translations_from_sample.txt"
+INFERENCE_FILE = "inference.pt" # slim inference artifact, stored next to the checkpoint
+SCRIPT_FILE = "greedy_scripted.pt" # TorchScript greedy searcher, stored next to the checkpoint
+QUANTIZED_FILE = "inference_int8.pt" # dynamic int8 inference artifact, stored next to the checkpoint
+QUANTIZED_SCRIPT_FILE = "greedy_scripted_int8.pt" # TorchScript greedy searcher of the int8 model
 
 
 #### CUDA SETTINGS ######
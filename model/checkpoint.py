@@ -0,0 +1,83 @@
+import torch
+
+from model.model import EncoderLSTM, DecoderLSTM
+from utils.tokenize import voc_to_words, voc_from_words, voc_from_state
+
+"""
+Loading of training checkpoints and of the slim inference artifact.
+The inference artifact only contains the model weights, the vocabularies (as word list) and the hyperparameters:
+no optimizer states and no separate copies of the embeddings, which are already part of the encoder/decoder weights.
+"""
+
+
+def build_models(enc_state, dec_state, n_layers, hidden_size, assign=False):
+    """
+    Builds encoder and decoder from their state dicts, sizes are read from the weights
+    :param assign: if True, the loaded tensors are used as parameters without copying them (e.g. memory-mapped tensors)
+    :return: encoder, decoder
+    """
+    input_size, emb_size = enc_state['embedding.weight'].shape
+    output_size = dec_state['embedding.weight'].shape[0]
+    encoder = EncoderLSTM(input_size, emb_size=emb_size, hidden_size=hidden_size, n_layers=n_layers)
+    decoder = DecoderLSTM(output_size, emb_size=emb_size, hidden_size=hidden_size, n_layers=n_layers)
+    if assign:
+        encoder.load_state_dict(enc_state, assign=True)
+        decoder.load_state_dict(dec_state, assign=True)
+    else:
+        encoder.load_state_dict(enc_state)
+        decoder.load_state_dict(dec_state)
+    return encoder, decoder
+
+
+def load_checkpoint(checkpoint_file):
+    """
+    Loads a training checkpoint (checkpoint.tar) for inference. Optimizer states are ignored.
+    :param checkpoint_file: path to the checkpoint
+    :return: encoder, decoder, source vocabulary, target vocabulary
+    """
+    checkpoint = torch.load(checkpoint_file, map_location="cpu")
+
+    src_voc = voc_from_state(checkpoint['src_dict'], "eng")
+    trg_voc = voc_from_state(checkpoint['tar_dict'], "deu")
+
+    encoder, decoder = build_models(checkpoint['en'], checkpoint['de'], checkpoint['n_layers'], checkpoint['hidden_size'])
+    return encoder, decoder, src_voc, trg_voc
+
+
+def export_inference_model(checkpoint_file, output_file):
+    """
+    Writes the slim inference artifact for a training checkpoint
+    :param checkpoint_file: path to the training checkpoint
+    :param output_file: path of the artifact
+    :return: output_file
+    """
+    checkpoint = torch.load(checkpoint_file, map_location="cpu")
+    src_voc = voc_from_state(checkpoint['src_dict'], "eng")
+    trg_voc = voc_from_state(checkpoint['tar_dict'], "deu")
+    torch.save({
+        'en': checkpoint['en'],
+        'de': checkpoint['de'],
+        # Words are stored as one newline separated string, which is much faster to unpickle than a list
+        'src_name': src_voc.name,
+        'trg_name': trg_voc.name,
+        'src_words': voc_to_words(src_voc),
+        'trg_words': voc_to_words(trg_voc),
+        'n_layers': checkpoint['n_layers'],
+        'hidden_size': checkpoint['hidden_size']
+    }, output_file)
+    return output_file
+
+
+def load_inference_model(artifact_file):
+    """
+    Loads the slim inference artifact. The weights are memory-mapped, not read into memory:
+    pages are loaded on first use and shared between processes using the same file.
+    :param artifact_file: path to the artifact written by export_inference_model
+    :return: encoder, decoder, source vocabulary, target vocabulary
+    """
+    artifact = torch.load(artifact_file, map_location="cpu", mmap=True, weights_only=True)
+    src_voc = voc_from_words(artifact['src_words'], artifact['src_name'])
+    trg_voc = voc_from_words(artifact['trg_words'], artifact['trg_name'])
+    encoder, decoder = build_models(artifact['en'], artifact['de'], artifact['n_layers'], artifact['hidden_size'],
+                                    assign=True)
+    return encoder, decoder, src_voc, trg_voc
@@ -75,8 +75,19 @@ class DecoderLSTM(nn.Module):
 
         self.out = nn.Linear(hidden_size, output_size)
 
-    def forward(self, input_step, last_hidden):
+    def restricted_output(self, output_words, correction=None):
+        # Weight and bias of the output layer rows of the given word indexes (sampled softmax training).
+        # Taken once per batch: the gradient of the full output layer is then built once, not at every step.
+        # correction (log-Q correction of SampledSoftmax.candidates) is subtracted from the bias
+        bias = self.out.bias[output_words]
+        if correction is not None:
+            bias = bias - correction
+        return self.out.weight[output_words], bias
+
+    def forward(self, input_step, last_hidden, logits=False, output_layer=None):
         #input_step = [seq_len, batch_size]
+        #logits = if True, the raw scores of the output layer are returned instead of the softmax probabilities
+        #output_layer = (weight, bias) used instead of the full output layer, see restricted_output
         #last_hidden = [seq_len, batch_size, hidden_size] #1, 64, 256
         #embedded = [seq_len, batch_size, embedding_size]
         embedded = self.embedding(input_step)
@@ -88,7 +99,23 @@ class DecoderLSTM(nn.Module):
         # Squeeze first dimension
         output = output.squeeze(0)
         # Prediction
-        output = self.out(output)
-        output = F.softmax(output, dim=1)
+        if output_layer is None:
+            output = self.out(output)
+        else:
+            output = F.linear(output, *output_layer)
+        if not logits:
+            output = F.softmax(output, dim=1)
         # Return output and final hidden state
         return output, hidden
+
+    def forward_sequence(self, input_seq, last_hidden, output_layer=None):
+        #Teacher forcing: all input tokens are known, the RNN runs over the whole sequence in one call
+        #input_seq = [seq_len, batch_size]
+        #returns the raw scores of the output layer = [seq_len, batch_size, output_size] and the final hidden state
+        embedded = F.relu(self.embedding(input_seq))
+        output, hidden = self.rnn(embedded, last_hidden)
+        if output_layer is None:
+            output = self.out(output)
+        else:
+            output = F.linear(output, *output_layer)
+        return output, hidden
@@ -0,0 +1,78 @@
+import torch
+from torch import nn
+from torch.ao.quantization import quantize_dynamic
+
+from model.checkpoint import load_checkpoint
+from model.model import EncoderLSTM, DecoderLSTM
+from utils.tokenize import voc_to_words, voc_from_words
+
+"""
+Dynamic int8 quantization for CPU inference.
+The weights of the LSTM layers and of the output projection (DecoderLSTM.out) are stored as int8, activations are
+quantized on the fly. Embeddings stay in fp32. Quantized models only run on the CPU.
+"""
+
+QUANTIZED_MODULES = {nn.LSTM, nn.Linear}
+
+
+def quantize_model(model):
+    """
+    :param model: encoder or decoder in eval mode
+    :return: dynamically quantized copy of the model
+    """
+    return quantize_dynamic(model, QUANTIZED_MODULES, dtype=torch.qint8)
+
+
+def quantize_models(encoder, decoder):
+    """
+    :return: quantized copies of encoder and decoder (on the CPU, in eval mode)
+    """
+    encoder = quantize_model(encoder.cpu().eval())
+    decoder = quantize_model(decoder.cpu().eval())
+    return encoder, decoder
+
+
+def export_quantized_model(checkpoint_file, output_file):
+    """
+    Writes the quantized inference artifact for a training checkpoint
+    :param checkpoint_file: path to the training checkpoint
+    :param output_file: path of the artifact
+    :return: output_file
+    """
+    encoder, decoder, src_voc, trg_voc = load_checkpoint(checkpoint_file)
+    q_encoder, q_decoder = quantize_models(encoder, decoder)
+    torch.save({
+        'en': q_encoder.state_dict(),
+        'de': q_decoder.state_dict(),
+        'src_name': src_voc.name,
+        'trg_name': trg_voc.name,
+        'src_words': voc_to_words(src_voc),
+        'trg_words': voc_to_words(trg_voc),
+        'src_size': encoder.input_size,
+        'trg_size': decoder.output_size,
+        'emb_size': encoder.emb_size,
+        'n_layers': encoder.n_layers,
+        'hidden_size': encoder.hidden_size
+    }, output_file)
+    return output_file
+
+
+def load_quantized_model(artifact_file):
+    """
+    Loads the quantized inference artifact. The packed int8 weights are not plain tensors, so the file
+    can not be memory-mapped or loaded with weights_only=True: only load artifacts you exported yourself.
+    :param artifact_file: path to the artifact written by export_quantized_model
+    :return: quantized encoder, quantized decoder, source vocabulary, target vocabulary
+    """
+    artifact = torch.load(artifact_file, map_location="cpu", weights_only=False)
+    src_voc = voc_from_words(artifact['src_words'], artifact['src_name'])
+    trg_voc = voc_from_words(artifact['trg_words'], artifact['trg_name'])
+    # The quantized modules are built from fp32 models of the same shape, then the int8 weights are loaded
+    encoder = EncoderLSTM(artifact['src_size'], emb_size=artifact['emb_size'], hidden_size=artifact['hidden_size'],
+                          n_layers=artifact['n_layers'])
+    decoder = DecoderLSTM(artifact['trg_size'], emb_size=artifact['emb_size'], hidden_size=artifact['hidden_size'],
+                          n_layers=artifact['n_layers'])
+    encoder, decoder = quantize_models(encoder, decoder)
+    encoder.load_state_dict(artifact['en'])
+    decoder.load_state_dict(artifact['de'])
+    return encoder, decoder, src_voc, trg_voc
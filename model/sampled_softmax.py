@@ -0,0 +1,58 @@
+import torch
+
+from utils.tokenize import PAD_token, SOS_token
+
+"""
+Sampled softmax for training the decoder output layer on large target vocabularies.
+Following Jean et al. (2015), "On Using Very Large Target Vocabulary for Neural Machine Translation", the softmax
+of a training batch is computed over a subset of the target vocabulary: all target words of the batch plus words
+sampled with probability ~ count^power. Only the rows of DecoderLSTM.out belonging to the subset are multiplied
+and updated. The full output layer is unchanged, validation, test and inference use the full softmax.
+The logits of the sampled words which are not targets of the batch are corrected by the log of their expected count
+in the sample (log-Q correction), so that frequent words are not favoured for being sampled more often. With enough
+samples every word is drawn, the corrections go to 0 and the loss approaches the full softmax cross entropy.
+"""
+
+
+class SampledSoftmax:
+    """
+    Draws the candidate words of a training batch
+    """
+    def __init__(self, counts, n_samples=1024, power=0.75, seed=1):
+        """
+        :param counts: word counts ordered by index, e.g. Voc.counts of the target vocabulary
+        :param n_samples: number of sampled words per batch (with replacement, duplicates are merged)
+        :param power: smoothing of the count distribution, 1 samples proportionally to the counts
+        :param seed: seed of the sampling
+        """
+        weights = torch.tensor(counts, dtype=torch.double).clamp(min=0) ** power
+        if weights.sum() == 0:
+            # No counts available (e.g. vocabulary loaded from a word list): uniform sampling
+            weights.fill_(1.)
+        # PAD and SOS are never predicted
+        weights[PAD_token] = 0
+        weights[SOS_token] = 0
+        self.weights = weights
+        self.n_samples = n_samples
+        # Log of the expected count of every word in the merged sample, i.e. the probability to be drawn at least once
+        # in n_samples draws: log(1 - (1 - q)^n_samples), -inf for PAD and SOS
+        q = weights / weights.sum()
+        self.log_expected_counts = torch.log(-torch.expm1(n_samples * torch.log1p(-q))).float()
+        self.generator = torch.Generator().manual_seed(seed)
+
+    def candidates(self, target_variable):
+        """
+        :param target_variable: batched target tensor, shape = (max_target_len, batch_size)
+        :return: sorted candidate word indexes, shape = (n_candidates,), the target tensor expressed as
+            positions in the candidates (to be used as targets of the restricted logits) and the log-Q correction to
+            subtract from the logits of the candidates, shape = (n_candidates,), 0 for the target words of the batch
+        """
+        sampled = torch.multinomial(self.weights, self.n_samples, replacement=True, generator=self.generator)
+        words, positions = torch.unique(torch.cat([target_variable.flatten().cpu(), sampled]), return_inverse=True)
+        target_positions = positions[:target_variable.numel()]
+        is_target = torch.zeros(words.numel(), dtype=torch.bool)
+        is_target[target_positions] = True
+        correction = self.log_expected_counts[words].masked_fill(is_target, 0.)
+        targets = target_positions.view_as(target_variable)
+        device = target_variable.device
+        return words.to(device), targets.to(device), correction.to(device)
@@ -0,0 +1,96 @@
+from typing import Tuple
+
+import torch
+import torch.nn.functional as F
+from torch import nn, Tensor
+
+from utils.tokenize import SOS_token, EOS_token, PAD_token, voc_to_words, voc_from_words
+
+"""
+TorchScript version of the greedy inference (encoder + GreedySearchDecoder loop) for LSTM models.
+The scripted module is stored together with the vocabularies, it can be loaded with torch.jit.load
+without the Python model classes.
+"""
+
+
+class ScriptGreedySearch(nn.Module):
+    """
+    Same computation as GreedySearchDecoder with EncoderLSTM/DecoderLSTM in eval mode, written with explicit types,
+    so that the whole decoding loop can be compiled with torch.jit.script
+    """
+    def __init__(self, encoder, decoder):
+        super(ScriptGreedySearch, self).__init__()
+        if encoder.cell_type != "lstm" or decoder.cell_type != "lstm":
+            raise AttributeError("Only LSTM models can be scripted!")
+        self.enc_embedding = encoder.embedding
+        self.enc_rnn = encoder.rnn
+        self.dec_embedding = decoder.embedding
+        self.dec_rnn = decoder.rnn
+        self.out = decoder.out
+        self.sos_token = SOS_token
+        self.eos_token = EOS_token
+        self.pad_token = PAD_token
+
+    def encode(self, input_seq: Tensor, input_length: Tensor) -> Tuple[Tensor, Tensor]:
+        # Dropout is not applied in eval mode, the encoder outputs are not needed
+        embedded = self.enc_embedding(input_seq)
+        packed = torch.nn.utils.rnn.pack_padded_sequence(embedded, input_length)
+        _, hidden = self.enc_rnn(packed)
+        return hidden
+
+    def forward(self, input_seq: Tensor, input_length: Tensor, max_length: int) -> Tuple[Tensor, Tensor]:
+        batch_size = input_seq.size(1)
+        device = input_seq.device
+        decoder_hidden = self.encode(input_seq, input_length)
+
+        all_tokens = torch.full((max_length, batch_size), self.pad_token, device=device, dtype=torch.long)
+        all_scores = torch.zeros(max_length, batch_size, device=device)
+        decoder_input = torch.full((1, batch_size), self.sos_token, device=device, dtype=torch.long)
+        finished = torch.zeros(batch_size, device=device, dtype=torch.bool)
+        steps = 0
+        for t in range(max_length):
+            embedded = F.relu(self.dec_embedding(decoder_input))
+            output, decoder_hidden = self.dec_rnn(embedded, decoder_hidden)
+            logits = self.out(output.squeeze(0))
+            scores, tokens = torch.max(logits, dim=1)
+            scores = torch.exp(scores - torch.logsumexp(logits, dim=1))
+            all_tokens[t] = tokens.masked_fill(finished, self.pad_token)
+            all_scores[t] = scores.masked_fill(finished, 0.)
+            finished = finished | (all_tokens[t] == self.eos_token)
+            steps = t + 1
+            if bool(finished.all()):
+                break
+            decoder_input = all_tokens[t:t + 1]
+        return all_tokens[:steps].t(), all_scores[:steps].t()
+
+
+def script_greedy_search(encoder, decoder):
+    """
+    :return: scripted greedy search for the given (eval mode) encoder and decoder
+    """
+    return torch.jit.script(ScriptGreedySearch(encoder, decoder).eval())
+
+
+def save_scripted(module, src_voc, trg_voc, path):
+    """
+    Saves a scripted searcher together with the vocabularies (as word lists)
+    """
+    extra_files = {"src_words": voc_to_words(src_voc),
+                   "trg_words": voc_to_words(trg_voc),
+                   "src_name": src_voc.name,
+                   "trg_name": trg_voc.name}
+    torch.jit.save(module, path, _extra_files=extra_files)
+    return path
+
+
+def load_scripted(path, map_location=None):
+    """
+    :return: scripted searcher, source vocabulary, target vocabulary
+    """
+    extra_files = {"src_words": "", "trg_words": "", "src_name": "", "trg_name": ""}
+    module = torch.jit.load(path, map_location=map_location, _extra_files=extra_files)
+    extra_files = {key: value.decode("utf-8") if isinstance(value, bytes) else value
+                   for key, value in extra_files.items()}
+    src_voc = voc_from_words(extra_files["src_words"], extra_files["src_name"])
+    trg_voc = voc_from_words(extra_files["trg_words"], extra_files["trg_name"])
+    return module, src_voc, trg_voc
@@ -1,15 +1,20 @@
 import argparse
 import os
 import random
+import sys
 from datetime import datetime
 import torch
 from torch import optim
 
 from experiment.train_eval import evaluateInput, GreedySearchDecoder, trainIters, eval_batch, plot_training_results
-from global_settings import device, FILENAME, SAVE_DIR, PREPRO_DIR, TRAIN_FILE, TEST_FILE, EXPERIMENT_DIR, LOG_FILE
+from global_settings import device, FILENAME, SAVE_DIR, PREPRO_CACHE_DIR, TRAIN_FILE, TEST_FILE, EXPERIMENT_DIR, LOG_FILE
 from model.model import EncoderLSTM, DecoderLSTM
-from utils.prepro import read_lines, preprocess_pipeline, load_cleaned_data, save_clean_data
+from utils.prepro import preprocessing_params, load_or_preprocess, iter_lines, iter_preprocessed
+from utils.cache import cache_key
 from utils.tokenize import build_vocab, batch2TrainData
+from utils.batching import bucket_batches, tensorize
+from utils.corpus import is_encoded_corpus, load_encoded_corpus, save_encoded_corpus, stream_encoded_corpus
+from utils.distributed import init_distributed, is_main_process, is_local_main_process, barrier, broadcast_parameters
 
 from global_settings import DATA_DIR
 from utils.utils import split_data, filter_pairs, max_length, plot_grad_flow
@@ -82,12 +87,20 @@ if __name__ == '__main__':
     parser.add_argument('--voc_all', type=str2bool, default="False",
                         help="Get vocabulary from all dataset (true) or only from training data (false).\n"
                              "Possible inputs: 'yes', 'true', 't', 'y', '1' OR 'no', 'false', 'f', 'n', '0'")
+    ### Vocabulary trimming ###
+    parser.add_argument('--min_count', type=int, default=1, help='minimum count of a vocabulary word, rarer words are mapped to <UNK>')
+    parser.add_argument('--max_vocab', type=int, default=0, help='maximum vocabulary size (special tokens included), the most frequent words are kept. 0 for no limit')
+    ### Sampled softmax ###
+    parser.add_argument('--sampled_softmax', type=int, default=0, help='train the decoder output layer with a sampled softmax over the batch target words and N sampled words. 0 for the full softmax. Evaluation always uses the full softmax')
 
     ### Truncated Backprop through time ###
     parser.add_argument('--tbptt', type=str2bool, default="True",
                         help="Set how to perform truncation in backpropagation. If 'true', every time 'detach()' is applied on the hidden states. "
                              "If 'false', 'detach()' is not applied.\n"
                              "Possible inputs: 'yes', 'true', 't', 'y', '1' OR 'no', 'false', 'f', 'n', '0'")
+    parser.add_argument('--tbptt_k', type=int, default=0, help="with --tbptt, backpropagate every K decoder steps and detach the hidden states in between: the activation memory grows with K instead of the target length. 0 for the detach at every step (only without teacher forcing)")
+    ### Mixed precision ###
+    parser.add_argument('--mixed_precision', type=str2bool, default="False", help="train and validate with bfloat16 autocast: matrix products and LSTM layers in bfloat16, weights, optimizer states and losses in fp32. The test loss is computed in fp32")
     ### Dropout ###
     parser.add_argument('--dropout', type=float, default=0.1,
                         help='dropout applied to layers (0.0 = no dropout). Values range allowed: [0.0 - 1.0]')
@@ -100,6 +113,22 @@ if __name__ == '__main__':
     parser.add_argument('--log_interval', type=int, default=100, help='report interval')
 
     parser.add_argument('--max_len', type=int, default=0, help='max sentence length in the dataset. Sentences longer than max_len are trimmed. Provide 0 for no trimming!')
+    parser.add_argument('--prepro_workers', type=int, default=1, help='number of processes preprocessing the dataset (only if it has not been preprocessed yet)')
+    parser.add_argument('--stream', type=str2bool, default="False",
+                        help="Read, preprocess, split, count and encode the dataset in a single streaming pass (true), for datasets larger than memory, or load it as a whole (false).\n"
+                             "The split is drawn pair by pair, so it differs from the non-streaming one.\n"
+                             "Possible inputs: 'yes', 'true', 't', 'y', '1' OR 'no', 'false', 'f', 'n', '0'")
+
+    ### Batch production ###
+    parser.add_argument('--bucket', type=str2bool, default="False",
+                        help="Build batches of sentences with similar lengths (true) or of random sentences (false).\n"
+                             "Possible inputs: 'yes', 'true', 't', 'y', '1' OR 'no', 'false', 'f', 'n', '0'")
+    parser.add_argument('--max_tokens', type=int, default=0, help='token budget per batch (sentences x longest sentence), used with --bucket True instead of --batch_size. 0 uses --batch_size')
+    parser.add_argument('--workers', type=int, default=1, help='number of background workers building the batches. 0 builds them in the training loop')
+    parser.add_argument('--prefetch', type=int, default=4, help='number of batches built ahead of the training loop')
+    parser.add_argument('--worker_processes', type=str2bool, default="False",
+                        help="Build the batches in worker processes (true) or threads (false).\n"
+                             "Possible inputs: 'yes', 'true', 't', 'y', '1' OR 'no', 'false', 'f', 'n', '0'")
 
 
     #### Start #####
@@ -107,6 +136,9 @@ if __name__ == '__main__':
     # Read arguments
     args = parser.parse_args()
 
+    # Distributed training when started with torchrun (more than one process): only the main process prints
+    rank, world_size = init_distributed()
+
     print("Expreiment settings:")
     for arg in vars(args):
         print(arg, getattr(args, arg))
@@ -127,65 +159,102 @@ if __name__ == '__main__':
 
     voc_all = args.voc_all
 
-    ### Setup preprocessing file ####
+    # Distributed training: the first process of every machine fills the preprocessing cache, the others wait for it
+    if not is_local_main_process():
+        barrier()
+
+    ### Setup preprocessing cache ####
+    # Entries are addressed by the content of the data file and all preprocessing parameters:
+    # cleaned pairs in <key>.pkl, vocabularies and data split as encoded corpus in <key>/
 
     max_sent_len = args.max_len
-    if max_sent_len > 0:
-        cleaned_file =  "%s-%s_cleaned" % (src_lang, trg_lang) + "_{}".format(max_sent_len) +".pkl"
+    source_file = os.path.join(start_root, DATA_DIR, FILENAME)
+    prepro_params = preprocessing_params(source_file, exp_contraction, max_len=max_sent_len)
+    corpus_params = {"prepro_key": cache_key(prepro_params), "src_lang": src_lang, "trg_lang": trg_lang,
+                     "limit": limit, "seed": args.seed, "voc_all": voc_all, "stream": args.stream,
+                     "min_count": args.min_count, "max_vocab": args.max_vocab}
+    encoded_dir = os.path.join(PREPRO_CACHE_DIR, cache_key(corpus_params))
+
+    if args.stream and not is_encoded_corpus(encoded_dir):
+        print("Streaming %s into encoded corpus %s...." % (source_file, encoded_dir))
+        stream_encoded_corpus(encoded_dir, iter_preprocessed(iter_lines(*os.path.split(source_file)), exp_contraction,
+                                                             max_len=max_sent_len, num_workers=args.prepro_workers),
+                              src_lang, trg_lang, limit=limit, seed=args.seed, voc_all=voc_all,
+                              min_count=args.min_count, max_size=args.max_vocab or None, params=corpus_params)
+
+    if is_encoded_corpus(encoded_dir):
+        print("Encoded corpus found in cache! Loading %s...." % encoded_dir)
+        input_lang, output_lang, splits, n_pairs = load_encoded_corpus(encoded_dir)
+        train_set, val_set, test_set = splits["train"], splits["val"], splits["test"]
+        print("Data in train set:", len(train_set))
+        print("Data in val set:", len(val_set))
+        print("Data in test set:", len(test_set))
+
+        # Lengths in words, without EOS
+        voc_splits = [train_set, val_set] if voc_all else [train_set]
+        max_src_l = [max(int(split.lengths()[0].max()) for split in voc_splits) - 1]
+        max_trg_l = [max(int(split.lengths()[1].max()) for split in voc_splits) - 1]
+        print("Max sentence length in source sentences:", max_src_l)
+        print("Max sentence length in source sentences:", max_trg_l)
     else:
-        cleaned_file = "%s-%s_cleaned" % (src_lang, trg_lang) + "_full" + ".pkl"
+        pairs, _ = load_or_preprocess(source_file, exp_contraction, max_len=max_sent_len,
+                                      num_workers=args.prepro_workers, params=prepro_params)
 
-    ### Check if data has already been preprocessed, if not, preprocess it ####
+        ### Get sample ###
+        print("Sample from data:")
+        print(random.choice(pairs))
 
-    if os.path.isfile(os.path.join(PREPRO_DIR, cleaned_file)):
-        print("File already preprocessed! Loading file....")
-        pairs = load_cleaned_data(PREPRO_DIR, filename=cleaned_file)
-    else:
-        print("No preprocessed file found. Starting data preprocessing...")
-        pairs = read_lines(os.path.join(start_root, DATA_DIR), FILENAME)
-        pairs, path = preprocess_pipeline(pairs, cleaned_file, exp_contraction, max_len = max_sent_len) #data/prepro/eng-deu_cleaned_full.pkl
+        src_sents, trg_sents = [], []
 
-    ### Get sample ###
-    print("Sample from data:")
-    print(random.choice(pairs))
 
-    src_sents, trg_sents = [], []
+        if limit:
+            pairs = pairs[:limit]
+            print("Limit set: %s" % str(limit))
 
+        train_set, val_set, test_set = split_data(pairs, seed=args.seed)
+        print("Data in train set:", len(train_set))
+        print("Data in val set:", len(val_set))
+        print("Data in test set:", len(test_set))
 
-    if limit:
-        pairs = pairs[:limit]
-        print("Limit set: %s" % str(limit))
+        print("Building vocabularies...")
 
-    train_set, val_set, test_set = split_data(pairs, seed=args.seed)
-    print("Data in train set:", len(train_set))
-    print("Data in val set:", len(val_set))
-    print("Data in test set:", len(test_set))
+        if voc_all:
+            train_data = train_set + val_set
+        else:
+            train_data = train_set
 
-    print("Building vocabularies...")
+        src_sents = [item[0] for item in train_data]
+        trg_sents = [item[1] for item in train_data]
 
-    if voc_all:
-        train_data = train_set + val_set
-    else:
-        train_data = train_set
+        max_src_l = max_length(src_sents)
+        max_trg_l = max_length(trg_sents)
 
-    src_sents = [item[0] for item in train_data]
-    trg_sents = [item[1] for item in train_data]
+        print("Max sentence length in source sentences:", max_src_l)
+        print("Max sentence length in source sentences:", max_trg_l)
 
-    max_src_l = max_length(src_sents)
-    max_trg_l = max_length(trg_sents)
+        input_lang = build_vocab(src_sents, "eng", args.min_count, args.max_vocab or None)
+        output_lang = build_vocab(trg_sents, "deu", args.min_count, args.max_vocab or None)
 
-    print("Max sentence length in source sentences:", max_src_l)
-    print("Max sentence length in source sentences:", max_trg_l)
+        n_pairs = len(pairs)
+        print("Storing encoded corpus in %s...." % encoded_dir)
+        splits = save_encoded_corpus(encoded_dir, input_lang, output_lang,
+                                     {"train": train_set, "val": val_set, "test": test_set}, n_pairs=n_pairs,
+                                     params=corpus_params)
+        train_set, val_set, test_set = splits["train"], splits["val"], splits["test"]
 
-    input_lang = build_vocab(src_sents, "eng")
-    output_lang = build_vocab(trg_sents, "deu")
+    if is_local_main_process():
+        barrier()
 
     print("Source vocabulary:", input_lang.num_words)
     print("Target vocabulary:", output_lang.num_words)
 
     ### test should translate - TODO: Remove this
-    test_batches = [batch2TrainData(input_lang, output_lang, [test_set[i]])
-                        for i in range(len(test_set))]
+    if args.bucket:
+        test_batches = [tensorize(input_lang, output_lang, pair_batch) for pair_batch in
+                        bucket_batches(test_set, args.batch_size, args.max_tokens, shuffle=False)]
+    else:
+        test_batches = [tensorize(input_lang, output_lang, [test_set[i]])
+                            for i in range(len(test_set))]
 
 
     print("Test batches:", len(test_batches))
@@ -215,11 +284,15 @@ if __name__ == '__main__':
 
     optimizer = "adam"
     model_name = ''
-    model_name += 'simple_nmt_model' + str(limit) if limit else 'simple_nmt_model_full_' + str(len(pairs))
+    model_name += 'simple_nmt_model' + str(limit) if limit else 'simple_nmt_model_full_' + str(n_pairs)
     model_name += "_teacher_{}".format(str(teacher_forcing_ratio)) if teacher_forcing_ratio > 0.0 else "_no_teacher"
     model_name += "" if voc_all else "_train_voc"
     model_name += "_clip-{}".format(clip) if clip else ""
-    model_name += "_tbptt" if tbptt else ""
+    model_name += ("_tbptt-{}".format(args.tbptt_k) if args.tbptt_k else "_tbptt") if tbptt else ""
+    model_name += ("_bucket-{}".format(args.max_tokens) if args.max_tokens else "_bucket") if args.bucket else ""
+    model_name += "_sampled-{}".format(args.sampled_softmax) if args.sampled_softmax else ""
+    model_name += "_bf16" if args.mixed_precision else ""
+    model_name += "_dist-{}".format(world_size) if world_size > 1 else ""
     model_name += "_"+optimizer
     model_name += "_lr-{}-{}".format(learning_rate, decoder_learning_ratio)
 
@@ -235,6 +308,8 @@ if __name__ == '__main__':
 
     encoder = encoder.to(device)
     decoder = decoder.to(device)
+    # Distributed training: all processes start from the weights of the main process
+    broadcast_parameters([encoder, decoder])
     print('Models built:')
     print(encoder)
     print(decoder)
@@ -252,12 +327,20 @@ if __name__ == '__main__':
     val_loss, directory, train_history, val_statistics, _, _ = \
         trainIters(model_name, input_lang, output_lang, train_set, val_set, encoder, decoder, encoder_optimizer,
                    decoder_optimizer, encoder_n_layers, decoder_n_layers, SAVE_DIR, n_iteration, batch_size,
-                   print_every, save_every, clip, FILENAME, val_iteration, tbptt=tbptt)
+                   print_every, save_every, clip, FILENAME, val_iteration, tbptt=tbptt, seed=args.seed,
+                   num_workers=args.workers, prefetch=args.prefetch, use_processes=args.worker_processes,
+                   bucketing=args.bucket, max_tokens=args.max_tokens, sampled_softmax=args.sampled_softmax,
+                   teacher_forcing_ratio=teacher_forcing_ratio, tbptt_k=args.tbptt_k,
+                   mixed_precision=args.mixed_precision)
 
     end_time = datetime.now()
     duration = end_time-start_time
     print('Training duration: {}'.format(duration))
 
+    # Distributed training: test evaluation, logs and plots only in the main process
+    if not is_main_process():
+        sys.exit()
+
     print("Performing evaluation on test set...")
     test_loss = eval_batch(test_batches, encoder, decoder, 1)
     print("Test loss:", test_loss)
@@ -276,7 +359,7 @@ if __name__ == '__main__':
             hf.write(model_name)
             hf.write("\nDirectory:\n")
             hf.write(str(directory))
-            hf.write("\n Number of samples: %s" %str(len(pairs)))
+            hf.write("\n Number of samples: %s" %str(n_pairs))
             if voc_all:
                 hf.write("\nVocabularies built on all dataset")
             else:
@@ -0,0 +1,218 @@
+"""
+Local HTTP translation service.
+Loads the checkpoint once and merges the sentences of concurrent requests into micro-batches, which are translated
+with a single GreedySearchDecoder pass. A batch is flushed as soon as it reaches --max_batch sentences or its
+oldest sentence has waited --max_wait milliseconds.
+
+Endpoints:
+- POST /translate with {"sentence": "..."} or {"sentences": ["...", ...]}, returns {"translations": [...]}
+- GET /stats: queue depth, batch size histogram, p50/p99 latency
+
+Example: curl -X POST localhost:8000/translate -d '{"sentence": "the train has left"}'
+"""
+import argparse
+import json
+import math
+import queue
+import threading
+import time
+from collections import Counter, deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from experiment.train_eval import GreedySearchDecoder, evaluate_batch
+from run_experiment import str2bool
+from translate import load_model
+from utils.cache import TranslationCache, checkpoint_id
+from utils.prepro import preprocess_sentence
+from utils.tokenize import EOS, PAD
+
+
+class _Pending:
+    """
+    A sentence waiting for its translation
+    """
+    def __init__(self, sentence):
+        self.sentence = sentence
+        # Arrival time, the batch deadline is counted from the oldest sentence of the batch
+        self.enqueued = time.monotonic()
+        self.translation = None
+        self.error = None
+        self.done = threading.Event()
+
+
+def percentile(values, q):
+    """
+    Nearest-rank percentile
+    :param values: sorted values
+    :param q: percentile in [0, 100]
+    :return: percentile or None if there are no values
+    """
+    if not values:
+        return None
+    rank = max(math.ceil(q / 100. * len(values)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+class MicroBatcher:
+    """
+    Collects sentences from concurrent requests in a queue. A single worker thread takes them out in batches of at
+    most max_batch_size sentences, waiting at most max_wait seconds for a batch to fill up.
+    """
+    def __init__(self, searcher, src_voc, trg_voc, max_batch_size=32, max_wait=0.01, cache=None, latency_window=10000):
+        self.searcher = searcher
+        self.src_voc = src_voc
+        self.trg_voc = trg_voc
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.cache = cache
+
+        self.batch_sizes = Counter()
+        self.latencies = deque(maxlen=latency_window)
+        self._stats_lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def translate(self, sentences):
+        """
+        Blocks until all sentences are translated
+        :param sentences: raw sentences
+        :return: translations, in the same order
+        """
+        start = time.monotonic()
+        pending = [_Pending(preprocess_sentence(sentence)) for sentence in sentences]
+        for item in pending:
+            self._queue.put(item)
+        for item in pending:
+            item.done.wait()
+            if item.error is not None:
+                raise item.error
+        with self._stats_lock:
+            self.latencies.append(time.monotonic() - start)
+        return [item.translation for item in pending]
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = batch[0].enqueued + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            with self._stats_lock:
+                self.batch_sizes[len(batch)] += 1
+            try:
+                decoded = evaluate_batch(self.searcher, self.src_voc, self.trg_voc, [item.sentence for item in batch],
+                                         cache=self.cache)
+                for item, output_words in zip(batch, decoded):
+                    output_words = [x for x in output_words if not (x == EOS or x == PAD)]
+                    item.translation = ' '.join(output_words)
+            except Exception as e:
+                for item in batch:
+                    item.error = e
+            for item in batch:
+                item.done.set()
+
+    def stats(self):
+        with self._stats_lock:
+            latencies = sorted(self.latencies)
+            histogram = dict(sorted(self.batch_sizes.items()))
+        p50, p99 = percentile(latencies, 50), percentile(latencies, 99)
+        stats = {"queue_depth": self._queue.qsize(),
+                 "batches": sum(histogram.values()),
+                 "batch_size_histogram": histogram,
+                 "requests": len(latencies),
+                 "latency_p50_ms": p50 * 1000 if p50 is not None else None,
+                 "latency_p99_ms": p99 * 1000 if p99 is not None else None}
+        if self.cache is not None:
+            stats["cache"] = self.cache.stats()
+        return stats
+
+
+class TranslationServer(ThreadingHTTPServer):
+    # Concurrent clients are expected, the default listen backlog of 5 connections would reset them
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def make_handler(batcher):
+
+    class TranslationHandler(BaseHTTPRequestHandler):
+
+        def _send_json(self, status, body):
+            data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self._send_json(200, batcher.stats())
+            else:
+                self._send_json(404, {"error": "Not found"})
+
+        def do_POST(self):
+            if self.path != "/translate":
+                self._send_json(404, {"error": "Not found"})
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length).decode("utf-8"))
+                sentences = body["sentences"] if "sentences" in body else [body["sentence"]]
+                if not isinstance(sentences, list):
+                    raise ValueError("Sentences must be a list of strings")
+                if not all(isinstance(sentence, str) for sentence in sentences):
+                    raise ValueError("Sentences must be strings")
+            except (ValueError, KeyError, TypeError) as e:
+                self._send_json(400, {"error": "Bad request: %s" % e})
+                return
+            try:
+                translations = batcher.translate(sentences)
+            except Exception as e:
+                self._send_json(500, {"error": str(e)})
+                return
+            self._send_json(200, {"translations": translations})
+
+        def log_message(self, format, *args):
+            # Keep the console quiet, statistics are available via /stats
+            pass
+
+    return TranslationHandler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='PyTorch Vanilla LSTM Machine Translator - HTTP service')
+    parser.add_argument('--path', type=str, default="", help='experiment path')
+    parser.add_argument('--host', type=str, default="127.0.0.1", help='host to bind to')
+    parser.add_argument('--port', type=int, default=8000, help='port to listen on')
+    parser.add_argument('--max_batch', type=int, default=32, help='maximum number of sentences per batch')
+    parser.add_argument('--max_wait', type=float, default=10., help='maximum waiting time of a batch in milliseconds')
+    parser.add_argument('--cache', type=int, default=0, help="Size of the LRU translation cache. 0 disables the cache")
+    parser.add_argument('--quantize', type=str2bool, default="False", help="Serve the dynamic int8 model (CPU only)")
+
+    args = parser.parse_args()
+
+    encoder, decoder, src_voc, trg_voc, experiment_dir, checkpoint_file = \
+        load_model(".", args.path if args.path != "" else None, quantize=args.quantize)
+    searcher = GreedySearchDecoder(encoder, decoder)
+    cache = TranslationCache(args.cache, model_id=checkpoint_id(checkpoint_file)) if args.cache > 0 else None
+    batcher = MicroBatcher(searcher, src_voc, trg_voc, max_batch_size=args.max_batch, max_wait=args.max_wait / 1000.,
+                           cache=cache)
+
+    server = TranslationServer((args.host, args.port), make_handler(batcher))
+    print("Serving translations of %s on http://%s:%d" % (experiment_dir, args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Shutting down...")
+        server.server_close()
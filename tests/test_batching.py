@@ -0,0 +1,15 @@
+import pytest
+
+from utils.batching import sample_bucket_batches
+
+
+def test_sample_bucket_batches_empty_pairs():
+    with pytest.raises(ValueError):
+        next(sample_bucket_batches([], n_batches=3, batch_size=2))
+
+
+def test_sample_bucket_batches_count():
+    pairs = [("a b", "c"), ("a", "b c d"), ("a b c", "d e")]
+    batches = list(sample_bucket_batches(pairs, n_batches=5, batch_size=2))
+    assert len(batches) == 5
+    assert all(1 <= len(batch) <= 2 for batch in batches)
@@ -0,0 +1,41 @@
+import torch
+import torch.nn.functional as F
+
+from model.sampled_softmax import SampledSoftmax
+from utils.tokenize import PAD_token
+
+
+### Zipf distributed counts of a vocabulary of 200 words
+counts = (1000. / torch.arange(1, 201)).tolist()
+
+
+def sampled_loss(logits, targets, n_samples, seed, correct=True):
+    sampler = SampledSoftmax(counts, n_samples, seed=seed)
+    words, positions, correction = sampler.candidates(targets)
+    restricted = logits[words] - correction if correct else logits[words]
+    return F.cross_entropy(restricted.expand(positions.numel(), -1), positions.flatten()).item()
+
+
+def test_candidates_contain_targets():
+    targets = torch.tensor([[5, 7], [9, PAD_token]])
+    words, positions, correction = SampledSoftmax(counts, 50, seed=1).candidates(targets)
+    assert torch.equal(words[positions], targets)
+    assert correction.shape == words.shape
+    # No correction for the target words of the batch
+    assert torch.all(correction[positions.flatten()] == 0)
+
+
+def test_loss_approaches_full_cross_entropy():
+    torch.manual_seed(1)
+    logits = torch.randn(len(counts)) * 2
+    targets = torch.randint(2, len(counts), (8, 4))
+    full = F.cross_entropy(logits.expand(targets.numel(), -1), targets.flatten()).item()
+    errors = []
+    for n_samples in (20, 200, 2000, 20000):
+        mean_loss = sum(sampled_loss(logits, targets, n_samples, seed) for seed in range(10)) / 10
+        errors.append(abs(mean_loss - full))
+    assert errors == sorted(errors, reverse=True)
+    assert errors[-1] < 1e-3 * full
+    # The correction reduces the bias of the loss with few samples
+    uncorrected = sum(sampled_loss(logits, targets, 200, seed, correct=False) for seed in range(10)) / 10
+    assert errors[1] < abs(uncorrected - full)
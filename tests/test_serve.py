@@ -0,0 +1,44 @@
+import queue
+import time
+
+from serve import MicroBatcher, _Pending, percentile
+
+
+def test_percentile_empty():
+    assert percentile([], 50) is None
+
+
+def test_percentile_odd_length():
+    values = [1, 2, 3, 4, 5]
+    assert percentile(values, 50) == 3
+    assert percentile(values, 0) == 1
+    assert percentile(values, 20) == 1
+    assert percentile(values, 21) == 2
+    assert percentile(values, 99) == 5
+    assert percentile(values, 100) == 5
+
+
+def test_percentile_single_value():
+    assert percentile([7], 50) == 7
+    assert percentile([7], 99) == 7
+
+
+def test_percentile_even_length():
+    values = [1, 2, 3, 4]
+    assert percentile(values, 50) == 2
+    assert percentile(values, 75) == 3
+    assert percentile(values, 99) == 4
+
+
+def test_next_batch_deadline_from_oldest_sentence():
+    # Without the worker thread, so that the queue is only read by _next_batch
+    batcher = MicroBatcher.__new__(MicroBatcher)
+    batcher.max_batch_size, batcher.max_wait = 32, 0.5
+    batcher._queue = queue.Queue()
+    item = _Pending("old sentence")
+    item.enqueued -= 1.
+    batcher._queue.put(item)
+    start = time.monotonic()
+    assert batcher._next_batch() == [item]
+    # The oldest sentence waited longer than max_wait already: the batch is flushed without waiting
+    assert time.monotonic() - start < 0.25
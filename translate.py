@@ -5,20 +5,27 @@ experiment/checkpoints/simple_nmt_model30000/deu.txt/1-1_256
 """
 import argparse
 import os
-import torch
-from torch import nn, optim
-
-from experiment.train_eval import GreedySearchDecoder, evaluateInput
-from global_settings import EXPERIMENT_DIR, LOG_FILE, device, DOCU_DIR, SAMPLES_FILE
-from model.model import EncoderLSTM, DecoderLSTM
+import time
+
+from experiment.train_eval import GreedySearchDecoder, BeamSearchDecoder, evaluateInput, translate_stream
+from global_settings import EXPERIMENT_DIR, LOG_FILE, device, DOCU_DIR, SAMPLES_FILE, INFERENCE_FILE, SCRIPT_FILE, \
+    QUANTIZED_FILE, QUANTIZED_SCRIPT_FILE
+from model.checkpoint import load_checkpoint, load_inference_model
+from model.quantize import load_quantized_model, quantize_models
+from model.script import load_scripted
 from run_experiment import str2bool
-from utils.tokenize import Voc
+from utils.cache import TranslationCache, checkpoint_id
 
 
 samples = os.path.join(".", DOCU_DIR, SAMPLES_FILE)
 
-def translate(start_root, path=None, read_from_file=False):
-    # start_root = "."
+def find_checkpoint(start_root, path=None):
+    """
+    Finds the last checkpoint of an experiment
+    :param start_root: root directory
+    :param path: experiment path. If not given, the last experiment in last_experiment.txt is used
+    :return: experiment path, checkpoint file
+    """
 
     print("Reading experiment information from: ")
     if not path:
@@ -56,69 +63,109 @@ def translate(start_root, path=None, read_from_file=False):
     last_checkpoint = checkpoints[-1]
    # print(os.path.join(start_root, experiment_path[0], last_checkpoint))
 
-    # Load model
-    checkpoint = torch.load(os.path.join(start_root, experiment_path[0], last_checkpoint))
-    # assert checkpoint
-
-    enc = checkpoint['en']
-    dec = checkpoint['de']
-    src_vocab = checkpoint['src_dict']
-    trg_vocab = checkpoint['tar_dict']
-    src_emb = checkpoint['src_embedding']
-    trg_emb = checkpoint['trg_embedding']
-    enc_optimizer = checkpoint['en_opt']
-    dec_optimzier = checkpoint['de_opt']
-    layers = checkpoint['n_layers']
-    hidden_size = checkpoint['hidden_size']
-
-    src_voc = Voc("eng")
-    trg_voc = Voc("deu")
-
-    src_voc.__dict__ = src_vocab
-    trg_voc.__dict__ = trg_vocab
-
-    input_size = src_voc.num_words
-    output_size = trg_voc.num_words
-
-    emb_dim = src_emb['weight'].shape[1]
-
-    src_embedding = nn.Embedding(input_size, emb_dim, _weight=src_emb['weight'])
-    trg_embedding = nn.Embedding(output_size, emb_dim, _weight=trg_emb['weight'])
-
-    encoder = EncoderLSTM(input_size, emb_size=emb_dim, hidden_size=hidden_size, n_layers=layers)
-    decoder = DecoderLSTM(output_size, emb_size=emb_dim, hidden_size=hidden_size, n_layers=layers)
+    return experiment_path[0], os.path.join(start_root, experiment_path[0], last_checkpoint)
+
+
+def _is_up_to_date(artifact_file, checkpoint_file):
+    return os.path.isfile(artifact_file) and os.path.getmtime(artifact_file) >= os.path.getmtime(checkpoint_file)
+
+
+def load_model(start_root, path=None, quantize=False):
+    """
+    Loads the last checkpoint of an experiment
+    :param start_root: root directory
+    :param path: experiment path. If not given, the last experiment in last_experiment.txt is used
+    :param quantize: if True, the dynamic int8 model is loaded (CPU only)
+    :return: encoder, decoder, source vocabulary, target vocabulary, experiment path, checkpoint file
+    """
+    experiment_dir, checkpoint_file = find_checkpoint(start_root, path)
+
+    # Load model, preferably from the slim inference artifacts (see export_model.py) if they are up to date
+    start_time = time.perf_counter()
+    artifact_file = os.path.join(start_root, experiment_dir, INFERENCE_FILE)
+    quantized_file = os.path.join(start_root, experiment_dir, QUANTIZED_FILE)
+    if quantize and _is_up_to_date(quantized_file, checkpoint_file):
+        checkpoint_file = quantized_file
+        encoder, decoder, src_voc, trg_voc = load_quantized_model(quantized_file)
+    elif _is_up_to_date(artifact_file, checkpoint_file):
+        checkpoint_file = artifact_file
+        encoder, decoder, src_voc, trg_voc = load_inference_model(artifact_file)
+    else:
+        encoder, decoder, src_voc, trg_voc = load_checkpoint(checkpoint_file)
 
-    encoder.load_state_dict(enc)
-    decoder.load_state_dict(dec)
+    if quantize:
+        if checkpoint_file != quantized_file:
+            # No exported int8 model, quantize now
+            encoder, decoder = quantize_models(encoder, decoder)
+    else:
+        encoder = encoder.to(device)
+        decoder = decoder.to(device)
 
-    encoder_optimizer = optim.Adam(encoder.parameters())
-    decoder_optimizer = optim.Adam(decoder.parameters())
+    encoder.eval()
+    decoder.eval()
+    print("Model loaded from %s in %.3f s" % (checkpoint_file, time.perf_counter() - start_time))
+
+    return encoder, decoder, src_voc, trg_voc, experiment_dir, checkpoint_file
+
+
+def load_scripted_model(start_root, path=None, quantize=False):
+    """
+    Loads the TorchScript greedy searcher of an experiment (see export_model.py --script)
+    :param quantize: if True, the searcher of the dynamic int8 model is loaded (see export_model.py --quantize)
+    :return: scripted searcher, source vocabulary, target vocabulary, experiment path, script file
+    """
+    experiment_dir, checkpoint_file = find_checkpoint(start_root, path)
+    script_file = os.path.join(start_root, experiment_dir, QUANTIZED_SCRIPT_FILE if quantize else SCRIPT_FILE)
+    if not os.path.isfile(script_file):
+        print("No TorchScript model found in %s. Please run: python export_model.py --script True%s"
+              % (experiment_dir, " --quantize True" if quantize else ""))
+        exit(-1)
+    start_time = time.perf_counter()
+    searcher, src_voc, trg_voc = load_scripted(script_file, map_location="cpu" if quantize else device)
+    print("Model loaded from %s in %.3f s" % (script_file, time.perf_counter() - start_time))
+    return searcher, src_voc, trg_voc, experiment_dir, script_file
 
-    encoder_optimizer.load_state_dict(enc_optimizer)
-    decoder_optimizer.load_state_dict(dec_optimzier)
 
-    encoder = encoder.to(device)
-    decoder = decoder.to(device)
+def translate(start_root, path=None, read_from_file=False, beam_width=1, input_file=None, output_file=None,
+              batch_size=64, cache_size=0, use_script=False, quantize=False, mixed_precision=False):
+    # start_root = "."
+    if use_script:
+        if beam_width > 1:
+            print("The TorchScript model only supports greedy search, beam width is ignored")
+            beam_width = 1
+        encoder, decoder = None, None
+        searcher, src_voc, trg_voc, experiment_dir, checkpoint_file = load_scripted_model(start_root, path, quantize=quantize)
+    else:
+        encoder, decoder, src_voc, trg_voc, experiment_dir, checkpoint_file = load_model(start_root, path, quantize=quantize)
 
-    encoder.eval()
-    decoder.eval()
+        if beam_width > 1:
+            searcher = BeamSearchDecoder(encoder, decoder, beam_width=beam_width)
+        else:
+            searcher = GreedySearchDecoder(encoder, decoder, mixed_precision=mixed_precision)
 
-    searcher = GreedySearchDecoder(encoder, decoder)
+    # Translations depend on the checkpoint and on the searcher
+    cache = None
+    if cache_size > 0:
+        cache = TranslationCache(cache_size, model_id="{}:beam-{}{}".format(checkpoint_id(checkpoint_file), beam_width,
+                                                                           ":bf16" if mixed_precision else ""))
 
     print("Starting translation process...")
 
-    if read_from_file:
-        translations = open(samples, mode="r", encoding="utf-8").read().split("\n")
-        results = evaluateInput(encoder, decoder, searcher, src_voc, trg_voc, from_file = translations)
-        store_file = os.path.join(start_root, experiment_path[0], "translation_results.txt")
-        with open(store_file, mode="w", encoding="utf-8") as f:
-            f.write("Experiment: {}\n".format(experiment_path[0]))
-            for result in results:
+    if read_from_file or input_file:
+        source_file = input_file if input_file else samples
+        store_file = output_file if output_file else os.path.join(start_root, experiment_dir, "translation_results.txt")
+        # Lines are read lazily and written as soon as their window is translated
+        with open(source_file, mode="r", encoding="utf-8") as source, open(store_file, mode="w", encoding="utf-8") as f:
+            f.write("Experiment: {}\n".format(experiment_dir))
+            for result in translate_stream(searcher, src_voc, trg_voc, source, batch_size=batch_size, cache=cache):
                 f.write("{} > {}\n".format(result[0], result[1]))
         print("Translations stored in %s" %str(store_file))
 
     else:
-        evaluateInput(encoder, decoder, searcher, src_voc, trg_voc, from_file = read_from_file)
+        evaluateInput(encoder, decoder, searcher, src_voc, trg_voc, from_file = read_from_file, cache=cache)
+
+    if cache is not None:
+        print("Translation cache:", cache.stats())
 
 
 
@@ -130,7 +177,20 @@ if __name__ == '__main__':
     parser.add_argument('--path', type=str, default="",
                         help='experiment path')
     parser.add_argument('--file', type=str2bool, default="False", help="Translate from keyboard (False) or from samples file (True)")
+    parser.add_argument('--beam', type=int, default=1, help="Beam width. 1 uses the greedy searcher")
+    parser.add_argument('--input', type=str, default="", help="File to translate line by line (instead of the samples file)")
+    parser.add_argument('--output', type=str, default="", help="Where to store the translations of the file. "
+                                                               "Default: translation_results.txt in the experiment directory")
+    parser.add_argument('--batch_size', type=int, default=64, help="Number of sentences translated together from file")
+    parser.add_argument('--cache', type=int, default=0, help="Number of translations kept in the LRU translation cache. 0 disables the cache")
+    parser.add_argument('--script', type=str2bool, default="False", help="Use the TorchScript greedy searcher exported with export_model.py --script True")
+    parser.add_argument('--quantize', type=str2bool, default="False", help="Use the dynamic int8 model (CPU only). "
+                                                                            "Exported with export_model.py --quantize True, otherwise quantized after loading")
+    parser.add_argument('--mixed_precision', type=str2bool, default="False", help="Greedy search with bfloat16 autocast (weights stay in fp32)")
 
     args = parser.parse_args()
 
-    translate(".", path=args.path if args.path !="" else None, read_from_file=args.file)
+    translate(".", path=args.path if args.path !="" else None, read_from_file=args.file, beam_width=args.beam,
+              input_file=args.input if args.input != "" else None, output_file=args.output if args.output != "" else None,
+              batch_size=args.batch_size, cache_size=args.cache, use_script=args.script,
+              quantize=args.quantize, mixed_precision=args.mixed_precision)
@@ -0,0 +1,186 @@
+import random
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from utils.tokenize import batch2TrainData, encodedBatch2TrainData
+
+"""
+Lazy batch production for training and validation.
+The sentence pairs of every batch are drawn in the main process from a seeded random generator, so the batches only
+depend on the seed. Their tensorization (batch2TrainData) runs in background workers, a bounded number of batches
+ahead of the training loop.
+Pairs are either sentence pairs or pre-encoded pairs of index arrays (see utils.tokenize.encode_pairs).
+"""
+
+
+def sample_batches(pairs, batch_size, n_batches, seed):
+    """
+    Draws n_batches random batches of pairs (with replacement)
+    :param pairs: sentence pairs
+    :param batch_size: pairs per batch
+    :param n_batches: number of batches
+    :param seed: seed of the random generator used only by this sampler
+    :return: generator of lists of pairs
+    """
+    rng = random.Random(seed)
+    for _ in range(n_batches):
+        yield [rng.choice(pairs) for _ in range(batch_size)]
+
+
+class Shard:
+    """
+    Part of the pairs seen by one process in distributed training: every world_size-th pair, starting at rank.
+    The shards of the processes are disjoint and together cover all pairs. Pairs are not copied.
+    """
+    def __init__(self, pairs, rank, world_size):
+        """
+        :param pairs: sentence pairs, pre-encoded pairs or an EncodedCorpus
+        :param rank: index of the process
+        :param world_size: number of processes
+        """
+        self.pairs = pairs
+        self.indexes = range(rank, len(pairs), world_size)
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def __getitem__(self, i):
+        return self.pairs[self.indexes[i]]
+
+    def __iter__(self):
+        for i in self.indexes:
+            yield self.pairs[i]
+
+
+def _lengths(pair):
+    # Number of tokens of source and target, including EOS
+    if isinstance(pair[0], str):
+        return len(pair[0].split(" ")) + 1, len(pair[1].split(" ")) + 1
+    return len(pair[0]), len(pair[1])
+
+
+def bucket_batches(pairs, batch_size=64, max_tokens=None, seed=1, shuffle=True):
+    """
+    One pass over the pairs in batches of pairs with similar lengths.
+    The pairs are sorted by target and source length (ties in random order) and cut into batches, so that every batch
+    covers a narrow length bucket and little padding is needed.
+    :param pairs: sentence pairs
+    :param batch_size: pairs per batch, if max_tokens is not given
+    :param max_tokens: token budget per batch: number of pairs * length of the longest sentence (source or target,
+    including padding). A batch holds as many pairs as fit into the budget, but at least one
+    :param seed: seed of the random generator used only by this sampler
+    :param shuffle: shuffle the order of the batches, otherwise they are returned from short to long
+    :return: list of lists of pairs
+    """
+    rng = random.Random(seed)
+    keyed = [(_lengths(pair), rng.random(), pair) for pair in pairs]
+    keyed.sort(key=lambda item: (item[0][1], item[0][0], item[1]))
+
+    batches, batch, longest = [], [], 0
+    for (src_len, trg_len), _, pair in keyed:
+        new_longest = max(longest, src_len, trg_len)
+        full = (len(batch) + 1) * new_longest > max_tokens if max_tokens else len(batch) == batch_size
+        if batch and full:
+            batches.append(batch)
+            batch, new_longest = [], max(src_len, trg_len)
+        batch.append(pair)
+        longest = new_longest
+    if batch:
+        batches.append(batch)
+
+    if shuffle:
+        rng.shuffle(batches)
+    return batches
+
+
+def sample_bucket_batches(pairs, n_batches, batch_size=64, max_tokens=None, seed=1):
+    """
+    Draws n_batches length-bucketed batches. The pairs are bucketed again (with a new random order)
+    every time all batches of a pass have been used.
+    :return: generator of lists of pairs
+    :raises ValueError: if there are no pairs
+    """
+    produced, epoch = 0, 0
+    while produced < n_batches:
+        batches = bucket_batches(pairs, batch_size, max_tokens, seed=seed + epoch)
+        if not batches:
+            raise ValueError("Cannot draw batches from an empty set of pairs")
+        for batch in batches:
+            if produced == n_batches:
+                return
+            # batch2TrainData sorts the batch in place
+            yield list(batch)
+            produced += 1
+        epoch += 1
+
+
+def padding_statistics(batch):
+    """
+    :param batch: output of batch2TrainData
+    :return: number of real tokens and number of tokens including padding (source + target)
+    """
+    inp, lengths, output, mask, _, _ = batch
+    real = int(lengths.sum()) + int(mask.sum())
+    return real, inp.numel() + output.numel()
+
+
+### Vocabularies of a worker process, set once by the initializer instead of being sent with every batch
+_worker_vocs = None
+
+
+def _init_worker(src_voc, tar_voc):
+    global _worker_vocs
+    _worker_vocs = (src_voc, tar_voc)
+
+
+def tensorize(src_voc, tar_voc, pair_batch):
+    """
+    :return: batch2TrainData for sentence pairs, encodedBatch2TrainData for pre-encoded pairs
+    """
+    if isinstance(pair_batch[0][0], str):
+        return batch2TrainData(src_voc, tar_voc, pair_batch)
+    return encodedBatch2TrainData(pair_batch)
+
+
+def _tensorize_in_worker(pair_batch):
+    return tensorize(_worker_vocs[0], _worker_vocs[1], pair_batch)
+
+
+def prefetch_batches(src_voc, tar_voc, pair_batches, num_workers=1, prefetch=4, use_processes=False):
+    """
+    Tensorizes batches of pairs in background workers. Batches are returned in the order of pair_batches,
+    at most `prefetch` batches are built ahead.
+    :param src_voc: source vocabulary (not needed for pre-encoded pairs)
+    :param tar_voc: target vocabulary (not needed for pre-encoded pairs)
+    :param pair_batches: iterable of lists of pairs, e.g. sample_batches(...)
+    :param num_workers: number of worker threads/processes. 0 builds every batch when it is requested
+    :param prefetch: maximum number of batches built ahead
+    :param use_processes: use worker processes instead of threads
+    :return: generator of the outputs of batch2TrainData
+    """
+    if num_workers <= 0:
+        for pair_batch in pair_batches:
+            yield tensorize(src_voc, tar_voc, pair_batch)
+        return
+
+    if use_processes:
+        executor = ProcessPoolExecutor(num_workers, initializer=_init_worker, initargs=(src_voc, tar_voc))
+        build = _tensorize_in_worker
+    else:
+        executor = ThreadPoolExecutor(num_workers)
+        build = lambda pair_batch: tensorize(src_voc, tar_voc, pair_batch)
+
+    pending = deque()
+    try:
+        for pair_batch in pair_batches:
+            pending.append(executor.submit(build, pair_batch))
+            if len(pending) > prefetch:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        # Also reached if the consumer stops early, e.g. at the end of the training.
+        # The batches not started yet are cancelled by hand (shutdown(cancel_futures=True) needs Python 3.9)
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
@@ -0,0 +1,100 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+"""
+Caches used during preprocessing and inference.
+"""
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """
+    SHA-256 of the content of a file, read in chunks
+    :param path: path to the file
+    :param chunk_size: bytes read at a time
+    :return: hex digest
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_key(params, length=16):
+    """
+    Content address of a set of parameters: equal parameters give equal keys, independently of the dict order.
+    :param params: JSON serializable dict, e.g. file digests and preprocessing settings
+    :param length: number of hex characters of the key
+    :return: hex key
+    """
+    serialized = json.dumps(params, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()[:length]
+
+
+def checkpoint_id(path):
+    """
+    Identity of a checkpoint file: path, size and modification time.
+    A new checkpoint written at the same path gets a new identity.
+    :param path: path to the checkpoint file
+    :return: identity string
+    """
+    stat = os.stat(path)
+    return "{}:{}:{}".format(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
+class TranslationCache:
+    """
+    Bounded translation cache with LRU eviction.
+    Keys are the preprocessed sentence (output of preprocess_sentence), the search max length and the model identity,
+    values are the decoded words. The cache can be shared by different threads.
+    """
+    def __init__(self, maxsize=10000, model_id=""):
+        self.maxsize = maxsize
+        self.model_id = model_id
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _key(self, sentence, max_length):
+        return self.model_id, sentence, max_length
+
+    def get(self, sentence, max_length):
+        """
+        :return: a copy of the cached decoded words or None
+        """
+        key = self._key(sentence, max_length)
+        with self._lock:
+            words = self._entries.get(key)
+            if words is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return list(words)
+
+    def put(self, sentence, max_length, words):
+        key = self._key(sentence, max_length)
+        with self._lock:
+            self._entries[key] = tuple(words)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"size": len(self._entries), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions, "hit_rate": self.hits / lookups if lookups else 0.0}
@@ -0,0 +1,320 @@
+import json
+import os
+import random
+from itertools import islice
+
+import numpy as np
+
+from utils.tokenize import Voc, EOS_token, UNK_token, encode_pairs, voc_to_words, voc_from_words
+
+"""
+Binary, memory-mapped format of the encoded corpus.
+Every side of a split is stored as a flat int32 token array (all sentences, EOS included, one after the other)
+and an int64 offsets array: sentence i is tokens[offsets[i]:offsets[i + 1]].
+The arrays are memory-mapped when loaded: nothing is read or copied up front, pages are loaded on first use
+and shared by all processes (and runs) reading the same files.
+
+Directory layout:
+    corpus.json                         names of the languages and of the splits, number of pairs, parameters
+    src_vocab.txt, trg_vocab.txt        words ordered by index
+    src_counts.npy, trg_counts.npy      word counts ordered by index
+    <split>_src_tokens.npy, <split>_src_offsets.npy, <split>_trg_tokens.npy, <split>_trg_offsets.npy
+"""
+
+META_FILE = "corpus.json"
+
+
+class EncodedCorpus:
+    """
+    Sequence of pre-encoded pairs (source indexes, target indexes), backed by flat token and offset arrays.
+    Items are views into the token arrays, they can be used wherever encode_pairs output is expected.
+    """
+    def __init__(self, src_tokens, src_offsets, trg_tokens, trg_offsets):
+        assert len(src_offsets) == len(trg_offsets)
+        self.src_tokens = src_tokens
+        self.src_offsets = src_offsets
+        self.trg_tokens = trg_tokens
+        self.trg_offsets = trg_offsets
+
+    @classmethod
+    def from_encoded_pairs(cls, encoded_pairs):
+        """
+        :param encoded_pairs: output of encode_pairs
+        :return: in-memory corpus
+        """
+        src_tokens, src_offsets = _flatten([src for src, _ in encoded_pairs])
+        trg_tokens, trg_offsets = _flatten([trg for _, trg in encoded_pairs])
+        return cls(src_tokens, src_offsets, trg_tokens, trg_offsets)
+
+    @classmethod
+    def load(cls, directory, split, mmap=True):
+        """
+        :param directory: corpus directory
+        :param split: name of the split, e.g. "train"
+        :param mmap: memory-map the arrays (read-only) instead of reading them
+        :return: corpus of the split
+        """
+        mmap_mode = "r" if mmap else None
+        # Plain array views of the memory maps: slices stay views and are pickled as plain arrays
+        arrays = [np.load(os.path.join(directory, "{}_{}.npy".format(split, name)), mmap_mode=mmap_mode).view(np.ndarray)
+                  for name in ("src_tokens", "src_offsets", "trg_tokens", "trg_offsets")]
+        return cls(*arrays)
+
+    def save(self, directory, split):
+        for name, array in (("src_tokens", self.src_tokens), ("src_offsets", self.src_offsets),
+                            ("trg_tokens", self.trg_tokens), ("trg_offsets", self.trg_offsets)):
+            np.save(os.path.join(directory, "{}_{}.npy".format(split, name)), array)
+
+    def __len__(self):
+        return len(self.src_offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("Corpus index out of range")
+        return (self.src_tokens[self.src_offsets[i]:self.src_offsets[i + 1]],
+                self.trg_tokens[self.trg_offsets[i]:self.trg_offsets[i + 1]])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def lengths(self):
+        """
+        :return: source lengths, target lengths (EOS included)
+        """
+        return np.diff(self.src_offsets), np.diff(self.trg_offsets)
+
+
+def _flatten(sequences):
+    offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+    np.cumsum([len(seq) for seq in sequences], out=offsets[1:])
+    tokens = np.concatenate(sequences).astype(np.int32) if sequences else np.zeros(0, dtype=np.int32)
+    return tokens, offsets
+
+
+def _save_voc(directory, prefix, voc):
+    with open(os.path.join(directory, prefix + "_vocab.txt"), mode="w", encoding="utf-8") as f:
+        f.write(voc_to_words(voc))
+    np.save(os.path.join(directory, prefix + "_counts.npy"), np.asarray(voc.counts, dtype=np.int64))
+
+
+def _load_voc(directory, prefix, lang_name):
+    counts = np.load(os.path.join(directory, prefix + "_counts.npy"))
+    with open(os.path.join(directory, prefix + "_vocab.txt"), mode="r", encoding="utf-8") as f:
+        return voc_from_words(f.read(), lang_name, counts.tolist())
+
+
+def save_encoded_corpus(directory, src_voc, tar_voc, splits, n_pairs=None, params=None):
+    """
+    Encodes sentence pairs with the given vocabularies and stores them in the binary corpus format
+    :param directory: corpus directory, created if needed
+    :param src_voc: source vocabulary
+    :param tar_voc: target vocabulary
+    :param splits: dict split name -> sentence pairs, e.g. {"train": train_set, "val": val_set, "test": test_set}
+    :param n_pairs: number of pairs of the dataset the splits were taken from
+    :param params: JSON serializable parameters the corpus was built with, stored in the meta file for reference
+    :return: dict split name -> memory-mapped EncodedCorpus
+    """
+    os.makedirs(directory, exist_ok=True)
+    if is_encoded_corpus(directory):
+        os.remove(os.path.join(directory, META_FILE))
+    _save_voc(directory, "src", src_voc)
+    _save_voc(directory, "trg", tar_voc)
+    for split, pairs in splits.items():
+        EncodedCorpus.from_encoded_pairs(encode_pairs(src_voc, tar_voc, pairs)).save(directory, split)
+    # Written last: a directory without meta file is incomplete
+    with open(os.path.join(directory, META_FILE), mode="w", encoding="utf-8") as f:
+        json.dump({"src_name": src_voc.name, "trg_name": tar_voc.name, "splits": list(splits),
+                   "n_pairs": n_pairs if n_pairs is not None else sum(len(pairs) for pairs in splits.values()),
+                   "params": params}, f, ensure_ascii=False)
+    return {split: EncodedCorpus.load(directory, split) for split in splits}
+
+
+def is_encoded_corpus(directory):
+    return os.path.isfile(os.path.join(directory, META_FILE))
+
+
+def load_encoded_corpus(directory, mmap=True):
+    """
+    Loads a corpus written by save_encoded_corpus
+    :param directory: corpus directory
+    :param mmap: memory-map the token arrays
+    :return: source vocabulary, target vocabulary, dict split name -> EncodedCorpus, number of pairs of the dataset
+    """
+    with open(os.path.join(directory, META_FILE), mode="r", encoding="utf-8") as f:
+        meta = json.load(f)
+    src_voc = _load_voc(directory, "src", meta["src_name"])
+    tar_voc = _load_voc(directory, "trg", meta["trg_name"])
+    splits = {split: EncodedCorpus.load(directory, split, mmap=mmap) for split in meta["splits"]}
+    return src_voc, tar_voc, splits, meta["n_pairs"]
+
+
+class _ArrayWriter:
+    """
+    Appends integers to a raw file, chunk by chunk. finish() copies them into a .npy file, again chunk by chunk,
+    so no array of the final size is ever held in memory.
+    """
+    def __init__(self, path, dtype, chunk_size=1 << 16):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.chunk_size = chunk_size
+        self.length = 0
+        self._buffer = []
+        self._raw = open(path + ".raw", "wb")
+
+    def extend(self, values):
+        self._buffer.extend(values)
+        if len(self._buffer) >= self.chunk_size:
+            self._flush()
+
+    def _flush(self):
+        np.asarray(self._buffer, dtype=self.dtype).tofile(self._raw)
+        self.length += len(self._buffer)
+        self._buffer = []
+
+    def finish(self, remap=None):
+        """
+        :param remap: function applied to every chunk before it is written
+        """
+        self._flush()
+        self._raw.close()
+        if self.length == 0:
+            np.save(self.path, np.zeros(0, dtype=self.dtype))
+        else:
+            raw = np.memmap(self.path + ".raw", dtype=self.dtype, mode="r", shape=(self.length,))
+            out = np.lib.format.open_memmap(self.path, mode="w+", dtype=self.dtype, shape=(self.length,))
+            for start in range(0, self.length, self.chunk_size):
+                chunk = np.asarray(raw[start:start + self.chunk_size])
+                out[start:start + len(chunk)] = remap(chunk) if remap is not None else chunk
+            out.flush()
+            del raw, out
+        os.remove(self.path + ".raw")
+
+
+class _SplitWriter:
+    """
+    Token and offset writers of both sides of a split
+    """
+    def __init__(self, directory, split):
+        self.writers = {name: _ArrayWriter(os.path.join(directory, "{}_{}.npy".format(split, name)),
+                                           np.int64 if name.endswith("offsets") else np.int32)
+                        for name in ("src_tokens", "src_offsets", "trg_tokens", "trg_offsets")}
+        self.writers["src_offsets"].extend([0])
+        self.writers["trg_offsets"].extend([0])
+        self.src_end = 0
+        self.trg_end = 0
+        self.n_pairs = 0
+
+    def append(self, src_indexes, trg_indexes):
+        self.writers["src_tokens"].extend(src_indexes)
+        self.writers["trg_tokens"].extend(trg_indexes)
+        self.src_end += len(src_indexes)
+        self.trg_end += len(trg_indexes)
+        self.writers["src_offsets"].extend([self.src_end])
+        self.writers["trg_offsets"].extend([self.trg_end])
+        self.n_pairs += 1
+
+    def finish(self, src_remap, trg_remap):
+        self.writers["src_tokens"].finish(src_remap)
+        self.writers["trg_tokens"].finish(trg_remap)
+        self.writers["src_offsets"].finish()
+        self.writers["trg_offsets"].finish()
+
+
+class _StreamingVoc:
+    """
+    Vocabulary built while encoding. Sentences of the splits the vocabulary is built on are added to the Voc,
+    exactly as build_vocab does. Other sentences are encoded against the Voc at that point: words it does not
+    contain (yet) get provisional negative indexes, resolved once all data is read - to the index of the word
+    if it was added later, to UNK otherwise.
+    """
+    def __init__(self, lang_name):
+        self.voc = Voc(lang_name)
+        self.pending = {}
+
+    def encode(self, sentence, add):
+        if add:
+            self.voc.addSentence(sentence)
+        word2index = self.voc.word2index
+        indexes = []
+        for word in sentence.split(' '):
+            index = word2index.get(word)
+            if index is None:
+                index = -1 - self.pending.setdefault(word, len(self.pending))
+            indexes.append(index)
+        indexes.append(EOS_token)
+        return indexes
+
+    def remap(self, min_count=1, max_size=None):
+        """
+        Completes the vocabulary, trimming it if requested (see Voc.trim)
+        :return: function resolving the provisional indexes of a token chunk and applying the trimming
+        """
+        resolved = np.array([self.voc.word2index.get(word, UNK_token) for word in self.pending], dtype=np.int32)
+        old2new = None
+        if min_count > 1 or max_size:
+            old2new = self.voc.trim(min_count, max_size)
+            resolved = old2new[resolved]
+
+        def remap(chunk):
+            provisional = chunk < 0
+            if old2new is not None:
+                remapped = old2new[np.where(provisional, 0, chunk)]
+            else:
+                remapped = chunk.copy() if provisional.any() else chunk
+            if provisional.any():
+                remapped[provisional] = resolved[-1 - chunk[provisional]]
+            return remapped
+        return remap
+
+
+def stream_encoded_corpus(directory, pairs, src_name, trg_name, limit=None, seed=1, val_ratio=0.2, test_ratio=0.1,
+                          voc_all=False, min_count=1, max_size=None, params=None):
+    """
+    Single pass ingestion: splits the pairs, builds the vocabularies and writes the encoded corpus while reading
+    the pairs from an iterable (e.g. utils.prepro.iter_preprocessed). Memory depends on the vocabulary size,
+    not on the number of pairs.
+    Every pair is assigned to a split by a random draw, so the split sizes match split_data in expectation
+    (val_ratio of all pairs, test_ratio of the rest), but not exactly.
+    :param directory: corpus directory, created if needed
+    :param pairs: iterable of cleaned sentence pairs
+    :param src_name: name of the source language
+    :param trg_name: name of the target language
+    :param limit: number of pairs read at most
+    :param seed: seed of the split
+    :param val_ratio: ratio of validation pairs
+    :param test_ratio: ratio of test pairs among the remaining pairs
+    :param voc_all: build the vocabularies on train and validation set
+    :param min_count: minimum count of a vocabulary word, rarer words are encoded as UNK
+    :param max_size: maximum vocabulary size, special tokens included
+    :param params: JSON serializable parameters the corpus was built with, stored in the meta file for reference
+    :return: source vocabulary, target vocabulary, dict split name -> memory-mapped EncodedCorpus, number of pairs
+    """
+    os.makedirs(directory, exist_ok=True)
+    if is_encoded_corpus(directory):
+        os.remove(os.path.join(directory, META_FILE))
+    rng = random.Random(seed)
+    test_bound = val_ratio + (1 - val_ratio) * test_ratio
+    vocab_splits = ("train", "val") if voc_all else ("train",)
+    src_voc, trg_voc = _StreamingVoc(src_name), _StreamingVoc(trg_name)
+    writers = {split: _SplitWriter(directory, split) for split in ("train", "val", "test")}
+
+    for src_sent, trg_sent in islice(pairs, limit):
+        draw = rng.random()
+        split = "val" if draw < val_ratio else "test" if draw < test_bound else "train"
+        add = split in vocab_splits
+        writers[split].append(src_voc.encode(src_sent, add), trg_voc.encode(trg_sent, add))
+
+    src_remap, trg_remap = src_voc.remap(min_count, max_size), trg_voc.remap(min_count, max_size)
+    for writer in writers.values():
+        writer.finish(src_remap, trg_remap)
+    _save_voc(directory, "src", src_voc.voc)
+    _save_voc(directory, "trg", trg_voc.voc)
+    n_pairs = sum(writer.n_pairs for writer in writers.values())
+    # Written last: a directory without meta file is incomplete
+    with open(os.path.join(directory, META_FILE), mode="w", encoding="utf-8") as f:
+        json.dump({"src_name": src_name, "trg_name": trg_name, "splits": list(writers), "n_pairs": n_pairs,
+                   "params": params}, f, ensure_ascii=False)
+    return load_encoded_corpus(directory)
@@ -0,0 +1,150 @@
+import builtins
+import datetime
+import os
+
+import torch
+import torch.distributed as dist
+
+"""
+Data-parallel training on several processes, on one machine or on several machines (torch.distributed, gloo backend).
+The processes are started with torchrun, which sets RANK, WORLD_SIZE, LOCAL_RANK, MASTER_ADDR and MASTER_PORT.
+Every process (rank) trains a replica of encoder and decoder on its own shard of the batches. After the backward
+passes of a batch, the gradients are averaged over all processes, so that the replicas take the same optimizer steps.
+Gradients are averaged once per training step with all_reduce calls over flat buckets, as DistributedDataParallel
+does. DistributedDataParallel itself expects one forward call per backward pass, while the decoder is called once per
+step (or through forward_sequence) and truncated backpropagation runs several backward passes per batch.
+"""
+
+### Size of the flat buffers used to all-reduce the gradients (same default as DistributedDataParallel)
+BUCKET_SIZE_MB = 25
+
+
+def init_distributed(backend="gloo", timeout_minutes=120):
+    """
+    Joins the process group when the script was started by torchrun with more than one process.
+    Outside of the main process, print only writes with print(..., force=True).
+    :param backend: torch.distributed backend, gloo runs on CPU
+    :param timeout_minutes: timeout of the collective calls, the other processes wait for the main process while it
+        preprocesses the data
+    :return: rank and number of processes (0, 1 without torchrun)
+    """
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    if world_size == 1:
+        return 0, 1
+    if not dist.is_initialized():
+        dist.init_process_group(backend, init_method="env://", timeout=datetime.timedelta(minutes=timeout_minutes))
+    rank = dist.get_rank()
+    if rank != 0:
+        _silence_print()
+    return rank, dist.get_world_size()
+
+
+def _silence_print():
+    builtin_print = builtins.print
+
+    def print(*args, force=False, **kwargs):
+        if force:
+            builtin_print(*args, **kwargs)
+
+    builtins.print = print
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    """
+    :return: True in the process which writes checkpoints, logs and plots (rank 0)
+    """
+    return get_rank() == 0
+
+
+def is_local_main_process():
+    """
+    :return: True in the first process of every machine, e.g. to fill the preprocessing cache of the machine
+    """
+    return int(os.environ.get("LOCAL_RANK", 0)) == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def broadcast_parameters(modules, src=0):
+    """
+    Copies parameters and buffers of the main process to all processes, so that all replicas start from the same
+    weights (as DistributedDataParallel does on construction)
+    :param modules: modules to synchronize, e.g. [encoder, decoder]
+    :param src: rank of the process holding the weights
+    """
+    if not is_distributed():
+        return
+    for module in modules:
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            dist.broadcast(tensor.data, src)
+
+
+def _buckets(params, bucket_size):
+    bucket, size = [], 0
+    for param in params:
+        bucket.append(param)
+        size += param.numel() * param.element_size()
+        if size >= bucket_size:
+            yield bucket
+            bucket, size = [], 0
+    if bucket:
+        yield bucket
+
+
+def all_reduce_gradients(modules, bucket_size_mb=BUCKET_SIZE_MB):
+    """
+    Averages the gradients over all processes, in place.
+    The gradients are copied into flat buckets of about bucket_size_mb, all buckets are reduced asynchronously.
+    Parameters without gradient take part with zeros, so that all processes reduce buffers of the same size.
+    :param modules: modules whose gradients are averaged, e.g. [encoder, decoder]
+    :param bucket_size_mb: size of a bucket in MB
+    """
+    if not is_distributed():
+        return
+    params = [param for module in modules for param in module.parameters() if param.requires_grad]
+    for param in params:
+        if param.grad is None:
+            param.grad = torch.zeros_like(param)
+    world_size = dist.get_world_size()
+    pending = []
+    for bucket in _buckets(params, bucket_size_mb * 2 ** 20):
+        flat = torch.cat([param.grad.reshape(-1) for param in bucket])
+        pending.append((bucket, flat, dist.all_reduce(flat, async_op=True)))
+    for bucket, flat, work in pending:
+        work.wait()
+        flat /= world_size
+        offset = 0
+        for param in bucket:
+            param.grad.copy_(flat[offset:offset + param.numel()].view_as(param.grad))
+            offset += param.numel()
+
+
+def all_reduce_values(values, average=True):
+    """
+    Sums or averages a list of numbers over all processes, e.g. the logged losses and token counts
+    :param values: list of numbers
+    :param average: divide the sums by the number of processes
+    :return: list of floats, unchanged without distributed training
+    """
+    if not is_distributed():
+        return [float(value) for value in values]
+    tensor = torch.tensor(values, dtype=torch.double)
+    dist.all_reduce(tensor)
+    if average:
+        tensor /= dist.get_world_size()
+    return tensor.tolist()
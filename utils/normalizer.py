@@ -0,0 +1,90 @@
+"""
+Trie based replacement of the keys of a mapping (e.g. ENG_CONTRACTIONS_MAP, UMLAUT_MAP) in a sentence.
+The mapping is compiled once; a sentence is then scanned in a single left-to-right pass, following the trie from
+every position where a key can start.
+
+The default matching reproduces the former regex alternation over the keys (re.IGNORECASE):
+at the leftmost position where any key matches, the key coming first in the mapping wins, the matched text is
+replaced by mapping[matched_text.lower()] (or removed, if the lowercased text is not a key).
+Note that with ENG_CONTRACTIONS_MAP this is not always the longest key: "can't" comes before "can't've".
+With longest_match=True the longest matching key wins instead.
+"""
+
+
+def _fold(c):
+    # Case-insensitive comparison character by character, as re.IGNORECASE
+    lower = c.lower()
+    return lower if len(lower) == 1 else c
+
+
+class _Node:
+    __slots__ = ("children", "priority")
+
+    def __init__(self):
+        self.children = {}
+        self.priority = None
+
+
+class MapNormalizer:
+    """
+    Compiled mapping: replaces occurrences of the keys in a sentence
+    """
+    def __init__(self, mapping, longest_match=False):
+        """
+        :param mapping: dictionary key -> replacement. Keys are matched literally and case-insensitively
+        :param longest_match: prefer the longest matching key instead of the first one in the mapping
+        """
+        self.mapping = dict(mapping)
+        self.longest_match = longest_match
+        self.root = _Node()
+        for priority, key in enumerate(self.mapping):
+            if not key:
+                continue
+            node = self.root
+            for c in key:
+                node = node.children.setdefault(_fold(c), _Node())
+            if node.priority is None:
+                node.priority = priority
+
+    def _match(self, folded, start):
+        """
+        :return: end of the chosen key starting at start, or None
+        """
+        node = self.root
+        best_end, best_priority = None, None
+        for end in range(start, len(folded)):
+            node = node.children.get(folded[end])
+            if node is None:
+                break
+            if node.priority is not None and (self.longest_match or best_priority is None
+                                              or node.priority < best_priority):
+                best_end, best_priority = end + 1, node.priority
+        return best_end
+
+    def __call__(self, sentence):
+        """
+        :param sentence: sentence
+        :return: sentence with all keys replaced
+        """
+        folded = sentence.lower()
+        if len(folded) != len(sentence):
+            folded = [_fold(c) for c in sentence]
+        starts = self.root.children
+
+        parts = []
+        last = 0
+        i = 0
+        n = len(sentence)
+        while i < n:
+            if folded[i] in starts:
+                end = self._match(folded, i)
+                if end is not None:
+                    parts.append(sentence[last:i])
+                    parts.append(self.mapping.get(sentence[i:end].lower(), ""))
+                    i = last = end
+                    continue
+            i += 1
+        if not parts:
+            return sentence
+        parts.append(sentence[last:])
+        return "".join(parts)
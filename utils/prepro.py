@@ -1,13 +1,19 @@
 import io
+import itertools
+import json
 import os
 import string
 import unicodedata
 import re
+from collections import deque
+from multiprocessing import Pool
 from pickle import dump, load
 
 from utils.mappings import ENG_CONTRACTIONS_MAP, UMLAUT_MAP
+from utils.normalizer import MapNormalizer
 from utils.tokenize import SOS_token, EOS_token
-from global_settings import PREPRO_DIR
+from utils.cache import file_digest, cache_key
+from global_settings import PREPRO_DIR, PREPRO_CACHE_DIR
 
 """ 
 This script contains methods to preprocess text files.
@@ -21,6 +27,13 @@ Adaptation for this task:
 
 """
 
+# Precompiled once: regex for char filtering and translation table for removing punctuation
+RE_PRINT = re.compile('[^%s]' % re.escape(string.printable))
+PUNCTUATION_TABLE = str.maketrans('', '', string.punctuation)
+
+# Part of the preprocessing cache key: increase it whenever the cleaning changes its output for the same input
+PREPRO_VERSION = 1
+
 
 def read_lines(root, filename):
     """
@@ -40,6 +53,18 @@ def read_lines(root, filename):
     return lines
 
 
+def iter_lines(root, filename):
+    """
+    Streaming version of read_lines: yields the lines one by one, without reading the whole file
+    :param root: directory path
+    :param filename: filename
+    :return: generator of lines (parallel corpus)
+    """
+    with io.open(os.path.join(root, filename), encoding="utf-8") as f:
+        for line in f:
+            yield line.replace("\n", "").lower().split("\t")
+
+
 def reverse_language_pair(pairs):
     """
     To use after read_lines, this allows to reverse the language combination order
@@ -76,7 +101,7 @@ def filter_pair(p, max_len):
     return len(p[0].split(" ")) <= max_len and len(p[1].split(" ")) <= max_len
 
 
-def preprocess_sentence(sentence, expand_contractions=None, append_token=False):
+def preprocess_sentence(sentence, expand_contractions=None, append_token=False, normalizer=None):
     # print("Preprocessing sentence...")
     """
     Rapid preprocessing
@@ -91,20 +116,19 @@ def preprocess_sentence(sentence, expand_contractions=None, append_token=False):
     - Lower case
     - Remove digits
     :param lines: lines to be preprocessed
+    :param normalizer: compiled contraction dictionary (see compile_contractions)
     :return: cleaned lines
     """
     if expand_contractions:
         mapping = expand_contractions
-        sentence = expand_contraction(sentence, mapping)
+        sentence = expand_contraction(sentence, mapping, normalizer)
 
     # Filtering function only applies on a sentence level
     # if filter_func:
     # sentence = filter_func(sentence)
 
-    # prepare regex for char filtering
-    re_print = re.compile('[^%s]' % re.escape(string.printable))
-    # prepare translation table for removing punctuation
-    table = str.maketrans('', '', string.punctuation)
+    re_print = RE_PRINT
+    table = PUNCTUATION_TABLE
 
     line = unicodedata.normalize("NFD", sentence).encode("ascii", "ignore")
     line = line.decode('UTF-8')
@@ -128,25 +152,38 @@ def preprocess_sentence(sentence, expand_contractions=None, append_token=False):
     return line
 
 
-def expand_contraction(sentence, mapping):
+### Compiled normalizers of the mappings used so far: id(mapping) -> (mapping, normalizer)
+_normalizers = {}
+
+
+def compile_contractions(mapping):
+    """
+    :param mapping: contraction dictionary
+    :return: normalizer replacing the keys of the dictionary (see utils/normalizer.py)
+    """
+    cached = _normalizers.get(id(mapping))
+    # The mapping may have been changed since it was compiled
+    if cached is None or cached[0] != mapping:
+        cached = (dict(mapping), MapNormalizer(mapping))
+        _normalizers[id(mapping)] = cached
+    return cached[1]
+
+
+def expand_contraction(sentence, mapping, normalizer=None):
     """
     Expands tokens in sentence given a contraction dictionary
 
     source: https://www.linkedin.com/pulse/processing-normalizing-text-data-saurav-ghosh
+    The regex alternation over all keys has been replaced by a trie, with the same results.
 
     :param sentence: sentence to expand
     :param mapping: contraction dictionary
+    :param normalizer: compile_contractions(mapping), looked up here if not given
     :return: expanded sentence
     """
-    contractions_patterns = re.compile('({})'.format('|'.join(mapping.keys())), flags=re.IGNORECASE | re.DOTALL)
-
-    def replace_text(t):
-        txt = t.group(0)
-        if txt.lower() in mapping.keys():
-            return mapping[txt.lower()]
-
-    expanded_sentence = contractions_patterns.sub(replace_text, sentence)
-    return expanded_sentence
+    if normalizer is None:
+        normalizer = compile_contractions(mapping)
+    return normalizer(sentence)
 
 
 def normalize_string(sentence):
@@ -207,12 +244,115 @@ def load_cleaned_data(path, filename):
         raise RuntimeError("File not found, please preprocess and save sentences!")
 
 
-def preprocess_pipeline(pairs, cleaned_file_to_store=None, exp_contraction=None, reverse_pairs=False, max_len=10):
+class PairCleaner:
+    """
+    Preprocesses sentence pairs with the contraction dictionaries of both languages compiled once
+    """
+    def __init__(self, src_mapping, trg_mapping):
+        self.src_mapping = src_mapping
+        self.trg_mapping = trg_mapping
+        self.src_normalizer = compile_contractions(src_mapping) if src_mapping else None
+        self.trg_normalizer = compile_contractions(trg_mapping) if trg_mapping else None
+
+    def clean(self, src_sent, trg_sent):
+        cleaned_src_sent = preprocess_sentence(src_sent, self.src_mapping, append_token=False,
+                                               normalizer=self.src_normalizer)
+        cleaned_trg_sent = preprocess_sentence(trg_sent, self.trg_mapping, append_token=False,
+                                               normalizer=self.trg_normalizer)
+        return [cleaned_src_sent, cleaned_trg_sent]
+
+    def __call__(self, pairs):
+        return [self.clean(src_sent, trg_sent) for src_sent, trg_sent in pairs]
+
+
+### Cleaner of a worker process, built once by the pool initializer
+_worker_cleaner = None
+
+
+def _init_worker(src_mapping, trg_mapping):
+    global _worker_cleaner
+    _worker_cleaner = PairCleaner(src_mapping, trg_mapping)
+
+
+def _clean_chunk(pairs):
+    return _worker_cleaner(pairs)
+
+
+def clean_pairs(pairs, src_mapping, trg_mapping, num_workers=1, chunk_size=5000):
+    """
+    Preprocesses all pairs, serially or sharded in chunks across a process pool.
+    The output (order and content) does not depend on the number of workers.
+    :param pairs: sentence pairs
+    :param src_mapping: contraction dictionary of the source language
+    :param trg_mapping: contraction dictionary of the target language
+    :param num_workers: number of worker processes, 1 preprocesses in this process
+    :param chunk_size: pairs sent to a worker at a time
+    :return: cleaned pairs
+    """
+    if num_workers <= 1:
+        return PairCleaner(src_mapping, trg_mapping)(pairs)
+    chunks = [pairs[i:i + chunk_size] for i in range(0, len(pairs), chunk_size)]
+    cleaned_pairs = []
+    with Pool(num_workers, initializer=_init_worker, initargs=(src_mapping, trg_mapping)) as pool:
+        # imap returns the chunks in order
+        for cleaned_chunk in pool.imap(_clean_chunk, chunks):
+            cleaned_pairs.extend(cleaned_chunk)
+    return cleaned_pairs
+
+
+def iter_clean_pairs(pairs, src_mapping, trg_mapping, num_workers=1, chunk_size=5000):
+    """
+    Streaming version of clean_pairs: pairs are read from an iterable and yielded in order.
+    With several workers, at most 2 * num_workers chunks are in flight, so memory does not grow with the input.
+    :param pairs: iterable of sentence pairs, e.g. iter_lines
+    :param src_mapping: contraction dictionary of the source language
+    :param trg_mapping: contraction dictionary of the target language
+    :param num_workers: number of worker processes, 1 preprocesses in this process
+    :param chunk_size: pairs sent to a worker at a time
+    :return: generator of cleaned pairs
+    """
+    if num_workers <= 1:
+        cleaner = PairCleaner(src_mapping, trg_mapping)
+        for src_sent, trg_sent in pairs:
+            yield cleaner.clean(src_sent, trg_sent)
+        return
+    pairs = iter(pairs)
+    with Pool(num_workers, initializer=_init_worker, initargs=(src_mapping, trg_mapping)) as pool:
+        pending = deque()
+        while True:
+            chunk = list(itertools.islice(pairs, chunk_size))
+            if chunk:
+                pending.append(pool.apply_async(_clean_chunk, (chunk,)))
+            if pending and (not chunk or len(pending) >= 2 * num_workers):
+                yield from pending.popleft().get()
+            elif not chunk:
+                return
+
+
+def iter_preprocessed(pairs, exp_contraction=None, reverse_pairs=False, max_len=10, num_workers=1):
+    """
+    Streaming version of preprocess_pipeline: cleans, reverses and filters the pairs one by one.
+    The output is the same as the pairs returned by preprocess_pipeline, nothing is stored.
+    :param pairs: iterable of sentence pairs, e.g. iter_lines
+    :param num_workers: number of preprocessing processes
+    :return: generator of cleaned pairs
+    """
+    src_mapping, trg_mapping = contraction_mappings(exp_contraction)
+    for pair in iter_clean_pairs(pairs, src_mapping, trg_mapping, num_workers=num_workers):
+        if reverse_pairs:
+            pair = pair[::-1]
+        if max_len <= 0 or filter_pair(pair, max_len):
+            yield pair
+
+
+def preprocess_pipeline(pairs, cleaned_file_to_store=None, exp_contraction=None, reverse_pairs=False, max_len=10,
+                        num_workers=1):
     """
     Performs preprocessing in a single pipeline
     :param cleaned_file_to_store:
     :param exp_contraction:
     :param reverse_pairs:
+    :param num_workers: number of preprocessing processes
     :return:
     """
 
@@ -225,20 +365,9 @@ def preprocess_pipeline(pairs, cleaned_file_to_store=None, exp_contraction=None,
     src_sents = [item[0] for item in pairs]
     trg_sents = [item[1] for item in pairs]
 
-    if expand_contraction:
-        src_mapping = ENG_CONTRACTIONS_MAP
-        trg_mapping = UMLAUT_MAP
-    else:
-        src_mapping = exp_contraction
-        trg_mapping = exp_contraction
+    src_mapping, trg_mapping = contraction_mappings(exp_contraction)
 
-    cleaned_pairs = []
-    for i, (src_sent, trg_sent) in enumerate(pairs):
-        cleaned_src_sent = preprocess_sentence(src_sent, src_mapping, append_token=False)
-        cleaned_trg_sent = preprocess_sentence(trg_sent, trg_mapping, append_token=False)
-        cleaned_list = [cleaned_src_sent, cleaned_trg_sent]
-
-        cleaned_pairs.append(cleaned_list)
+    cleaned_pairs = clean_pairs(pairs, src_mapping, trg_mapping, num_workers=num_workers)
 
     if reverse_pairs:
         cleaned_pairs = reverse_language_pair(cleaned_pairs)
@@ -254,3 +383,60 @@ def preprocess_pipeline(pairs, cleaned_file_to_store=None, exp_contraction=None,
         store_path = save_clean_data(PREPRO_DIR, cleaned_pairs, cleaned_file_to_store)
         print("Preprocessing complete!")
     return cleaned_pairs, store_path
+
+
+def contraction_mappings(exp_contraction):
+    """
+    :param exp_contraction: expand contractions
+    :return: contraction dictionaries of source and target language, None if contractions are not expanded
+    """
+    if exp_contraction:
+        return ENG_CONTRACTIONS_MAP, UMLAUT_MAP
+    return None, None
+
+
+def preprocessing_params(source_file, exp_contraction=None, reverse_pairs=False, max_len=10):
+    """
+    Everything the output of preprocess_pipeline depends on: content of the source file, the contraction
+    dictionaries in use, the pair order, the length filter and the version of the cleaning code
+    :param source_file: path to the tab separated parallel corpus
+    :return: JSON serializable dict, see cache_key
+    """
+    src_mapping, trg_mapping = contraction_mappings(exp_contraction)
+    return {"source_sha256": file_digest(source_file), "exp_contraction": bool(exp_contraction),
+            "src_mapping": src_mapping, "trg_mapping": trg_mapping, "reverse_pairs": bool(reverse_pairs),
+            "max_len": max_len, "version": PREPRO_VERSION}
+
+
+def load_or_preprocess(source_file, exp_contraction=None, reverse_pairs=False, max_len=10, num_workers=1,
+                       cache_dir=PREPRO_CACHE_DIR, params=None):
+    """
+    Returns the preprocessed pairs of the source file from the preprocessing cache, or preprocesses and caches them.
+    Cache entries are named by the key of their preprocessing parameters, so results of different files and
+    settings are stored side by side and a changed file is never served from a stale entry.
+    :param source_file: path to the tab separated parallel corpus
+    :param num_workers: number of preprocessing processes
+    :param cache_dir: directory of the cache entries
+    :param params: output of preprocessing_params for the same arguments, if already computed
+    :return: cleaned pairs, cache key
+    """
+    if params is None:
+        params = preprocessing_params(source_file, exp_contraction, reverse_pairs, max_len)
+    key = cache_key(params)
+    cached_file = key + ".pkl"
+    if os.path.isfile(os.path.join(cache_dir, cached_file)):
+        print("Preprocessed file found in cache (%s)! Loading file...." % key)
+        return load_cleaned_data(cache_dir, cached_file), key
+
+    print("No preprocessed file found in cache. Starting data preprocessing...")
+    pairs = read_lines(*os.path.split(source_file))
+    cleaned_pairs, _ = preprocess_pipeline(pairs, None, exp_contraction, reverse_pairs=reverse_pairs,
+                                           max_len=max_len, num_workers=num_workers)
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, key + ".json"), mode="w", encoding="utf-8") as f:
+        json.dump(dict(params, source_file=source_file), f, ensure_ascii=False, indent=1)
+    # Renamed when complete: an interrupted run does not leave a truncated entry behind
+    tmp_path = save_clean_data(cache_dir, cleaned_pairs, cached_file + ".tmp")
+    os.replace(tmp_path, os.path.join(cache_dir, cached_file))
+    print("Preprocessing complete!")
+    return cleaned_pairs, key
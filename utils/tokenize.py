@@ -1,5 +1,6 @@
 # Default word tokens
 import itertools
+import numpy as np
 import torch
 
 """
@@ -17,36 +18,125 @@ SOS = "<SOS>"
 EOS = "<EOS>"
 UNK = "<UNK>"
 
+SPECIAL_TOKENS = [PAD, SOS, EOS, UNK] # ordered by index
+
+
 class Voc:
+    """
+    Vocabulary. Words are indexed in order of first appearance; index2word and counts are lists indexed by the word
+    index, word2index is the only dict. Special tokens have count 0.
+    """
     def __init__(self, name):
         self.name = name
         self.trimmed = False
-        self.word2index = {PAD: PAD_token, SOS: SOS_token, EOS: EOS_token, UNK: UNK_token}
-        self.word2count = {}
-        self.index2word = {PAD_token: PAD, SOS_token: SOS, EOS_token: EOS, UNK_token:UNK}
-        self.num_words = 4  # Count SOS, EOS, PAD
+        self.word2index = {word: index for index, word in enumerate(SPECIAL_TOKENS)}
+        self.index2word = list(SPECIAL_TOKENS)
+        self.counts = [0] * len(SPECIAL_TOKENS)
+        self.num_words = len(SPECIAL_TOKENS)  # Count PAD, SOS, EOS, UNK
+
+    @property
+    def word2count(self):
+        """
+        :return: dict word -> count of the counted words
+        """
+        return {word: count for word, count in zip(self.index2word, self.counts) if count > 0}
 
     def addSentence(self, sentence):
         for word in sentence.split(' '):
             self.addWord(word)
 
     def addWord(self, word):
-        if word not in self.word2index:
+        index = self.word2index.get(word)
+        if index is None:
             self.word2index[word] = self.num_words
-            self.word2count[word] = 1
-            self.index2word[self.num_words] = word
+            self.index2word.append(word)
+            self.counts.append(1)
             self.num_words += 1
         else:
-            self.word2count[word] += 1
-
-
-def build_vocab(sent_list, lang_name):
+            self.counts[index] += 1
+
+    def trim(self, min_count=1, max_size=None):
+        """
+        Drops rare words: keeps the words counted at least min_count times and, if max_size is given,
+        only the most frequent ones so that the vocabulary has at most max_size entries (special tokens included,
+        they are always kept).
+        Kept words keep their order, dropped words are encoded as UNK from now on; their counts are added to UNK.
+        :param min_count: minimum count of a kept word
+        :param max_size: maximum number of entries
+        :return: int32 array old index -> new index, to re-encode data encoded with the untrimmed vocabulary
+        """
+        counts = np.asarray(self.counts, dtype=np.int64)
+        n_special = len(SPECIAL_TOKENS)
+        keep = counts >= min_count
+        keep[:n_special] = True
+        if max_size is not None and keep.sum() > max_size:
+            # Most frequent words first, ties broken by index
+            candidates = np.flatnonzero(keep[n_special:]) + n_special
+            ranked = candidates[np.argsort(-counts[candidates], kind="stable")]
+            keep[ranked[max(max_size - n_special, 0):]] = False
+
+        old2new = np.full(len(counts), UNK_token, dtype=np.int32)
+        old2new[keep] = np.arange(int(keep.sum()), dtype=np.int32)
+        self.counts = counts[keep].tolist()
+        self.counts[UNK_token] += int(counts[~keep].sum())
+        self.index2word = [word for word, kept in zip(self.index2word, keep) if kept]
+        self.word2index = {word: index for index, word in enumerate(self.index2word)}
+        self.num_words = len(self.index2word)
+        self.trimmed = True
+        return old2new
+
+
+def build_vocab(sent_list, lang_name, min_count=1, max_size=None):
     vocab = Voc(name=lang_name)
     for sent in sent_list:
         vocab.addSentence(sent)
+    if min_count > 1 or max_size:
+        vocab.trim(min_count, max_size)
+    return vocab
+
+
+def voc_to_words(voc):
+    # Compact serialization: the words ordered by index, as one newline separated string
+    return "\n".join(voc.index2word)
+
+
+def voc_from_words(words, lang_name, counts=None):
+    vocab = Voc(name=lang_name)
+    vocab.index2word = words.split("\n")
+    vocab.word2index = {word: index for index, word in enumerate(vocab.index2word)}
+    vocab.num_words = len(vocab.index2word)
+    vocab.counts = list(counts) if counts is not None else [0] * vocab.num_words
     return vocab
 
 
+def voc_to_state(voc):
+    """
+    Compact serialization of a vocabulary for checkpoints: word string and counts tensor
+    :param voc: vocabulary
+    :return: dict name, words, counts, trimmed
+    """
+    return {"name": voc.name, "words": voc_to_words(voc), "counts": torch.tensor(voc.counts, dtype=torch.int64),
+            "trimmed": voc.trimmed}
+
+
+def voc_from_state(state, lang_name=None):
+    """
+    Inverse of voc_to_state. Also reads the former checkpoint format, the __dict__ of the vocabulary
+    :param state: serialized vocabulary
+    :param lang_name: name of the vocabulary, if not stored
+    :return: vocabulary
+    """
+    if "words" in state:
+        voc = voc_from_words(state["words"], state.get("name", lang_name), state["counts"].tolist())
+        voc.trimmed = state.get("trimmed", False)
+        return voc
+    index2word = state["index2word"]
+    voc = voc_from_words("\n".join(index2word[i] for i in range(state["num_words"])), state.get("name", lang_name))
+    word2count = state.get("word2count", {})
+    voc.counts = [word2count.get(word, 0) for word in voc.index2word]
+    return voc
+
+
 ###### Vectorization methods #######
 
 def indexesFromSentence(voc, sentence):
@@ -81,9 +171,8 @@ def outputVar(l, voc):
     lengths = torch.tensor(sorted([len(indexes) for indexes in indexes_batch], reverse=True))# 'lengths' array has to be sorted in decreasing order -> pack padded
     max_target_len = max(lengths)
     padList = zeroPadding(indexes_batch)
-    mask = binaryMatrix(padList)
-    mask = torch.ByteTensor(mask)
     padVar = torch.LongTensor(padList)
+    mask = padVar != PAD_token
     return padVar, mask, max_target_len, lengths
 
 # Returns all items for a given batch of pairs
@@ -98,5 +187,43 @@ def batch2TrainData(src_voc, tar_voc, pair_batch):
     return inp, lengths, output, mask, max_target_len, out_lengths
 
 
-
-
+###### Vectorized methods on pre-encoded sentences #######
+
+def encode_pairs(src_voc, tar_voc, pairs):
+    """
+    Encodes sentence pairs once, so that batches can be built without looking up words again
+    :param src_voc: source vocabulary
+    :param tar_voc: target vocabulary
+    :param pairs: sentence pairs
+    :return: list of (source indexes, target indexes) as int32 arrays, EOS included
+    """
+    return [(np.array(indexesFromSentence(src_voc, src), dtype=np.int32),
+             np.array(indexesFromSentence(tar_voc, trg), dtype=np.int32)) for src, trg in pairs]
+
+
+def padEncoded(sequences):
+    """
+    :param sequences: list of index arrays
+    :return: padded LongTensor of shape (max_len, batch_size), lengths as int64 array
+    """
+    lengths = np.fromiter((len(seq) for seq in sequences), dtype=np.int64, count=len(sequences))
+    padded = np.full((lengths.max(), len(sequences)), PAD_token, dtype=np.int64)
+    # The transposed view is filled row by row, i.e. sentence by sentence
+    padded.T[np.arange(padded.shape[0]) < lengths[:, None]] = np.concatenate(sequences)
+    return torch.from_numpy(padded), lengths
+
+
+def encodedBatch2TrainData(pair_batch):
+    """
+    Same outputs as batch2TrainData, for a batch of pre-encoded pairs (see encode_pairs)
+    :param pair_batch: list of (source indexes, target indexes)
+    :return: input, lengths, output, mask, max target length, target lengths
+    """
+    src_lengths = np.fromiter((len(src) for src, _ in pair_batch), dtype=np.int64, count=len(pair_batch))
+    # Stable sort by decreasing source length, as the list sort in batch2TrainData
+    order = np.argsort(-src_lengths, kind="stable")
+    inp, lengths = padEncoded([pair_batch[i][0] for i in order])
+    output, out_lengths = padEncoded([pair_batch[i][1] for i in order])
+    mask = output != PAD_token
+    out_lengths = torch.from_numpy(np.sort(out_lengths)[::-1].copy())
+    return inp, torch.from_numpy(lengths), output, mask, out_lengths.max(), out_lengths
@@ -2,6 +2,7 @@ import os
 import random
 
 import torch
+import torch.nn.functional as F
 
 from global_settings import device
 import matplotlib.pyplot as plt
@@ -77,6 +78,43 @@ def maskNLLLoss(inp, target, mask):
     return loss, nTotal.item()
 
 
+def maskCrossEntropyLoss(inp, target, mask, ignore_index=-100):
+    """
+    Fused version of maskNLLLoss, to use with the raw decoder logits (decoder(..., logits=True)).
+    Log-softmax, NLL and masking are computed in a single cross entropy op, masked positions are ignored.
+    :param inp: Logits provided as tensor, shape = (batch_size, vocabulary_size)
+    :param target: Target variable provided as tensor
+    :param mask: THe masking matrix to handle with padded tensors
+    :param ignore_index: target value used for the masked positions, must not be a vocabulary index
+    :return: the mean cross entropy for the not masked targets and the number of not masked targets (as tensor,
+        reading it would synchronize with the device at every step)
+    """
+    mask = mask.bool()
+    nTotal = mask.sum()
+    # Logits from a bfloat16 autocast region: the loss is computed in fp32
+    inp = inp.float()
+    loss = F.cross_entropy(inp, target.masked_fill(~mask, ignore_index), ignore_index=ignore_index)
+    return loss, nTotal
+
+
+def sequenceMaskCrossEntropyLoss(inp, target, mask):
+    """
+    maskCrossEntropyLoss for all time steps in one call, e.g. for the output of DecoderLSTM.forward_sequence.
+    :param inp: Logits provided as tensor, shape = (max_target_len, batch_size, vocabulary_size)
+    :param target: Target variable provided as tensor, shape = (max_target_len, batch_size)
+    :param mask: THe masking matrix to handle with padded tensors
+    :return: the sum over the time steps of the mean cross entropy of each step (the loss of a step by step loop
+        with maskCrossEntropyLoss), the summed cross entropy of all not masked targets and their number
+    """
+    mask = mask.bool()
+    # Logits from a bfloat16 autocast region: the loss is computed in fp32
+    inp = inp.float()
+    losses = F.cross_entropy(inp.flatten(0, 1), target.flatten(), reduction="none").view_as(target)
+    losses = losses.masked_fill(~mask, 0.)
+    loss = (losses.sum(dim=1) / mask.sum(dim=1).clamp(min=1)).sum()
+    return loss, losses.sum(), mask.sum()
+
+
 def split_data(data, test_ratio=0.2, seed=40):
     """
     Splits data into training, validation and test set.